@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+# Offline replay / benchmark for DbusTeslaAPIService.
+# Feeds a recording of vehicle_data responses and inverter power values (one JSON object per line, see
+# sample-vehicle-data.jsonl) through the real service, with a fake VeDbusService instead of D-Bus and a local
+# stub HTTP server instead of the Tesla API. Needs PyGObject (gi) and requests - no car, token or Venus OS.
+#
+# Recording lines:
+#   {"inverter": 1900, "vehicle_data": {"response": {...}}}   - served with 200
+#   {"inverter": 0, "status": 408, "body": {...}}             - served as an error response (a vehicle list
+#                                                                probe answers "asleep" for a 408 line instead)
+#
+# Usage: python replay.py [recording.jsonl] [--policy heuristic|backoff|budget] [--budget N] [--vehicles N] [--estimate]
+#                         [--profile cprofile|sample] [--delay SECONDS] [--json]
+#        python replay.py [recording.jsonl] --compare N   - N cars in one process vs. N single-car processes
+import os
+import sys
+import json
+import time
+import types
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from datetime import datetime
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gi.repository import GLib
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+service_path = os.path.join(script_dir, '..', 'dbus-teslaapi-evcharger.py')
+
+
+class FakeVeDbusService:
+  # stands in for velib's VeDbusService and counts the writes the service makes
+  def __init__(self, servicename, *args, **kwargs):
+    self.servicename = servicename
+    self.values = {}
+    self.callbacks = {}
+    self.writes = 0
+    self.changes = 0
+
+  def add_path(self, path, value, description='', writeable=False, onchangecallback=None, gettextcallback=None, **kwargs):
+    self.values[path] = value
+    self.callbacks[path] = onchangecallback
+
+  def __getitem__(self, path):
+    return self.values[path]
+
+  def __setitem__(self, path, value):
+    self.writes += 1
+    if self.values.get(path) != value:
+      self.changes += 1
+    self.values[path] = value
+
+  def __delitem__(self, path):
+    del self.values[path]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+
+class StubTeslaAPI(BaseHTTPRequestHandler):
+  # the server instance carries the recording and the request counters - every car replays the whole recording
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    self._count('token')
+    self._send(200, {'access_token': 'replay', 'refresh_token': 'replay', 'expires_in': 8 * 60 * 60, 'token_type': 'Bearer'})
+
+  def do_GET(self):
+    parts = self.path.split('?')[0].strip('/').split('/')   # api/1/vehicles[/{id}/vehicle_data]
+    if len(parts) == 3:
+      # vehicle list probe - a recorded 408 means that car is asleep
+      self._count('vehicle_list')
+      vehicles = []
+      for vehicleId in self.server.vehicleIds:
+        asleep = (self.server.peekSample(vehicleId) or {}).get('status') == 408
+        if asleep:
+          self.server.nextSample(vehicleId)
+        vehicles.append({'id': vehicleId, 'state': 'asleep' if asleep else 'online'})
+      self._send(200, {'response': vehicles, 'count': len(vehicles)})
+      return
+
+    self._count('vehicle_data')
+    if self.server.delay:
+      # a stalled upstream - the service must keep its main loop running meanwhile
+      time.sleep(self.server.delay)
+    sample = self.server.nextSample(parts[3])
+    if sample is None:
+      self._send(503, {'error': 'recording exhausted'})
+    elif 'vehicle_data' in sample:
+      self._send(200, sample['vehicle_data'])
+    else:
+      self._send(sample.get('status', 500), sample.get('body', {}))
+
+  def _count(self, endpoint):
+    with self.server.lock:
+      self.server.requests[endpoint] = self.server.requests.get(endpoint, 0) + 1
+
+  def _send(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, samples, vehicleIds, delay=0):
+    super().__init__(('127.0.0.1', 0), StubTeslaAPI)
+    self.samples = samples
+    self.vehicleIds = vehicleIds
+    self.delay = delay              # seconds every vehicle_data answer is held back
+    self.served = dict((vehicleId, 0) for vehicleId in vehicleIds)
+    self.requests = {}
+    self.lock = threading.Lock()
+
+  def peekSample(self, vehicleId):
+    with self.lock:
+      served = self.served[vehicleId]
+      return self.samples[served] if served < len(self.samples) else None
+
+  def nextSample(self, vehicleId):
+    with self.lock:
+      served = self.served[vehicleId]
+      if served >= len(self.samples):
+        return None
+      self.served[vehicleId] = served + 1
+      return self.samples[served]
+
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def loadService():
+  vedbus = types.ModuleType('vedbus')
+  vedbus.VeDbusService = FakeVeDbusService
+  sys.modules['vedbus'] = vedbus
+  sys.path.insert(0, os.path.dirname(service_path))
+
+  spec = importlib.util.spec_from_file_location('dbusteslaapievcharger', service_path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def writeConfig(directory, port, args, vehicleIds):
+  path = os.path.join(directory, 'config.ini')
+  with open(path, 'w') as file:
+    file.write("[DEFAULT]\n")
+    file.write("SignOfLifeLog = 0\n")
+    if len(vehicleIds) == 1:
+      # the single-car layout - everything in [DEFAULT]
+      file.write("Deviceinstance = 99\n")
+      file.write("CustomName = REPLAY\n")
+      file.write("VehicleId = %s\n" % (vehicleIds[0]))
+    file.write("Phase = L1\n")
+    file.write("Position = 0\n")
+    file.write("RefreshToken = replay\n")
+    file.write("ApiBaseUrl = http://127.0.0.1:%d\n" % (port))
+    file.write("AuthBaseUrl = http://127.0.0.1:%d\n" % (port))
+    file.write("InverterPowerSource = inotify\n")
+    file.write("InverterPowerFile = %s\n" % (os.path.join(directory, 'Inverter.json')))
+    file.write("CommandSocket = %s\n" % (os.path.join(directory, 'tesla-command.sock')))
+    file.write("CacheDir = %s\n" % (directory))
+    file.write("RateLimitStateFile = %s\n" % (os.path.join(directory, 'ratelimit.json')))
+    file.write("HistoryFile = %s\n" % (os.path.join(directory, 'history.db')))
+    file.write("PollingPolicy = %s\n" % (args.policy))
+    file.write("DailyRequestBudget = %d\n" % (args.budget))
+    if args.delay:
+      # long enough to wait for the stalled answer
+      file.write("ReadTimeout = %d\n" % (args.delay + 10))
+    file.write("PowerEstimate = %d\n" % (1 if args.estimate else 0))
+    file.write("ProfileDir = %s\n" % (os.path.join(directory, 'profiles')))
+    file.write("ProfileMode = %s\n" % (args.profile or 'cprofile'))
+    if len(vehicleIds) > 1:
+      for index, vehicleId in enumerate(vehicleIds):
+        file.write("\n[VEHICLE%d]\n" % (index + 1))
+        file.write("Deviceinstance = %d\n" % (99 + index))
+        file.write("CustomName = REPLAY%d\n" % (index + 1))
+        file.write("VehicleId = %s\n" % (vehicleId))
+  return path
+
+
+def timed(latencies, function):
+  def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      latencies.append(time.perf_counter() - start)
+  return wrapper
+
+
+def usage():
+  # peak RSS (kB on Linux) and CPU time of this process
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_maxrss, usage.ru_utime + usage.ru_stime
+
+
+def compare(args):
+  # N cars in one process vs. N single-car processes running side by side
+  command = [sys.executable, os.path.realpath(__file__), args.recording, '--policy', args.policy, '--json']
+  shared = subprocess.run(command + ['--vehicles', str(args.compare)], stdout=subprocess.PIPE, check=True)
+  processes = [subprocess.Popen(command + ['--vehicles', '1'], stdout=subprocess.PIPE) for _ in range(args.compare)]
+  separate = [json.loads(process.communicate()[0]) for process in processes]
+  shared = json.loads(shared.stdout)
+
+  def requests(report, endpoint):
+    return report['api_requests'].get(endpoint, 0)
+
+  rows = [
+    ('peak RSS (MB)', shared['max_rss_kb'] / 1024.0, sum(report['max_rss_kb'] for report in separate) / 1024.0),
+    ('CPU seconds', shared['cpu_seconds'], sum(report['cpu_seconds'] for report in separate)),
+    ('threads', shared['threads'], sum(report['threads'] for report in separate)),
+    ('token requests', requests(shared, 'token'), sum(requests(report, 'token') for report in separate)),
+    ('vehicle list requests', requests(shared, 'vehicle_list'), sum(requests(report, 'vehicle_list') for report in separate)),
+    ('vehicle_data requests', requests(shared, 'vehicle_data'), sum(requests(report, 'vehicle_data') for report in separate)),
+  ]
+  print('%-24s %14s %14s' % ('', '1 process', '%d processes' % (args.compare)))
+  for name, one, many in rows:
+    print('%-24s %14.2f %14.2f' % (name, one, many))
+
+
+def parseArgs(argv=None):
+  parser = argparse.ArgumentParser(description='Replay recorded vehicle_data through DbusTeslaAPIService')
+  parser.add_argument('recording', nargs='?', default=os.path.join(script_dir, 'sample-vehicle-data.jsonl'))
+  parser.add_argument('--policy', default='heuristic', choices=['heuristic', 'backoff', 'budget'])
+  parser.add_argument('--budget', type=int, default=0, help='DailyRequestBudget for the budget policy')
+  parser.add_argument('--vehicles', type=int, default=1, help='number of cars managed by the one process')
+  parser.add_argument('--compare', type=int, default=0, help='compare N cars in one process against N processes')
+  parser.add_argument('--timeout', type=float, default=60, help='give up after this many seconds')
+  parser.add_argument('--json', action='store_true', help='print the report as JSON')
+  parser.add_argument('--metrics', action='store_true', help='also print what the metrics endpoint would serve')
+  parser.add_argument('--estimate', action='store_true', help='publish the charger power estimate (PowerEstimate=1)')
+  parser.add_argument('--profile', choices=['cprofile', 'sample'], help='profile the replay like /Profile/Duration does and print the top functions')
+  parser.add_argument('--delay', type=float, default=0, help='hold every vehicle_data answer back this many seconds')
+  return parser.parse_args(argv)
+
+
+def main():
+  args = parseArgs()
+
+  if args.compare:
+    compare(args)
+    return
+
+  logging.basicConfig(level=logging.WARNING)
+
+  with open(args.recording, 'r') as file:
+    samples = [json.loads(line) for line in file if line.strip()]
+
+  vehicleIds = ['replay-%d-%d' % (os.getpid(), index) for index in range(args.vehicles)]
+  server = ReplayServer(samples, vehicleIds, args.delay)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  # import + construction up to the last D-Bus path - no Tesla call may happen before that
+  startup = time.perf_counter()
+  module = loadService()
+  mainloop = GLib.MainLoop()
+  latencies = []
+  intervals = []
+  processed = dict((vehicleId, 0) for vehicleId in vehicleIds)
+
+  with tempfile.TemporaryDirectory() as directory:
+    configPath = writeConfig(directory, server.server_address[1], args, vehicleIds)
+    if len(vehicleIds) == 1:
+      services = [module.DbusTeslaAPIService(configPath=configPath)]
+      account = services[0]._account
+    else:
+      defaults = module.TeslaConfig(configPath, module.ACCOUNT_SETTINGS)
+      account = module.TeslaAccount(defaults, directory, None)
+      services = [module.DbusTeslaAPIService(configPath=configPath, account=account, section=section)
+                  for section in defaults.vehicleSections()]
+    startupSeconds = time.perf_counter() - startup
+    requestsAtStartup = sum(server.requests.values())
+    requestsImported = 'requests' in sys.modules
+
+    def replay(service, vehicleId):
+      processTeslaAPIData = service._onTeslaAPIData
+
+      def onTeslaAPIData(future):
+        processTeslaAPIData(future)
+        # the interval the policy picked after this sample - used to estimate real-world calls per day
+        intervals.append(service._wait_seconds)
+        processed[vehicleId] += 1
+        if all(count >= len(samples) for count in processed.values()):
+          mainloop.quit()
+          return False
+        if processed[vehicleId] >= len(samples):
+          return False
+        # time warp: feed the next inverter value (the first car drives the shared source) and poll right away
+        if vehicleId == vehicleIds[0]:
+          account.inverterPower._publish(Decimal(str(samples[processed[vehicleId]].get('inverter', 0))))
+        service._lastCheckData = datetime(2023, 12, 8)
+        service._schedulePoll()
+        return False
+
+      service._update = timed(latencies, service._update)
+      service._onInverterPowerChanged = timed(latencies, service._onInverterPowerChanged)
+      service._onTeslaAPIData = timed(latencies, onTeslaAPIData)
+
+    for service, vehicleId in zip(services, vehicleIds):
+      replay(service, vehicleId)
+
+    if samples:
+      account.inverterPower._publish(Decimal(str(samples[0].get('inverter', 0))))
+    GLib.timeout_add(int(args.timeout * 1000), mainloop.quit)
+    if args.profile:
+      account.startProfile(args.timeout)
+
+    started = time.perf_counter()
+    mainloop.run()
+    elapsed = time.perf_counter() - started
+    threads = threading.active_count()
+    account.executor.shutdown(wait=True)
+    metrics = account.metrics.registry.render()
+    profile = None
+    if args.profile:
+      path = account.stopProfile()
+      profile = {'file': os.path.basename(path), 'bytes': os.path.getsize(path)}
+      if path.endswith('.folded'):
+        with open(path, 'r') as file:
+          profile['top'] = [line.strip() for line in file][:10]
+      else:
+        with open(os.path.splitext(path)[0] + '.txt', 'r') as file:
+          profile['top'] = [line.rstrip() for line in file if line.strip()][:25]
+    # like SIGTERM - flushes the charge history
+    account.shutdown()
+    history = {'samples': account.history.rows, 'sessions': len(account.history.sessions(vehicleIds[0], 0, time.time() + 1))}
+
+  server.shutdown()
+
+  maxRss, cpuSeconds = usage()
+  dbus = services[0]._dbusserviceev
+  simulated = sum(intervals)
+  report = {
+    'vehicles': len(services),
+    'samples': len(samples),
+    'processed': sum(processed.values()),
+    'elapsed_seconds': round(elapsed, 3),
+    'startup_ms': round(startupSeconds * 1000, 1),
+    'api_requests_before_publish': requestsAtStartup,
+    'requests_imported_at_publish': requestsImported,
+    'ticks': len(latencies),
+    'tick_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+    'tick_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    'api_requests': server.requests,
+    'dbus_writes': sum(service._dbusserviceev.writes for service in services),
+    'dbus_changes': sum(service._dbusserviceev.changes for service in services),
+    'dbus_writes_per_tick': round(sum(service._dbusserviceev.writes for service in services) / float(len(latencies) or 1), 2),
+    'policy': args.policy,
+    'policy_intervals': intervals,
+    'estimated_requests_per_day': round(len(intervals) * 86400 / simulated, 1) if simulated else None,
+    'max_rss_kb': maxRss,
+    'cpu_seconds': round(cpuSeconds, 3),
+    'threads': threads,
+    'history': history,
+    'dbus_values': {path: value for path, value in sorted(dbus.values.items()) if not path.startswith('/Mgmt')},
+  }
+
+  if args.metrics:
+    report['metrics'] = metrics
+  if profile:
+    report['profile'] = profile
+
+  if args.json:
+    print(json.dumps(report, indent=2, default=str))
+    return
+
+  for key, value in report.items():
+    if key == 'dbus_values':
+      print('final D-Bus values (first car):')
+      for path, pathValue in value.items():
+        print('  %-22s %s' % (path, pathValue))
+    elif key == 'metrics':
+      print('metrics:')
+      sys.stdout.write(value)
+    elif key == 'profile':
+      print('profile %s (%d bytes):' % (value['file'], value['bytes']))
+      for line in value['top']:
+        print('  %s' % (line))
+    else:
+      print('%-28s %s' % (key, value))
+
+if __name__ == "__main__":
+  main()
@@ -3,5 +3,11 @@ SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
 rm $SCRIPT_DIR/tesla-api-token-refresh.py
 wget https://raw.githubusercontent.com/rsmith0906/dbus-teslaapi-evcharger/main/TokenRefresh/tesla-api-token-refresh.py
+# shared modules the token refresh imports from the parent directory
+for file in teslatoken.py teslalog.py teslaconfig.py teslaerrors.py
+do
+    rm $SCRIPT_DIR/../$file
+    wget -O $SCRIPT_DIR/../$file https://raw.githubusercontent.com/rsmith0906/dbus-teslaapi-evcharger/main/$file
+done
 rm $SCRIPT_DIR/current.log
 kill $(pgrep -f "python $SCRIPT_DIR/tesla-api-token-refresh.py")
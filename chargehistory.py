@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+# Charging history in SQLite (WAL).
+# Every processed vehicle_data / telemetry update is recorded as one compact row (integers: W, A, V, %, Wh) and
+# charging sessions are derived on the fly (start, end, energy, peak power, SoC). A gap of more than SESSION_GAP or a
+# drop of charge_energy_added (the car starts counting again) ends the session. Rows are buffered in memory and
+# written in one transaction every flushInterval seconds by a writer thread - the main loop never waits for the card.
+# 15-minute averages are kept up to date with every flush, so long ranges are served from a few thousand rows.
+# Retention keeps the database bounded: raw samples are dropped after downsampleDays, the 15-minute averages after
+# retentionDays. Freed pages are reused, so the file stops growing once both windows are full.
+#
+# Queries open their own (read-only) connection and can run on any thread:
+#   series(vehicle, start, end, step)   power/current/voltage/SoC/energy, optionally averaged per `step` seconds
+#                                       (a multiple of 15 minutes reads only the 15-minute table)
+#   sessions(vehicle, start, end)       charging sessions
+#   daily(vehicle, start, end)          energy and charging time per day
+#
+# python chargehistory.py history.db [vehicle] [days]   print the sessions and daily totals
+# python chargehistory.py --bench                        write a month of 30 second samples and time the queries
+import os
+import sys
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+
+BUCKET = 15 * 60   # seconds per downsampled row
+# a charging sample more than this after the last one starts a new session - twice the longest poll interval
+SESSION_GAP = 2 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vehicles (
+  id INTEGER PRIMARY KEY,
+  name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+  vehicle INTEGER NOT NULL,
+  ts INTEGER NOT NULL,
+  power INTEGER,
+  current INTEGER,
+  voltage INTEGER,
+  soc INTEGER,
+  energy INTEGER,
+  charging INTEGER,
+  PRIMARY KEY (vehicle, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS samples_15min (
+  vehicle INTEGER NOT NULL,
+  ts INTEGER NOT NULL,
+  power INTEGER,
+  current INTEGER,
+  voltage INTEGER,
+  soc INTEGER,
+  energy INTEGER,
+  charging INTEGER,
+  count INTEGER,
+  PRIMARY KEY (vehicle, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sessions (
+  vehicle INTEGER NOT NULL,
+  start INTEGER NOT NULL,
+  end INTEGER,
+  last INTEGER NOT NULL,
+  energy INTEGER NOT NULL,
+  peak_power INTEGER NOT NULL,
+  start_soc INTEGER,
+  end_soc INTEGER,
+  samples INTEGER NOT NULL,
+  PRIMARY KEY (vehicle, start)
+) WITHOUT ROWID;
+"""
+
+COLUMNS = ('ts', 'power', 'current', 'voltage', 'soc', 'energy', 'charging')
+SESSION_COLUMNS = ('start', 'end', 'last', 'energy', 'peak_power', 'start_soc', 'end_soc', 'samples')
+
+
+def _toInt(value, scale=1):
+  try:
+    return int(round(float(value) * scale)) if value is not None else None
+  except (TypeError, ValueError):
+    return None
+
+
+class ChargeHistory:
+  def __init__(self, path, flushInterval=60, downsampleDays=30, retentionDays=730, sessionGap=SESSION_GAP):
+    self.path = path
+    self.sessionGap = sessionGap
+    self.flushInterval = flushInterval
+    self.downsampleDays = downsampleDays
+    self.retentionDays = retentionDays
+    self.rows = 0               # samples written
+    self.flushes = 0
+    self._pending = []          # (vehicle name, row tuple)
+    self._pendingSessions = {}  # (vehicle name, start): session dict
+    self._open = {}             # vehicle name: open session dict
+    self._vehicleIds = {}
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._stopping = False
+    self._lastMaintenance = 0
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self._db = self._connect()
+    self._db.executescript(SCHEMA)
+    self._loadOpenSessions()
+    self._thread = threading.Thread(target=self._run, name='charge-history', daemon=True)
+    self._thread.start()
+
+  def _connect(self, readonly=False):
+    if readonly:
+      db = sqlite3.connect("file:%s?mode=ro" % (self.path), uri=True, check_same_thread=False)
+    else:
+      db = sqlite3.connect(self.path, check_same_thread=False)
+      db.execute('PRAGMA journal_mode=WAL')
+      # a power loss may lose the last transaction, never corrupt the file
+      db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+  # --- recording (main loop) ---
+
+  def record(self, vehicle, charge_state, ts=None):
+    # one vehicle_data / telemetry update - returns the open charging session (dict) or None
+    ts = int(ts or time.time())
+    charging = charge_state.get('charging_state') == 'Charging'
+    current = _toInt(charge_state.get('charger_actual_current'))
+    voltage = _toInt(charge_state.get('charger_voltage'))
+    phases = _toInt(charge_state.get('charger_phases')) or 1
+    power = current * voltage * phases if charging and current is not None and voltage is not None else 0
+    soc = _toInt(charge_state.get('battery_level'))
+    energy = _toInt(charge_state.get('charge_energy_added'), 1000)
+    row = (ts, power, current, voltage, soc, energy, 1 if charging else 0)
+
+    with self._lock:
+      self._pending.append((vehicle, row))
+      session = self._updateSession(vehicle, row)
+    return session
+
+  def openSession(self, vehicle):
+    return self._open.get(vehicle)
+
+  def _updateSession(self, vehicle, row):
+    ts, power, current, voltage, soc, energy, charging = row
+    session = self._open.get(vehicle)
+
+    if not charging:
+      if session is not None:
+        self._closeSession(vehicle, session)
+      return None
+
+    if session is not None and self._isNewSession(session, ts, energy):
+      # restarted or slept in between - the old session ended with its last sample, nothing is integrated over the gap
+      self._closeSession(vehicle, session)
+      session = None
+
+    if session is None:
+      session = {'start': ts, 'end': None, 'last': ts, 'energy': 0, 'peak_power': 0, 'start_soc': soc, 'end_soc': soc,
+                 'samples': 0, 'startEnergy': energy, 'integrated': 0.0}
+      self._open[vehicle] = session
+    else:
+      if session['startEnergy'] is None and energy is not None and energy >= session['energy']:
+        # continued after a restart without the first sample - line charge_energy_added up with the energy so far
+        session['startEnergy'] = energy - session['energy']
+      # trapezoid of the charger power - used when charge_energy_added is missing
+      session['integrated'] += (ts - session['last']) * (power + session.get('lastPower', power)) / 2.0 / 3600.0
+
+    session['last'] = ts
+    session['lastPower'] = power
+    session['samples'] += 1
+    session['peak_power'] = max(session['peak_power'], power)
+    session['end_soc'] = soc
+    if energy is not None and session['startEnergy'] is not None and energy >= session['startEnergy']:
+      session['energy'] = energy - session['startEnergy']
+    else:
+      session['energy'] = int(session['integrated'])
+    self._pendingSessions[(vehicle, session['start'])] = dict(session)
+    return session
+
+  def _closeSession(self, vehicle, session):
+    # ended with the last sample that still said Charging
+    session['end'] = session['last']
+    self._pendingSessions[(vehicle, session['start'])] = dict(session)
+    del self._open[vehicle]
+
+  def _isNewSession(self, session, ts, energy):
+    if ts - session['last'] > self.sessionGap:
+      return True
+    if energy is None:
+      return False
+    if session['startEnergy'] is None:
+      return energy < session['energy']
+    # charge_energy_added only grows within a session
+    return energy < session['startEnergy'] + session['energy']
+
+  # --- writer thread ---
+
+  def _run(self):
+    while not self._stopping:
+      self._wake.wait(self.flushInterval)
+      self._wake.clear()
+      try:
+        self._flush()
+        if time.time() - self._lastMaintenance >= 3600:
+          self._maintain()
+      except Exception as e:
+        logging.critical('Error at %s', 'ChargeHistory._flush', exc_info=e)
+
+  def flush(self):
+    # write the buffered rows now (from any thread)
+    self._wake.set()
+
+  def close(self):
+    self._stopping = True
+    self._wake.set()
+    self._thread.join(30)
+    self._flush()
+    self._db.close()
+
+  def _flush(self):
+    with self._lock:
+      pending, self._pending = self._pending, []
+      sessions, self._pendingSessions = self._pendingSessions, {}
+    if not pending and not sessions:
+      return
+
+    started = time.perf_counter()
+    with self._db:
+      rows = [(self._vehicleId(vehicle),) + row for vehicle, row in pending]
+      self._db.executemany('INSERT OR REPLACE INTO samples (vehicle, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)' % (', '.join(COLUMNS)), rows)
+      # re-average the 15-minute buckets these samples fall into
+      buckets = set((row[0], row[1] // BUCKET * BUCKET) for row in rows)
+      self._db.executemany("""
+        INSERT OR REPLACE INTO samples_15min (vehicle, ts, power, current, voltage, soc, energy, charging, count)
+        SELECT vehicle, ?, CAST(AVG(power) AS INTEGER), CAST(AVG(current) AS INTEGER), CAST(AVG(voltage) AS INTEGER),
+               MAX(soc), MAX(energy), MAX(charging), COUNT(*)
+        FROM samples WHERE vehicle = ? AND ts >= ? AND ts < ?""",
+        [(bucket, vehicleId, bucket, bucket + BUCKET) for vehicleId, bucket in buckets])
+      self._db.executemany('INSERT OR REPLACE INTO sessions (vehicle, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % (', '.join(SESSION_COLUMNS)),
+                           [(self._vehicleId(vehicle),) + tuple(session[name] for name in SESSION_COLUMNS)
+                            for (vehicle, start), session in sessions.items()])
+    self.rows += len(rows)
+    self.flushes += 1
+    logging.debug("Charge history: %d samples, %d sessions written in %.1fms" % (len(rows), len(sessions), (time.perf_counter() - started) * 1000))
+
+  def _maintain(self):
+    # raw samples past downsampleDays only live on in their 15-minute rows, drop what is past retention
+    self._lastMaintenance = time.time()
+    now = int(time.time())
+    downsampleBefore = (now - self.downsampleDays * 86400) // BUCKET * BUCKET
+    retainAfter = now - self.retentionDays * 86400
+    with self._db:
+      folded = self._db.execute('DELETE FROM samples WHERE ts < ?', (downsampleBefore,)).rowcount
+      dropped = self._db.execute('DELETE FROM samples_15min WHERE ts < ?', (retainAfter,)).rowcount
+      self._db.execute('DELETE FROM sessions WHERE last < ?', (retainAfter,))
+    if folded or dropped:
+      logging.info("Charge history: %d samples downsampled, %d 15-minute rows dropped" % (folded, dropped))
+
+  def _vehicleId(self, name):
+    vehicleId = self._vehicleIds.get(name)
+    if vehicleId is None:
+      self._db.execute('INSERT OR IGNORE INTO vehicles (name) VALUES (?)', (name,))
+      vehicleId = self._db.execute('SELECT id FROM vehicles WHERE name = ?', (name,)).fetchone()[0]
+      self._vehicleIds[name] = vehicleId
+    return vehicleId
+
+  def _loadOpenSessions(self):
+    # a session that was still charging when the service stopped - continued if the car still charges
+    rows = self._db.execute('''SELECT v.name, x.energy, %s FROM sessions s JOIN vehicles v ON v.id = s.vehicle
+                               LEFT JOIN samples x ON x.vehicle = s.vehicle AND x.ts = s.start WHERE s.end IS NULL''' % (
+      ', '.join('s.' + name for name in SESSION_COLUMNS))).fetchall()
+    now = time.time()
+    for row in rows:
+      session = dict(zip(SESSION_COLUMNS, row[2:]))
+      # charge_energy_added of the first sample - None if that sample was already dropped
+      session['startEnergy'] = row[1]
+      session['integrated'] = float(session['energy'])
+      self._open[row[0]] = session
+      if now - session['last'] > self.sessionGap:
+        # stopped for too long to still be the same charge
+        self._closeSession(row[0], session)
+
+  # --- queries (any thread) ---
+
+  def series(self, vehicle, start, end, step=None):
+    # [(ts, power W, current A, voltage V, soc %, energy Wh, charging)] - averaged per `step` seconds if given
+    with self._reader() as db:
+      vehicleId = self._lookupVehicle(db, vehicle)
+      if vehicleId is None:
+        return []
+      if step and step % BUCKET == 0:
+        # weighted by the samples behind each 15-minute row
+        return db.execute("""
+          SELECT ts / ? * ?, CAST(SUM(power * count) / SUM(count) AS INTEGER), CAST(SUM(current * count) / SUM(count) AS INTEGER),
+                 CAST(SUM(voltage * count) / SUM(count) AS INTEGER), MAX(soc), MAX(energy), MAX(charging)
+          FROM samples_15min WHERE vehicle = ? AND ts >= ? AND ts < ? GROUP BY ts / ? ORDER BY 1""",
+          (step, step, vehicleId, start, end, step)).fetchall()
+
+      # raw samples - older ranges fall back to the 15-minute rows
+      rawFrom = db.execute('SELECT MIN(ts) FROM samples WHERE vehicle = ?', (vehicleId,)).fetchone()[0]
+      rawFrom = max(start, rawFrom // BUCKET * BUCKET) if rawFrom is not None else end
+      rows = []
+      for table, rangeStart, rangeEnd in (('samples_15min', start, min(end, rawFrom)), ('samples', rawFrom, end)):
+        if rangeStart >= rangeEnd:
+          continue
+        if step:
+          rows.extend(db.execute("""
+            SELECT ts / ? * ?, CAST(AVG(power) AS INTEGER), CAST(AVG(current) AS INTEGER), CAST(AVG(voltage) AS INTEGER),
+                   MAX(soc), MAX(energy), MAX(charging)
+            FROM %s WHERE vehicle = ? AND ts >= ? AND ts < ? GROUP BY ts / ? ORDER BY 1""" % (table),
+            (step, step, vehicleId, rangeStart, rangeEnd, step)).fetchall())
+        else:
+          rows.extend(db.execute('SELECT %s FROM %s WHERE vehicle = ? AND ts >= ? AND ts < ? ORDER BY ts' % (', '.join(COLUMNS), table),
+                                 (vehicleId, rangeStart, rangeEnd)).fetchall())
+      return rows
+
+  def sessions(self, vehicle, start, end):
+    with self._reader() as db:
+      vehicleId = self._lookupVehicle(db, vehicle)
+      if vehicleId is None:
+        return []
+      rows = db.execute('SELECT %s FROM sessions WHERE vehicle = ? AND start >= ? AND start < ? ORDER BY start' % (
+        ', '.join(SESSION_COLUMNS)), (vehicleId, start, end)).fetchall()
+      return [dict(zip(SESSION_COLUMNS, row)) for row in rows]
+
+  def daily(self, vehicle, start, end):
+    # [(day 'YYYY-MM-DD' local time, energy Wh, charging seconds, sessions)]
+    with self._reader() as db:
+      vehicleId = self._lookupVehicle(db, vehicle)
+      if vehicleId is None:
+        return []
+      return db.execute("""
+        SELECT date(start, 'unixepoch', 'localtime'), SUM(energy), SUM(last - start), COUNT(*)
+        FROM sessions WHERE vehicle = ? AND start >= ? AND start < ? GROUP BY 1 ORDER BY 1""", (vehicleId, start, end)).fetchall()
+
+  def _reader(self):
+    return _Reader(self._connect(readonly=True))
+
+  def _lookupVehicle(self, db, vehicle):
+    row = db.execute('SELECT id FROM vehicles WHERE name = ?', (str(vehicle),)).fetchone()
+    return row[0] if row else None
+
+
+class _Reader:
+  def __init__(self, db):
+    self.db = db
+
+  def __enter__(self):
+    return self.db
+
+  def __exit__(self, *args):
+    self.db.close()
+    return False
+
+
+def createChargeHistory(config):
+  if not config.HistoryFile:
+    return None
+  return ChargeHistory(config.HistoryFile, config.HistoryFlushInterval, config.HistoryDownsampleDays, config.HistoryRetentionDays)
+
+
+def _bench():
+  # a month of 30 second samples for one car, charging 4 hours every day
+  directory = tempfile.mkdtemp()
+  path = os.path.join(directory, 'history.db')
+  history = ChargeHistory(path, flushInterval=3600, downsampleDays=3650)
+  end = int(time.time()) // 86400 * 86400
+  start = end - 30 * 86400
+
+  written = time.perf_counter()
+  for ts in range(start, end, 30):
+    charging = (ts % 86400) < 4 * 3600
+    charge_state = {'charging_state': 'Charging' if charging else 'Complete', 'charger_actual_current': 16 if charging else 0,
+                    'charger_voltage': 230, 'charger_phases': 1, 'battery_level': 50 + (ts % 86400) // 600,
+                    'charge_energy_added': ((ts % 86400) / 3600.0 * 3.68) if charging else 14.7}
+    history.record('bench', charge_state, ts)
+  history.close()
+  written = time.perf_counter() - written
+  samplesWritten = history.rows
+
+  history = ChargeHistory(path, flushInterval=3600)
+  for label, function in (('raw month', lambda: history.series('bench', start, end)),
+                          ('month per 15 min', lambda: history.series('bench', start, end, BUCKET)),
+                          ('month per hour', lambda: history.series('bench', start, end, 3600)),
+                          ('sessions', lambda: history.sessions('bench', start, end)),
+                          ('daily totals', lambda: history.daily('bench', start, end))):
+    queried = time.perf_counter()
+    rows = function()
+    print("%-18s %6d rows in %7.1f ms" % (label, len(rows), (time.perf_counter() - queried) * 1000))
+  history.close()
+  print("%-18s %6d rows in %7.1f ms, %.1f MB on disk" % ('write', samplesWritten, written * 1000, os.path.getsize(path) / 1e6))
+
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+    _bench()
+    return
+
+  path = sys.argv[1] if len(sys.argv) > 1 else '/data/tesla/history.db'
+  history = ChargeHistory(path)
+  days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+  end = int(time.time()) + 1
+  start = end - days * 86400
+  with history._reader() as db:
+    vehicles = [sys.argv[2]] if len(sys.argv) > 2 else [row[0] for row in db.execute('SELECT name FROM vehicles')]
+
+  for vehicle in vehicles:
+    print("%s - sessions of the last %d days:" % (vehicle, days))
+    for session in history.sessions(vehicle, start, end):
+      print("  %s  %5.1f h  %6.2f kWh  peak %5.0f W  SoC %s -> %s%s" % (
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(session['start'])), (session['last'] - session['start']) / 3600.0,
+        session['energy'] / 1000.0, session['peak_power'], session['start_soc'], session['end_soc'],
+        '' if session['end'] else '  (charging)'))
+    for day, energy, seconds, count in history.daily(vehicle, start, end):
+      print("  %s  %6.2f kWh  %5.1f h  %d session(s)" % (day, energy / 1000.0, seconds / 3600.0, count))
+  history.close()
+
+if __name__ == "__main__":
+  main()
@@ -14,42 +14,73 @@ import sys
 import time
 import json
 import subprocess
-import requests # for http GET
-import configparser # for config/ini file
+import signal
+import teslaenv
+import teslalog
+
+# fallback for getProcessAge() without /proc
+_imported = time.monotonic()
 
 script_dir = '/data/tesla'
 
-# Load configurations from config.json
-config_file_path = os.path.join(script_dir, 'config.json')
-with open(config_file_path, 'r') as config_file:
-    config = json.load(config_file)
+# loaded from config.json by setupEnvironment()
+config = {}
+# full path of tesla-control - resolved once and cached in config.json (see teslaenv.py)
+tesla_control = 'tesla-control'
+
+def setupEnvironment():
+  # only needed by the real service - importing the module (e.g. for the replay harness) has no side effects
+  global config, tesla_control
 
-authtoken_file_path = os.path.join(script_dir, 'authtoken.txt')
-token_file_path = os.path.join(script_dir, 'token.txt')
-token_expire_file_path = os.path.join(script_dir, 'tokenexpire.txt')
+  config = teslaenv.loadConfigJson(script_dir)
+  tesla_control = teslaenv.setupEnvironment(script_dir)
 
-# Setting environment variables
-os.environ['PATH'] += ':/usr/local/bin:/usr/bin:/bin:/data/usr/local/go/bin'
-os.environ['TESLA_VIN'] = config['VIN']
-os.environ['TESLA_KEY_NAME'] = 'Tessy'
-os.environ['TESLA_KEY_FILE'] = '/data/tesla/private.pem'
-os.environ['TESLA_TOKEN_FILE'] = '/data/tesla/token.txt'
+def getProcessAge():
+  # seconds since this process was started (interpreter start-up and imports included)
+  try:
+    with open('/proc/self/stat', 'r') as file:
+      # the command name may contain spaces - the fields after it are fixed
+      started = int(file.read().rsplit(')', 1)[1].split()[19]) / float(os.sysconf('SC_CLK_TCK'))
+    with open('/proc/uptime', 'r') as file:
+      return float(file.read().split()[0]) - started
+  except (OSError, ValueError, IndexError):
+    return time.monotonic() - _imported
 
-# Adding Go bin to PATH
-go_path_output = subprocess.check_output(['/data/usr/local/go/bin/go', 'env', 'GOPATH']).decode().strip()
-os.environ['PATH'] += f':{go_path_output}/bin'
+def getConfigPath():
+  return "%s/config.ini" % (os.path.dirname(os.path.realpath(__file__)))
+
+def getClientId():
+  # client id of the Fleet API application (config.json) - used for the tesla-control token
+  return config.get('CLIENT_ID')
 
 # our own packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
+from teslaconfig import TeslaConfig, ACCOUNT_SETTINGS
+from teslaaccount import TeslaAccount
+from dbuspublisher import DbusPublisher
+from vehiclecache import VehicleStateCache
+from surpluscontroller import createSurplusController
+from powerestimator import createPowerEstimator
+import teslaerrors
+import pollingpolicy
 from datetime import datetime
 from decimal import Decimal
 
+# seconds between two looks at the power estimate while the car charges
+ESTIMATE_INTERVAL = 15
+
 class DbusTeslaAPIService:
-  def __init__(self, productname='Tesla API', connection='Tesla API HTTP JSON service'):
-    config = self._getConfig()
-    deviceinstance = int(config['DEFAULT']['Deviceinstance'])
-    customname = config['DEFAULT']['CustomName']
+  def __init__(self, productname='Tesla API', connection='Tesla API HTTP JSON service', configPath=None, account=None,
+               section='DEFAULT', bus=None):
+    # account: the TeslaAccount shared with the other cars - section: this car's [VEHICLE...] section of config.ini
+    self._config = TeslaConfig(configPath or getConfigPath(), section=section)
+    config = self._config
+    if account is None:
+      account = TeslaAccount(config, script_dir, getClientId(), executable=tesla_control)
+    self._account = account
+    deviceinstance = config.Deviceinstance
+    customname = config.CustomName
 
     #formatting
     _kwh = lambda p, v: (str(round(v, 2)) + 'kWh')
@@ -60,25 +91,61 @@ class DbusTeslaAPIService:
     _w = lambda p, v: (str(round(v, 1)) + 'W')
     _v = lambda p, v: (str(round(v, 1)) + 'V')
 
-    self._dbusserviceev = VeDbusService("{}.http_{:02d}".format('com.victronenergy.evcharger', deviceinstance))
+    # several cars in one process need their own (private) bus connection each
+    servicename = "{}.http_{:02d}".format('com.victronenergy.evcharger', deviceinstance)
+    self._dbusserviceev = VeDbusService(servicename, bus) if bus is not None else VeDbusService(servicename)
 
     logging.debug("%s /DeviceInstance = %d" % ('com.victronenergy.evcharger', deviceinstance))
 
+    # all value updates go through the publisher - only changed paths are written, once per update
+    self._dbus = DbusPublisher(self._dbusserviceev)
+
     self._runningSeconds = 0
     self._startDate = datetime.now()
     self._lastCheck = datetime(2023, 12, 8)
     self._lastCheckData = datetime(2023, 12, 8)
     self._running = False
     self._firstRun = False
-    self._carData = {}
-    self._token = None
-    self._request_timeout_string = "Request Timeout"
-    self._too_many_requests = "Too Many Requests"
+    # last vehicle_data snapshot - served from RAM, persisted under CacheDir so cold starts have VIN/firmware
+    self._vehicleState = VehicleStateCache(os.path.join(config.CacheDir, "%s.json" % (config.VehicleId)), config.CachePersistInterval)
+    self._carData = self._vehicleState.data or {}
     self._wait_seconds = 30
+    # failures per error class - published under /Errors and in the sign of life, the run of the last class drives the backoff
+    self._errors = teslaerrors.ErrorCounters()
+    self._policy = pollingpolicy.createPollingPolicy(config)
     self._lastMessage = ""
     self._lastUpdate = 0
     self._cacheInverterPower = Decimal(0.0)
     self._cacheChargingPower = -1
+    self._fetchInFlight = False
+    self._lastPayload = None
+    # vehicle summary probes (they never wake the car) gate the vehicle_data fetches
+    self._lastOnline = None
+    self._vehicleOnlineState = None
+    self._probes = 0
+    self._fetches = 0
+    self._wakeupsAvoided = 0
+    # shared with the other cars of the account (see teslaaccount.py)
+    self._executor = account.executor
+    self._rateLimiter = account.rateLimiter
+    self._session = account.session
+    self._ownerTokens = account.ownerTokens
+    self._controlTokens = account.controlTokens
+    self._commands = account.commands
+    self._commandExecutor = account.commandExecutor
+    self._inverterPower = account.inverterPower
+    self._telemetry = account.telemetry
+    self._metrics = account.metrics
+    self._history = account.history
+    self._startStopTarget = None
+    self._startStopRunning = False
+    # (value, time.time()) of the last charging-start/-stop that went out - newer than the snapshot until the next poll
+    self._startStopSent = None
+    # follows the solar surplus with charging-set-amps while the car charges (SurplusControl=1)
+    self._surplus = createSurplusController(config)
+    self._surplusCommandRunning = False
+    # keeps /Ac/Power current between polls and asks for an early poll when it diverges (PowerEstimate=1)
+    self._estimator = createPowerEstimator(config)
 
     self.add_standard_paths(self._dbusserviceev, productname, customname, connection, deviceinstance, config, {
           '/Mode': {'initial': 0, 'textformat': _mode},
@@ -92,12 +159,55 @@ class DbusTeslaAPIService:
           '/Ac/Energy/Forward': {'initial': 0, 'textformat': _kwh},
           '/StartStop': {'initial': 0, 'textformat': _startStop},
         })
-
-    # add _update function 'timer'
-    gobject.timeout_add(500, self._update) # pause 250ms before the next request
-
-    # add _signOfLife 'timer' to get feedback in log every 5minutes
-    gobject.timeout_add(self._getSignOfLifeInterval()*60*1000, self._signOfLife)
+    # progress of the last /StartStop request: idle, pending, waking, sending, done or failed
+    self._dbusserviceev.add_path('/StartStopStatus', 'idle')
+    # failures per error class since start (/Errors/Auth, /Errors/RateLimited, ...)
+    for kind in teslaerrors.KINDS:
+      self._dbusserviceev.add_path(self._getErrorPath(kind), 0)
+    # request budget left and until when no call is allowed (epoch seconds, 0 = not blocked)
+    self._dbusserviceev.add_path('/RateLimit/RemainingHour', None)
+    self._dbusserviceev.add_path('/RateLimit/RemainingDay', None)
+    self._dbusserviceev.add_path('/RateLimit/BlockedUntil', 0)
+    self._dbusserviceev.add_path('/RateLimit/Denied', 0)
+    # state from the last vehicle summary probe (online, asleep, offline) and probes vs. full fetches
+    self._dbusserviceev.add_path('/Probe/State', None)
+    self._dbusserviceev.add_path('/Probe/Probes', 0)
+    self._dbusserviceev.add_path('/Probe/Fetches', 0)
+    self._dbusserviceev.add_path('/Probe/WakeupsAvoided', 0)
+    # confidence of the published charger power (%), error of the estimate at the last poll (W), early polls
+    self._dbusserviceev.add_path('/Estimate/Confidence', None)
+    self._dbusserviceev.add_path('/Estimate/Error', None)
+    self._dbusserviceev.add_path('/Estimate/EarlyPolls', 0)
+    # write seconds to profile the main loop (0 stops), see profiler.py - the last file written
+    self._dbusserviceev.add_path('/Profile/Duration', 0, writeable=True, onchangecallback=self._handlechangedvalue)
+    self._dbusserviceev.add_path('/Profile/Running', 0)
+    self._dbusserviceev.add_path('/Profile/LastFile', None)
+
+    # this car's deadlines (API poll, sign of life, ...) on the account's single GLib timeout
+    self._scheduler = account.scheduler.scoped("vehicle-%s" % (config.VehicleId), self._onDeadline)
+
+    # inverter power changes and telemetry records are passed on by the account
+    account.addVehicle(self)
+
+    # first _update right away, it schedules the following ones
+    self._scheduler.schedule('poll', 0)
+
+    # _signOfLife to get feedback in log every SignOfLifeLog minutes
+    self._scheduleSignOfLife()
+
+    # all paths are on D-Bus now - nothing has been sent to Tesla yet, the first poll runs from the main loop
+    self.startupSeconds = getProcessAge()
+    logging.info("D-Bus paths of %s published %.0f ms after process start" % (servicename, self.startupSeconds * 1000))
+
+    # read when the metrics are scraped
+    vehicle = config.VehicleId
+    self._metrics.startupSeconds.set(self.startupSeconds, vehicle=vehicle)
+    self._metrics.dbusWrites.bind(lambda: self._dbus.writes, vehicle=vehicle)
+    self._metrics.dbusSkipped.bind(lambda: self._dbus.skipped, vehicle=vehicle)
+    self._metrics.waitSeconds.bind(lambda: self._wait_seconds, vehicle=vehicle)
+    self._metrics.dataAge.bind(lambda: self._vehicleState.age, vehicle=vehicle)
+    self._metrics.estimateConfidence.bind(lambda: self._estimator.confidence() if self._estimator else None, vehicle=vehicle)
+    self._metrics.earlyPolls.bind(lambda: self._estimator.earlyPolls if self._estimator else 0, vehicle=vehicle)
 
   def add_standard_paths(self, dbusservice, productname, customname, connection, deviceinstance, config, paths):
       # Create the management objects, as specified in the ccgx dbus-api document
@@ -114,7 +224,7 @@ class DbusTeslaAPIService:
       dbusservice.add_path('/Latency', None)
       dbusservice.add_path('/FirmwareVersion', self._getTeslaAPIVersion())
       dbusservice.add_path('/HardwareVersion', 0)
-      dbusservice.add_path('/Position', int(config['DEFAULT']['Position']))
+      dbusservice.add_path('/Position', config.Position)
       dbusservice.add_path('/Serial', self._getTeslaAPISerial())
       dbusservice.add_path('/UpdateIndex', 0)
 
@@ -123,31 +233,70 @@ class DbusTeslaAPIService:
         dbusservice.add_path(
           path, settings['initial'], gettextcallback=settings['textformat'], writeable=True, onchangecallback=self._handlechangedvalue)
 
-  def _getConfig(self):
-    config = configparser.ConfigParser()
-    config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
-    return config;
+  def _handleSighup(self):
+    # called by the account on SIGHUP
+    self._config.invalidate()
+    self._config.refresh()
+    if self._errors.run:
+      # e.g. a new RefreshToken after auth failures - retry now instead of after the backoff
+      self._errors.resetRun()
+      self._wait_seconds = min(self._wait_seconds, 30)
+    self._surplus = createSurplusController(self._config)
+    self._estimator = createPowerEstimator(self._config)
+    self._scheduleSignOfLife()
+    self._schedulePoll()
+
+  def _onDeadline(self, due):
+    if 'signoflife' in due:
+      self._signOfLife()
+      self._scheduleSignOfLife()
+    if 'persist' in due:
+      self._vehicleState.flush()
+    if 'startstop' in due:
+      self._runStartStop()
+    if 'estimate' in due:
+      self._checkEstimate()
+    if 'poll' in due:
+      self._update()
+
+  def _schedulePoll(self):
+    # nothing to do while a fetch is in flight - _onTeslaAPIData reschedules
+    if self._fetchInFlight:
+      self._scheduler.cancel('poll')
+      return
+    elapsed = (datetime.now() - self._lastCheckData).total_seconds()
+    remaining = self._wait_seconds - elapsed
+    if self._telemetry and self._telemetry.isLive(self._getTelemetryVin()):
+      # fall back to polling only once the stream has been quiet for TelemetryTimeout
+      remaining = max(remaining, self._telemetry.staleIn(self._getTelemetryVin()))
+    # no point waking up before the request budget allows another call
+    remaining = max(remaining, self._rateLimiter.delay())
+    self._scheduler.schedule('poll', remaining)
+
+  def _schedulePersist(self):
+    # throttled write of the vehicle state cache - update() already wrote it if the interval had passed
+    due = self._vehicleState.persistDue()
+    if due is not None and self._scheduler.remaining('persist') is None:
+      self._scheduler.schedule('persist', due)
+
+  def shutdown(self):
+    # called by the account - it flushes the shared state itself
+    self._vehicleState.flush()
+
+  def _scheduleSignOfLife(self):
+    interval = self._getSignOfLifeInterval()
+    if interval > 0:
+      self._scheduler.schedule('signoflife', interval * 60)
+    else:
+      self._scheduler.cancel('signoflife')
 
   def _getSignOfLifeInterval(self):
-    config = self._getConfig()
-    value = config['DEFAULT']['SignOfLifeLog']
-
-    if not value:
-        value = 0
-
-    return int(value)
+    return self._config.SignOfLifeLog
 
   def _getTeslaAPISerial(self):
-      config = self._getConfig()
-      car_id = config['DEFAULT']['VehicleId']
-      self._carData = self.read_data(car_id)
-      vin = 0
-
-      if (self._carData):
-        vin = self._carData['response']['vin']
+      vin = self._vehicleState.get('vin', default=0)
 
       if self.is_not_blank(vin):
-         logging.info(f"return cached vin {vin}")
          return vin
         
       if not vin:
@@ -155,16 +304,9 @@ class DbusTeslaAPIService:
       return str(vin)
       
   def _getTeslaAPIVersion(self):
-      config = self._getConfig()
-      car_id = config['DEFAULT']['VehicleId']
-      self._carData = self.read_data(car_id)
-      version = 0
-
-      if self._carData:
-        version = self._carData['response']['vehicle_state']['car_version']
+      version = self._vehicleState.get('vehicle_state', 'car_version', default=0)
 
       if self.is_not_blank(version):
-         logging.info(f"return cached version {version}")
          return version
 
       if not version:
@@ -173,88 +315,172 @@ class DbusTeslaAPIService:
       return str(version)
 
   def _getTeslaAPIStatusUrl(self):
-    config = self._getConfig()
-    URL = "https://owner-api.teslamotors.com/api/1/vehicles/%s/vehicle_data" % (config['DEFAULT']['VehicleId'])
-    return URL
-
-  def _getTeslaAPIData(self):
-    config = self._getConfig()
-    car_id = config['DEFAULT']['VehicleId']
-    URL = self._getTeslaAPIStatusUrl()
+    URL = "%s/api/1/vehicles/%s/vehicle_data" % (self._config.ApiBaseUrl, self._config.VehicleId)
 
-    if not self._token:
-       self._token = self._getAccessToken()
-
-    if not self._token:
-        raise ValueError("Could not retrieve Tesla Token")
+    # only ask for the sections _processCarData uses - the full document is needed until VIN and firmware are known
+    endpoints = self._config.VehicleDataEndpoints
+    if endpoints and self._getTeslaAPISerial() != '0' and self._getTeslaAPIVersion() != '0':
+      URL = "%s?endpoints=%s" % (URL, endpoints.replace(';', '%3B'))
+    return URL
 
-    token = self._token
+  def _requestTeslaAPIData(self):
+    # only one fetch in flight - the result is handed back to the main loop in _onTeslaAPIData
+    if self._fetchInFlight:
+       return False
 
-    headers = {
-        'Authorization': f'Bearer {token}'
-    }
+    # the telemetry stream is delivering fresher data than a poll would
+    if self._telemetry and self._telemetry.isLive(self._getTelemetryVin()):
+       return False
 
     checkDiff = datetime.now() - self._lastCheckData
     checkSecs = checkDiff.total_seconds()
 
-    if checkSecs > self._wait_seconds:
+    delay = self._rateLimiter.delay()
+    if delay > 0:
+       self._showInfoMessage('Request budget used up - waiting for the rate limiter')
+       return False
+
+    if checkSecs >= self._wait_seconds:
        self._lastCheckData = datetime.now()
        logging.info(f"Last Get Tesla Data: {self._lastCheckData} - Wait in Seconds: {self._wait_seconds}")
 
-       response = requests.get(url = URL, headers=headers)
-       response.raise_for_status()
-
-       # check for response
-       if not response:
-          raise ConnectionError("No response from TeslaAPI - %s" % (URL))
-       self._carData = response.json()
-       
-       # check for Json
-       if not self._carData:
-          raise ValueError("Converting response to JSON failed")
-       
-       self.save_data(car_id, json.dumps(self._carData))
-       return self._carData
+       self._fetchInFlight = True
+       self._policy.recordRequest()
+       future = self._executor.submit(self._fetchTeslaAPIData, self._getTeslaAPIStatusUrl())
+       future.add_done_callback(lambda f: gobject.idle_add(self._onTeslaAPIData, f))
+       return True
     else:
-       return None
-
-  def _getAccessToken(self):
-    config = self._getConfig()
-    refreshToken = config['DEFAULT']['RefreshToken']
-
-    self._showInfoMessage('Get Access Token')
+       return False
 
-    URL = 'https://auth.tesla.com/oauth2/v3/token'
+  def _fetchTeslaAPIData(self, URL):
+    # runs on the worker thread - must not touch D-Bus
+    token = self._getAccessToken()
 
-    body = {
-      'grant_type': 'refresh_token',
-      'client_id': 'ownerapi',
-      'refresh_token': refreshToken,
-      'scope': 'openid email offline_access'
+    headers = {
+        'Authorization': f'Bearer {token}'
     }
 
-    json_data = json.dumps(body)
-    response = requests.post(url = URL, data=json_data, headers={'Content-Type': 'application/json'})
+    if self._needsProbe():
+       state = self._probeVehicleState(headers)
+       if state != 'online':
+          # vehicle_data would only answer 408 and keep the car from sleeping
+          self._wakeupsAvoided += 1
+          raise teslaerrors.VehicleAsleepError("Car is %s - vehicle_data not requested" % (state))
+
+    self._fetches += 1
+    response = self._session.get(URL, headers=headers, timeout=(self._config.ConnectTimeout, self._config.ReadTimeout))
+    # per-poll details at DEBUG - INFO is kept for state changes
+    logging.debug(str(self._session.lastTiming()))
+    teslaerrors.raiseForStatus(response)
 
     # check for response
     if not response:
-        raise ConnectionError("No response from Tesla API - %s" % (URL))
-
-    response = response.json()
+       raise ConnectionError("No response from TeslaAPI - %s" % (URL))
+
+    parseStart = time.perf_counter()
+    carData = json.loads(response.content)
+    payload = {
+      'wire': self._getWireBytes(response),
+      'bytes': len(response.content),
+      'parse': time.perf_counter() - parseStart,
+    }
+    logging.debug("vehicle_data payload: %d bytes on the wire, %d bytes JSON, parsed in %.1fms" % (payload['wire'], payload['bytes'], payload['parse'] * 1000))
 
     # check for Json
-    if not response:
-        raise ValueError("Converting response to JSON failed")
+    if not carData or 'response' not in carData:
+       raise teslaerrors.DataError("Unexpected vehicle_data response: %s" % (response.text[:200]))
+
+    return carData, payload
+
+  def _needsProbe(self):
+    # no probe while the car was seen online moments ago (e.g. charging at 30 second intervals)
+    return self._lastOnline is None or time.monotonic() - self._lastOnline > self._config.ProbeSkipWindow
+
+  def _probeVehicleState(self, headers):
+    # runs on a worker thread - the vehicle list (shared by all cars of the account) does not wake the car
+    self._probes += 1
+    state = self._account.vehicleState(self._config.VehicleId, headers)
+    self._vehicleOnlineState = state
+    if state == 'online':
+      self._lastOnline = time.monotonic()
+    return state
+
+  def _getWireBytes(self, response):
+    # compressed size as read from the socket - falls back to the decoded size
+    try:
+      return response.raw.tell() or len(response.content)
+    except Exception:
+      return len(response.content)
+
+  def _onTeslaAPIData(self, future):
+    self._fetchInFlight = False
+    started = time.perf_counter()
+    try:
+       carData, self._lastPayload = future.result()
+       self._lastOnline = time.monotonic()
+       self._vehicleOnlineState = 'online'
+       self._carData = self._mergeCarData(carData)
+       self._errors.resetRun()
+       self._account.scheduleTokenRefresh()
+       self._vehicleState.update(self._carData)
+       self._schedulePersist()
+       # the publisher only writes these when they changed (e.g. the first fetch after a cold start)
+       self._dbus['/Serial'] = self._getTeslaAPISerial()
+       self._dbus['/FirmwareVersion'] = self._getTeslaAPIVersion()
+       self._processCarData()
+    except Exception as e:
+       self._handleUpdateError(e)
+
+    self._signalChanges()
+    self._schedulePoll()
+    self._metrics.processSeconds.observe(time.perf_counter() - started, vehicle=self._config.VehicleId)
+
+    # one-shot idle callback
+    return False
+
+  def _onTelemetry(self, changes):
+    # streamed fields are applied on top of the last full snapshot and published right away
+    previous = self._vehicleState.get()
+    if not previous:
+      self._showInfoMessage('Telemetry received - waiting for a first vehicle_data poll')
+      return
 
-    accessToken = response["access_token"]
-    refreshToken = response["refresh_token"]
-    expiresIn = response["expires_in"]
-    tokenType = response["token_type"]
-    
-    return accessToken
+    started = time.perf_counter()
+    merged = dict(previous)
+    for section, fields in changes.items():
+      merged[section] = dict(previous.get(section) or {}, **fields)
+    self._carData = {'response': merged}
+
+    try:
+       self._vehicleState.update(self._carData)
+       self._schedulePersist()
+       self._processCarData()
+    except Exception as e:
+       self._handleUpdateError(e)
+
+    self._signalChanges()
+    self._schedulePoll()
+    self._metrics.processSeconds.observe(time.perf_counter() - started, vehicle=self._config.VehicleId)
+
+  def _mergeCarData(self, carData):
+    # a selective response only has the requested sections - keep the others (vehicle_state, ...) from the snapshot
+    previous = self._vehicleState.get()
+    if not previous or 'response' not in carData:
+      return carData
+    merged = dict(previous)
+    merged.update(carData['response'])
+    return dict(carData, response=merged)
+
+  def _getAccessToken(self):
+    # in memory - only hits the token endpoint when the token is missing or about to expire
+    if self._ownerTokens.expiresIn() <= self._ownerTokens.margin:
+      self._showInfoMessage('Get Access Token')
+    return self._ownerTokens.getToken()
 
   def _signOfLife(self):
-    logging.info("Start: sign of life - Last _update() call: %s" % (self._lastUpdate))
+    logging.info("Start: sign of life - Last _update() call: %s - wakeups in the last hour: %d - D-Bus writes: %d, skipped: %d, signals: %d - errors: %s - probes: %d, fetches: %d, wake-ups avoided: %d" % (
+      self._lastUpdate, self._scheduler.wakeupsPerHour(), self._dbus.writes, self._dbus.skipped, self._dbus.signals, self._errors,
+      self._probes, self._fetches, self._wakeupsAvoided))
     return True
 
   def _setcurrent(self, path, value):
@@ -266,58 +492,102 @@ class DbusTeslaAPIService:
       return False
     return True
 
-  def _startstop(self, path, value):
+  def _requestStartStop(self, value):
+    # called on the main loop for every /StartStop write - only the last value within StartStopDebounce is sent
+    self._startStopTarget = value
+    self._publishStartStopStatus('pending')
+    if not self._startStopRunning:
+      self._scheduler.schedule('startstop', self._config.StartStopDebounce)
+
+  def _runStartStop(self):
+    value = self._startStopTarget
+    self._startStopRunning = True
+
+    charge_state = self._vehicleState.get('charge_state', 'charging_state')
+    sent = self._startStopSent
+    if sent is not None and (self._vehicleState.fetched or 0) < sent[1]:
+      # the snapshot predates the last command (e.g. toggled again while it ran) - the car is where it was sent
+      charge_state = 'Charging' if sent[0] == 1 else 'Stopped'
+
+    future = self._commandExecutor.submit(self._startstop, value, charge_state)
+    future.add_done_callback(lambda f: gobject.idle_add(self._onStartStopDone, value, f))
+
+  def _onStartStopDone(self, value, future):
+    self._startStopRunning = False
+    try:
+      future.result()
+      self._publishStartStopStatus('done')
+    except Exception as e:
+      logging.critical('Error at %s', '_startstop', exc_info=e)
+      self._publishStartStopStatus('failed')
+
+    if self._startStopTarget != value:
+      # toggled again while the command ran - send the latest state now
+      self._runStartStop()
+    else:
+      # poll soon to pick up the new charging state
+      self._wait_seconds = min(self._wait_seconds, 30)
+      self._schedulePoll()
+
+    # one-shot idle callback
+    return False
+
+  def _publishStartStopStatus(self, status):
+    # may be called from the command thread - D-Bus is only touched on the main loop
+    def _publish():
+      self._dbus['/StartStopStatus'] = status
+      self._signalChanges()
+      return False
+    gobject.idle_add(_publish)
+
+  def _startstop(self, value, charge_state):
+      # runs on the command thread
       attempt = 0
       max_attempts = 2
       success = False
 
-      logging.info("StartIt")
+      logging.info("StartStop %s - car is %s" % (value, charge_state))
 
       while attempt < max_attempts:
           try:
-              logging.info("LoopIt")
-
-              config = self._getConfig()
-              car_id = config['DEFAULT']['VehicleId']
-
-              self._carData = self.read_data(car_id)
-              if self._carData:
-                 charge_state = self._carData['response']['charge_state']['charging_state']
-                 logging.info(charge_state)
-
+              if charge_state:
                  makeChange = True
                  if charge_state == 'Charging' and value == 1:
                   makeChange = False
-                  
+
                  if charge_state != 'Charging' and value == 0:
                   makeChange = False
 
                  if makeChange:
-                   if self.get_token_is_expired():
-                      self.get_new_token()
+                   # refreshes token.txt first if it is about to expire
+                   self._controlTokens.getToken()
 
-                   # Replace subprocess.call with subprocess.check_call to ensure an error is raised if the command fails
-                   result = subprocess.run(['tesla-control', 'wake'], check=True, stderr=subprocess.PIPE)
-                   time.sleep(10)
+                   # raises subprocess.CalledProcessError if the command fails
+                   self._publishStartStopStatus('waking')
+                   vin = self._getCommandVin()
+                   result = self._commands.run('wake', vin=vin)
+                   self._waitUntilOnline()
 
+                   self._publishStartStopStatus('sending')
                    if value == 1:
-                     result = subprocess.run(['tesla-control', 'charging-start'], check=True, stderr=subprocess.PIPE)
+                     result = self._commands.run('charging-start', vin=vin)
                    else:
-                     result = subprocess.run(['tesla-control', 'charging-stop'], check=True, stderr=subprocess.PIPE)
+                     result = self._commands.run('charging-stop', vin=vin)
+                   self._startStopSent = (value, time.time())
 
               success = True
               break
           except subprocess.CalledProcessError as e:
               # Check if the error output contains 'token'
-              logging.critical('Error at %s', 'main', exc_info=e)
-              
+              logging.critical('Error at %s', '_startstop', exc_info=e)
+
               success = False
 
               error_output = e.stderr.decode('utf-8')
-              
+
               if 'token' in error_output.lower():
-                  print("Token error detected, attempting to refresh token.")
-                  self.get_new_token()
+                  logging.info("Token error detected, attempting to refresh token.")
+                  self._controlTokens.refresh()
                   attempt += 1
                   if attempt >= max_attempts:
                       raise RuntimeError(f"Failed to resolve token issue after multiple attempts: {error_output}") from e
@@ -327,148 +597,305 @@ class DbusTeslaAPIService:
 
       return success
 
+  def _waitUntilOnline(self):
+    # poll the vehicle summary (it does not wake the car) instead of sleeping a fixed 10 seconds - 2, 4, 8, ... seconds
+    # apart, so a 60 second WakeTimeout costs at most 5 list calls (all taken from the request budget)
+    deadline = time.monotonic() + self._config.WakeTimeout
+    wait = 2
+    while time.monotonic() < deadline:
+      time.sleep(max(0, min(wait, deadline - time.monotonic())))
+      wait *= 2
+      if self._rateLimiter.delay() > 0:
+        logging.warning("Request budget used up - not checking if the car is online")
+        return False
+      try:
+        # the cached vehicle list would still say asleep
+        self._account.invalidateVehicleList()
+        if self._probeVehicleState({'Authorization': f'Bearer {self._getAccessToken()}'}) == 'online':
+          return True
+      except teslaerrors.RateLimitedError as e:
+        logging.warning("Could not check if the car is online: %s" % (e))
+        return False
+      except Exception as e:
+        logging.warning("Could not check if the car is online: %s" % (e))
+    logging.warning("Car not online after %d seconds - sending the command anyway" % (self._config.WakeTimeout))
+    return False
+
   def _update(self):
+    started = time.perf_counter()
     try:
-       config = self._getConfig()
-       str(config['DEFAULT']['Phase'])
-
-       charging = False
-
-       if self.is_time_between_midnight_and_8am() and not self._dbusserviceev['/Ac/Power'] > 0:
-          self._wait_seconds = 60 * 10
-
-       inverterPower = self.getInverterPower()
+       # cheap stat() - config.ini is only re-parsed when it changed
+       self._config.refresh()
 
        if not self._firstRun:
-          self._dbusserviceev['/Mode'] = 0
-          self._dbusserviceev['/Connected'] = 1
+          self._dbus['/Mode'] = 0
+          self._dbus['/Connected'] = 1
           self._firstRun = True
 
-       if inverterPower > 500:
-          self._wait_seconds = 30
+       self._applyPollingPolicy(pollingpolicy.TICK)
 
+       #get data from TeslaAPI Plug - the response is processed in _onTeslaAPIData
+       self._requestTeslaAPIData()
+    except Exception as e:
+      self._handleUpdateError(e)
+
+    self._lastUpdate = time.time()
+    self._signalChanges()
+    self._schedulePoll()
+    self._metrics.updateSeconds.observe(time.perf_counter() - started, vehicle=self._config.VehicleId)
+
+  def _onInverterPowerChanged(self, inverterPower):
+    try:
        if abs(self._cacheInverterPower - inverterPower) >= 1.0:
           self._showInfoMessage(f"Inverter Power Level Changed: {inverterPower}")
-          self._wait_seconds = 30
-          if abs(self._cacheInverterPower - inverterPower) >= 400.0:
+          self._applyPollingPolicy(pollingpolicy.INVERTER, inverterPowerDelta=inverterPower - self._cacheInverterPower)
+          # while the car charges the power estimate decides if a swing needs a poll - but only if it sees the load
+          # (PowerEstimateLoad=1), otherwise nothing else would notice a real change of the charger power
+          estimating = self._estimator is not None and self._estimator.charging and self._estimator.loadFollows
+          if abs(self._cacheInverterPower - inverterPower) >= 400.0 and not estimating:
+             # big swing - poll the car right away instead of on the next tick
              self._lastCheckData = datetime(2023, 12, 8)
+             self._requestTeslaAPIData()
           self._cacheInverterPower = inverterPower
-
-       #get data from TeslaAPI Plug
-       self._carData = self._getTeslaAPIData()
-       if self._carData:
-          inverter_phase = str(config['DEFAULT']['Phase'])
-
-          charging_state = self._carData['response']['charge_state']['charging_state']
-          if charging_state == "NoPower":
-             raise ValueError("NoPower")
-
-          self._showInfoMessage('Car Awake')
-
-          #send data to DBus
-          for phase in ['L1']:
-            pre = '/Ac/' + phase
-
-            if phase == inverter_phase:
-              current = self._carData['response']['charge_state']['charger_actual_current']
-              voltage = self._carData['response']['charge_state']['charger_voltage']
-              charger_power = self._carData['response']['charge_state']['charger_power']
-              charge_state = self._carData['response']['charge_state']['charging_state']
-              charge_port_latch = self._carData['response']['charge_state']['charge_port_latch']
-              charge_energy_added = self._carData['response']['charge_state']['charge_energy_added']
-              max_current = self._carData['response']['charge_state']['charge_current_request_max']
-              battery_state = self._carData['response']['charge_state']['battery_level']
-
-              if max_current <= 12:
-                if int(charge_energy_added) == 0:
-                  self._startDate = datetime.now()
-                  self.resetSavedChargeStart()
-                
-                #self._dbusserviceev['/Ac/Energy/Forward'] = charge_energy_added
-                self._dbusserviceev['/MaxCurrent'] = max_current
-
-                if charge_state == 'Stopped' or charging_state == 'Complete':
-                    if charge_port_latch == 'Engaged':
-                      self._dbusserviceev['/Status'] = 1
-                    else:
-                      self._dbusserviceev['/Status'] = 0
-                      self._dbusserviceev['/ChargingTime'] = 0
-                      self._dbusserviceev['/Position'] = 0
-                    self._wait_seconds = 60 * 5
-                elif charge_state == 'Charging':
-                    power = voltage * current
-                    self._dbusserviceev['/Status'] = 2
-                    self._dbusserviceev['/Current'] = current
-                    self._dbusserviceev['/Ac/Power'] = power
-                    self._dbusserviceev[pre + '/Power'] = power
-                    # self._dbusserviceev["/Mode"] = str(battery_state) + '%'
-                    self._wait_seconds = 30
-                    self._running = True
-
-                    if (current > 12):
-                      self._dbusserviceev['/Position'] = 1
-                    else:
-                      self._dbusserviceev['/Position'] = 0
-
-                    delta = datetime.now() - self._startDate
-                    self._dbusserviceev['/ChargingTime'] = delta.total_seconds()
-                    charging = True
-                else:
-                    self._dbusserviceev['/Status'] = 10
-                    self._wait_seconds = 60 * 5
-
-          if not charging:
-              self._dbusserviceev['/Ac/Power'] = 0
-              self._dbusserviceev[pre + '/Power'] = 0
-              self._dbusserviceev['/Current'] = 0
-              self._dbusserviceev['/Position'] = 0
-              self._running = False
-
-          carDriving = self._getCarDriving()
-          if carDriving:
-             self._showInfoMessage('Car Driving')
-             self._wait_seconds = 60 * 60
-             
-       #else:
-         #if charging:
-           #delta = datetime.now() - self._startDate
-           #self._dbusserviceev['/ChargingTime'] = delta.total_seconds()
+          self._controlSurplus()
+          if self._estimator is not None:
+            self._estimator.loadChanged(float(inverterPower))
+            self._checkEstimate()
     except Exception as e:
-      error_message = str(e)
-      if self._request_timeout_string in error_message:
-        self._dbusserviceev['/Status'] = 0
-        # self._dbusserviceev['/Mode'] = "Car Sleeping"
-        self._wait_seconds = 60 * 5
-        self._showInfoMessage('Car Sleeping')
-      elif self._too_many_requests in error_message:
-        self._dbusserviceev['/Status'] = 0
-        # self._dbusserviceev['/Mode'] = "Too Many Requests"
-        self._wait_seconds = self._wait_seconds + 30
-        self._showInfoMessage('Too Many Requests')
-      elif "NoPower" in error_message:
-        self._dbusserviceev['/Status'] = 0
-        # self._dbusserviceev['/Mode'] = "No Power to Charger"
-        self._wait_seconds = 60 * 5
-        self._showInfoMessage('No Power to Charger')
-      else:
-        self._wait_seconds = 60 * 5
-        self._dbusserviceev['/Status'] = 10
-        self._token = self._getAccessToken()
-        # self._dbusserviceev['/Mode'] = "Check Logs for Error"
-        logging.critical('Error at %s', '_update', exc_info=e)
-      
-    self._lastUpdate = time.time()
+      self._handleUpdateError(e)
+
+    # the poll interval may have changed
+    self._schedulePoll()
+
+  def _applyPollingPolicy(self, event, **kwargs):
+    context = pollingpolicy.PollContext(event, self._wait_seconds, chargerPower=self._dbus['/Ac/Power'],
+                                        inverterPower=self.getInverterPower(), consecutiveErrors=self._errors.run, **kwargs)
+    self._wait_seconds = self._policy.nextInterval(context)
+    if self._estimator is not None and event != pollingpolicy.ERROR:
+      # a poll is only needed once the estimate runs out of confidence (or diverges, see _checkEstimate)
+      self._wait_seconds = self._estimator.nextInterval(self._wait_seconds)
+
+  def _processCarData(self):
+    charging = False
+    inverter_phase = self._config.Phase
+    policy_state = None
+
+    # the open charging session survives restarts - it gives /ChargingTime its start
+    session = None
+    if self._history:
+      session = self._history.record(self._config.VehicleId, self._carData['response']['charge_state'])
+    if self._estimator:
+      self._estimator.observe(self._carData['response']['charge_state'], float(self.getInverterPower()))
+
+    charging_state = self._carData['response']['charge_state']['charging_state']
+    if charging_state == "NoPower":
+       raise teslaerrors.NoPowerError("NoPower")
+
+    self._showInfoMessage('Car Awake')
+
+    #send data to DBus
+    for phase in ['L1']:
+      pre = '/Ac/' + phase
+
+      if phase == inverter_phase:
+        current = self._carData['response']['charge_state']['charger_actual_current']
+        voltage = self._carData['response']['charge_state']['charger_voltage']
+        charger_power = self._carData['response']['charge_state']['charger_power']
+        charge_state = self._carData['response']['charge_state']['charging_state']
+        charge_port_latch = self._carData['response']['charge_state']['charge_port_latch']
+        charge_energy_added = self._carData['response']['charge_state']['charge_energy_added']
+        max_current = self._carData['response']['charge_state']['charge_current_request_max']
+        battery_state = self._carData['response']['charge_state']['battery_level']
+
+        if max_current <= 12:
+          if session:
+            self._startDate = datetime.fromtimestamp(session['start'])
+          elif int(charge_energy_added) == 0:
+            self._startDate = datetime.now()
+
+          # energy of the current charging session (since plug-in)
+          self._dbus['/Ac/Energy/Forward'] = charge_energy_added
+          self._dbus['/MaxCurrent'] = max_current
+
+          if charge_state == 'Stopped' or charging_state == 'Complete':
+              if charge_port_latch == 'Engaged':
+                self._dbus['/Status'] = 1
+              else:
+                self._dbus['/Status'] = 0
+                self._dbus['/ChargingTime'] = 0
+                self._dbus['/Position'] = 0
+              policy_state = charge_state
+          elif charge_state == 'Charging':
+              power = voltage * current
+              self._dbus['/Status'] = 2
+              self._dbus['/Current'] = current
+              self._dbus['/Ac/Power'] = power
+              self._dbus[pre + '/Power'] = power
+              # self._dbus["/Mode"] = str(battery_state) + '%'
+              policy_state = charge_state
+              self._running = True
+
+              if (current > 12):
+                self._dbus['/Position'] = 1
+              else:
+                self._dbus['/Position'] = 0
+
+              delta = datetime.now() - self._startDate
+              self._dbus['/ChargingTime'] = delta.total_seconds()
+              charging = True
+          else:
+              self._dbus['/Status'] = 10
+              policy_state = charge_state
+
+    if not charging:
+        self._dbus['/Ac/Power'] = 0
+        self._dbus[pre + '/Power'] = 0
+        self._dbus['/Current'] = 0
+        self._dbus['/Position'] = 0
+        self._running = False
+
+    carDriving = self._getCarDriving()
+    if carDriving:
+       self._showInfoMessage('Car Driving')
+
+    self._applyPollingPolicy(pollingpolicy.DATA, chargingState=policy_state, driving=carDriving)
+    self._controlSurplus()
+    self._publishEstimate()
+    self._scheduleEstimate()
+
+  def _controlSurplus(self):
+    # main loop - after every vehicle_data/telemetry update and inverter change
+    if self._surplus is None or self._surplusCommandRunning:
+      return
+    charge_state = self._carData.get('response', {}).get('charge_state') or {}
+    # _running: published as charging from data fetched by this process - not the snapshot loaded from the cache
+    if not self._running or charge_state.get('charging_state') != 'Charging':
+      return
+
+    amps = self._surplus.update(float(self.getInverterPower()), charge_state.get('charger_voltage'),
+                                charge_state.get('charger_actual_current'), charge_state.get('charge_current_request'),
+                                charge_state.get('charger_phases'), charge_state.get('charge_current_request_max'),
+                                dataAge=self._vehicleState.age)
+    if amps is None:
+      return
+
+    logging.info("Surplus control: %.0f W from the inverter - setting %d A" % (self.getInverterPower(), amps))
+    self._surplusCommandRunning = True
+    future = self._commandExecutor.submit(self._setChargingAmps, amps)
+    future.add_done_callback(lambda f: gobject.idle_add(self._onSetChargingAmpsDone, amps, f))
+
+  def _setChargingAmps(self, amps):
+    # runs on the command thread - queued with /StartStop commands through the broker
+    self._controlTokens.getToken()
+    return self._commands.run('charging-set-amps', str(amps), vin=self._getCommandVin())
+
+  def _onSetChargingAmpsDone(self, amps, future):
+    self._surplusCommandRunning = False
+    try:
+      future.result()
+      self._dbus['/SetCurrent'] = amps
+      if self._estimator is not None:
+        self._estimator.commanded(amps)
+        self._checkEstimate()
+      self._signalChanges()
+    except Exception as e:
+      logging.critical('Error at %s', '_setChargingAmps', exc_info=e)
+      if self._surplus is not None:
+        self._surplus.commandFailed()
+
+    # one-shot idle callback
+    return False
+
+  def _checkEstimate(self):
+    # main loop - every ESTIMATE_INTERVAL seconds while charging, after inverter changes and set-amps commands
+    if self._estimator is None:
+      return
+    reason = self._estimator.pollReason()
+    if reason and not self._fetchInFlight:
+      logging.info("Power estimate %s (confidence %.2f) - polling the car early" % (reason, self._estimator.confidence()))
+      self._lastCheckData = datetime(2023, 12, 8)
+      if self._requestTeslaAPIData():
+        self._estimator.pollStarted(reason)
+    self._publishEstimate()
     self._signalChanges()
+    self._scheduleEstimate()
 
-    # return true, otherwise add_timeout will be removed from GObject - see docs http://library.isr.ist.utl.pt/docs/pygtk2reference/gobject-functions.html#function-gobject--timeout-add
-    return True
+  def _scheduleEstimate(self):
+    if self._estimator is not None and self._estimator.charging:
+      self._scheduler.schedule('estimate', ESTIMATE_INTERVAL)
+    else:
+      self._scheduler.cancel('estimate')
+
+  def _publishEstimate(self):
+    if self._estimator is None:
+      return
+    # only where _processCarData published the car as charging
+    if self._estimator.charging and self._running:
+      power = self._estimator.estimate()
+      self._dbus['/Ac/Power'] = power
+      self._dbus['/Ac/L1/Power'] = power
+      self._dbus['/Current'] = round(self._estimator.current(), 1)
+    self._dbus['/Estimate/Confidence'] = int(round(self._estimator.confidence() * 100))
+    self._dbus['/Estimate/Error'] = int(round(self._estimator.lastError)) if self._estimator.lastError is not None else None
+    self._dbus['/Estimate/EarlyPolls'] = self._estimator.earlyPolls
+
+  def _handleUpdateError(self, e):
+    kind = teslaerrors.classifyError(e)
+    retryAfter = teslaerrors.getRetryAfter(e)
+    self._errors.record(kind)
+    self._metrics.errors.inc(vehicle=self._config.VehicleId, kind=kind)
+    self._dbus[self._getErrorPath(kind)] = self._errors.counts[kind]
+
+    if kind == teslaerrors.ASLEEP:
+      self._dbus['/Status'] = 0
+      # probe first from now on - switches to probe-only polling at AsleepProbeInterval
+      self._lastOnline = None
+      # self._dbus['/Mode'] = "Car Sleeping"
+      self._showInfoMessage('Car Sleeping')
+    elif kind == teslaerrors.RATE_LIMITED:
+      self._dbus['/Status'] = 0
+      # self._dbus['/Mode'] = "Too Many Requests"
+      self._showInfoMessage('Too Many Requests - retry after %s seconds' % (retryAfter))
+    elif kind == teslaerrors.NO_POWER:
+      self._dbus['/Status'] = 0
+      # self._dbus['/Mode'] = "No Power to Charger"
+      self._showInfoMessage('No Power to Charger')
+    elif kind == teslaerrors.AUTH:
+      self._dbus['/Status'] = 10
+      # the only error that drops the token - refetched on the worker thread with the next request
+      self._ownerTokens.invalidate()
+      logging.error("Tesla API rejected the token: %s" % (e))
+    elif kind == teslaerrors.NETWORK:
+      # transient - keep the token and the last published values, retry soon
+      logging.error("Tesla API not reachable: %s" % (e))
+    else:
+      self._dbus['/Status'] = 10
+      # self._dbus['/Mode'] = "Check Logs for Error"
+      logging.critical('Error at %s', '_update', exc_info=e)
+
+    self._applyPollingPolicy(pollingpolicy.ERROR, error=kind, retryAfter=retryAfter)
+
+  def _getErrorPath(self, kind):
+    return '/Errors/%s' % (''.join(word.capitalize() for word in kind.split('_')))
 
   def _signalChanges(self):
-    # increment UpdateIndex - to show that new data is available
-    index = self._dbusserviceev['/UpdateIndex'] + 1  # increment index
-    if index > 255:   # maximum value of the index
-      index = 0       # overflow from 255 to 0
-    self._dbusserviceev['/UpdateIndex'] = index
+    self._publishRateLimit()
+    self._publishProbeStats()
+    # write the changed paths and bump /UpdateIndex - nothing is emitted if no value changed
+    self._dbus.publish()
+
+  def _publishProbeStats(self):
+    self._dbus['/Probe/State'] = self._vehicleOnlineState
+    self._dbus['/Probe/Probes'] = self._probes
+    self._dbus['/Probe/Fetches'] = self._fetches
+    self._dbus['/Probe/WakeupsAvoided'] = self._wakeupsAvoided
+
+  def _publishRateLimit(self):
+    status = self._rateLimiter.status()
+    self._dbus['/RateLimit/RemainingHour'] = status['remainingHour']
+    self._dbus['/RateLimit/RemainingDay'] = status['remainingDay']
+    self._dbus['/RateLimit/BlockedUntil'] = int(time.time() + status['delay']) if status['delay'] > 0 else 0
+    self._dbus['/RateLimit/Denied'] = sum(status['denied'].values())
 
   def _showInfoMessage(self, message):
     if not self._lastMessage == message:
@@ -490,92 +917,51 @@ class DbusTeslaAPIService:
     logging.info("someone else updated %s to %s" % (path, value))
 
     if path == '/StartStop':
-      self._startstop(path, value)
+      self._requestStartStop(value)
+
+    if path == '/Profile/Duration':
+      return self._requestProfile(value)
 
     return True # accept the change
 
+  def _requestProfile(self, value):
+    try:
+      seconds = int(value)
+    except (TypeError, ValueError):
+      return False
+    if seconds <= 0:
+      self._account.stopProfile()
+      return True
+    return self._account.startProfile(seconds)
+
+  def _publishProfile(self):
+    # called by the account when a profile starts or ends
+    profiler = self._account.profiler
+    self._dbus['/Profile/Running'] = 1 if profiler.running else 0
+    self._dbus['/Profile/LastFile'] = profiler.lastPath
+    if not profiler.running:
+      self._dbus['/Profile/Duration'] = 0
+    self._signalChanges()
+
   def is_not_blank(self, s):
       return bool(s and not s.isspace())
   
-  def save_data(self, key, value):
-    file = open(f"/tmp/{key}.json", 'w') 
-    file.write(value) 
-    file.close() 
-
-  def read_data(self, key):
-    try:
-      if os.path.exists(f"/tmp/{key}.json"):
-        with open(f"/tmp/{key}.json", 'r') as file:
-          return json.load(file)
-      else:
-        return None
-    except Exception as e:
-      logging.critical('Error at %s', '_update', exc_info=e)
+  def _getTelemetryVin(self):
+    # None until the VIN is known from a first vehicle_data
+    vin = self._getTeslaAPISerial()
+    return vin if vin != '0' else None
+
+  def _getCommandVin(self):
+    # a single car uses TESLA_VIN from config.json - with several, every command names its car
+    if self._account.isSingleVehicle():
       return None
-  
-  def get_new_token(self):
-    # Reading the refresh token from a json file
-    with open(authtoken_file_path, 'r') as file:
-        data = json.load(file)
-        refresh_token = data['refresh_token']
-
-    # Making a POST request to get a new auth token
-    url = 'https://auth.tesla.com/oauth2/v3/token'
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    data = {
-        'grant_type': 'refresh_token',
-        'client_id': config['CLIENT_ID'],
-        'refresh_token': refresh_token,
-        'scopes': 'user_data vehicle_device_data vehicle_cmds vehicle_charging_cmds'
-    }
-
-    response = requests.post(url, headers=headers, data=data)
-    response_data = response.json()
-
-    # Checking if the response contains 'refresh_token' and writing to authtoken.txt
-    if 'refresh_token' in response_data:
-        with open(authtoken_file_path, 'w') as file:
-            json.dump(response_data, file, indent=4)
-        print("New auth and refresh tokens saved to authtoken.txt.")
-    else:
-        print("Response does not contain a refresh token.")
-
-    # Extracting the access token, if available
-    auth_token = response_data.get('access_token', '')
-    expires_in = response_data.get('expires_in', 0)
-
-    expiration_date = time.time() + (expires_in - 1000)
-    expiration_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiration_date))
-
-    # Saving the new auth token if it's not empty
-    if auth_token:
-        print("New auth token saved to token.txt.")
-        with open(token_file_path, 'w') as token_file:
-            token_file.write(auth_token)
-
-        with open(token_expire_file_path, 'w') as token_expire_file:
-            token_expire_file.write(expiration_date)
-    else:
-        print("Auth token is empty. Token not saved.")
-
-  def get_token_is_expired(self):
-    if os.path.exists(token_expire_file_path):
-        with open(token_expire_file_path, 'r') as expire_file:
-            expiration_date = expire_file.read()
-            expiration_date = time.mktime(time.strptime(expiration_date, '%Y-%m-%d %H:%M:%S'))
-            if expiration_date < time.time():
-                print("Auth token is expired.")
-                return True
-    else:
-      return True
-    return False
+    vin = self._getTelemetryVin()
+    if not vin:
+      raise RuntimeError("VIN of vehicle %s not known yet - cannot send commands" % (self._config.VehicleId))
+    return vin
 
   def getInverterPower(self):
-    inverter_data = self.read_data("Inverter")
-    if inverter_data:
-       return Decimal(inverter_data['Power'])
-    else:
-       return Decimal(0.0)
+    return self._inverterPower.power
 
   def getCurrentDateAsLong(self):
     now = datetime.now()
@@ -583,59 +969,47 @@ class DbusTeslaAPIService:
     timestamp_as_long = int(timestamp)
     return timestamp_as_long
   
-  def resetSavedChargeStart(self):
-      config = self._getConfig()
-      car_id = config['DEFAULT']['VehicleId']
-      self.save_data(f"{car_id}-chargeStartTime", f"{{ \"ChargingStartTime\": \"{self.getCurrentDateAsLong()}\" }}")
-
-  def getSavedChargeStart(self):
-    try:
-      config = self._getConfig()
-      car_id = config['DEFAULT']['VehicleId']
-      charge_data = self.read_data(f"{car_id}-chargeStartTime")
-      if charge_data:
-        return datetime.now()
-      else:
-        return datetime.now()
-    except Exception as e:
-      return datetime.now()
-       
   def getDateFromLong(self, long):
     return datetime.fromtimestamp(long)
 
-  def is_time_between_midnight_and_8am(self):
-      # Get the current time
-      current_time = datetime.now().time()
-
-      # Define the time for midnight and 8 AM
-      midnight = current_time.replace(hour=6, minute=0, second=0, microsecond=0)
-      eight_am = current_time.replace(hour=14, minute=0, second=0, microsecond=0)
-
-      # Check if the current time is between midnight and 8 AM
-      return midnight <= current_time < eight_am
-
 def main():
-  #configure logging
-  logging.basicConfig(      format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            level=logging.INFO,
-                            handlers=[
-                                logging.FileHandler("%s/current.log" % (os.path.dirname(os.path.realpath(__file__)))),
-                                logging.StreamHandler()
-                            ])
+  #configure logging - file I/O runs on the log listener thread, not on the main loop
+  teslalog.setupLogging("%s/current.log" % (os.path.dirname(os.path.realpath(__file__))), getConfigPath())
 
   try:
       logging.info("Start");
 
+      setupEnvironment()
+
       from dbus.mainloop.glib import DBusGMainLoop
       # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
       DBusGMainLoop(set_as_default=True)
 
-      #start our main-service
-      pvac_output = DbusTeslaAPIService()
+      #start our main-service - one evcharger service per [VEHICLE...] section, or the single car in [DEFAULT]
+      defaults = TeslaConfig(getConfigPath(), ACCOUNT_SETTINGS)
+      account = TeslaAccount(defaults, script_dir, getClientId(), executable=tesla_control)
+      sections = defaults.vehicleSections()
+      if sections:
+        import dbus
+        for section in sections:
+          bus = dbus.SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus(private=True)
+          DbusTeslaAPIService(account=account, section=section, bus=bus)
+      else:
+        DbusTeslaAPIService(account=account)
+      logging.info("Managing %d vehicle(s)" % (len(account.vehicles)))
 
       logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
       mainloop = gobject.MainLoop()
+
+      # svc -d / kill: persist the vehicle state before exiting
+      def _stop():
+        logging.info("Stop")
+        account.shutdown()
+        mainloop.quit()
+        return False
+      gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGTERM, _stop)
+      gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGINT, _stop)
+
       mainloop.run()
   except Exception as e:
     logging.critical('Error at %s', 'main', exc_info=e)
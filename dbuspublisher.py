@@ -0,0 +1,53 @@
+# Diff based publisher in front of a VeDbusService.
+# Values are buffered while an update is processed and publish() only writes the paths whose value actually changed,
+# as one batch. /UpdateIndex is only incremented when something changed.
+
+
+class DbusPublisher:
+  def __init__(self, dbusservice):
+    self._dbusservice = dbusservice
+    self._pending = {}
+    self.writes = 0     # path writes that reached D-Bus
+    self.skipped = 0    # buffered writes dropped because the value did not change
+    self.signals = 0    # batches (ItemsChanged / PropertiesChanged rounds) emitted
+
+  def __setitem__(self, path, value):
+    self._pending[path] = value
+
+  def __getitem__(self, path):
+    if path in self._pending:
+      return self._pending[path]
+    return self._dbusservice[path]
+
+  def publish(self):
+    changed = {}
+    for path, value in self._pending.items():
+      if self._dbusservice[path] != value:
+        changed[path] = value
+      else:
+        self.skipped += 1
+    self._pending.clear()
+
+    if not changed:
+      return 0
+
+    # increment UpdateIndex - to show that new data is available
+    index = self._dbusservice['/UpdateIndex'] + 1  # increment index
+    if index > 255:   # maximum value of the index
+      index = 0       # overflow from 255 to 0
+    changed['/UpdateIndex'] = index
+
+    self._write(changed)
+    self.writes += len(changed)
+    self.signals += 1
+    return len(changed)
+
+  def _write(self, changed):
+    # newer velib versions collect changes made inside a `with service` block into a single ItemsChanged signal
+    if hasattr(type(self._dbusservice), '__enter__'):
+      with self._dbusservice as service:
+        for path, value in changed.items():
+          service[path] = value
+    else:
+      for path, value in changed.items():
+        self._dbusservice[path] = value
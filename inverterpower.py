@@ -0,0 +1,156 @@
+# Sources for the inverter power the service uses for its solar-surplus decisions.
+#  - InotifyInverterPowerSource: re-reads /tmp/Inverter.json only when a writer closes or renames it
+#  - DbusInverterPowerSource: follows a Victron D-Bus item via PropertiesChanged, no file needed
+#  - PollingInverterPowerSource: the old behaviour, re-reads the file on a fixed interval
+# All of them call the registered callback on the GLib main loop when the value changes.
+import os
+import sys
+import json
+import ctypes
+import ctypes.util
+import struct
+import logging
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+from decimal import Decimal
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_EVENT = struct.Struct('iIII')
+
+
+class InverterPowerSource:
+  name = None
+
+  def __init__(self):
+    self.power = Decimal(0.0)
+    self.reads = 0
+    self._callback = None
+
+  def start(self, callback):
+    self._callback = callback
+
+  def _publish(self, power):
+    if power == self.power:
+      return
+    self.power = power
+    if self._callback:
+      self._callback(power)
+
+
+class _FileInverterPowerSource(InverterPowerSource):
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+
+  def _readFile(self):
+    self.reads += 1
+    try:
+      with open(self.path, 'r') as file:
+        return Decimal(json.load(file)['Power'])
+    except FileNotFoundError:
+      return Decimal(0.0)
+    except Exception as e:
+      logging.error("Could not read inverter power from %s: %s" % (self.path, e))
+      return self.power
+
+
+class PollingInverterPowerSource(_FileInverterPowerSource):
+  name = 'poll'
+
+  def __init__(self, path, interval=500):
+    super().__init__(path)
+    self.interval = interval
+
+  def start(self, callback):
+    super().start(callback)
+    self._publish(self._readFile())
+    gobject.timeout_add(self.interval, self._poll)
+
+  def _poll(self):
+    self._publish(self._readFile())
+    return True
+
+
+class InotifyInverterPowerSource(_FileInverterPowerSource):
+  name = 'inotify'
+
+  def __init__(self, path):
+    super().__init__(path)
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    # watch the directory - writers that replace the file via rename would drop a watch on the file itself
+    directory = os.path.dirname(os.path.abspath(path)).encode()
+    if self._libc.inotify_add_watch(self._fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+      error = ctypes.get_errno()
+      os.close(self._fd)
+      raise OSError(error, "inotify_add_watch failed for %s" % (directory))
+    self._filename = os.path.basename(path).encode()
+
+  def start(self, callback):
+    super().start(callback)
+    self._publish(self._readFile())
+    gobject.io_add_watch(self._fd, gobject.PRIORITY_DEFAULT, gobject.IO_IN, self._onEvents)
+
+  def _onEvents(self, fd, condition):
+    try:
+      buffer = os.read(self._fd, 4096)
+    except BlockingIOError:
+      return True
+
+    changed = False
+    offset = 0
+    while offset + _EVENT.size <= len(buffer):
+      wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+      name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+      offset += _EVENT.size + length
+      if name == self._filename:
+        changed = True
+
+    if changed:
+      self._publish(self._readFile())
+    return True # keep the watch installed
+
+
+class DbusInverterPowerSource(InverterPowerSource):
+  name = 'dbus'
+
+  def __init__(self, serviceName, path):
+    super().__init__()
+    self.serviceName = serviceName
+    self.path = path
+    self._item = None
+
+  def start(self, callback):
+    super().start(callback)
+    import dbus
+    from vedbus import VeDbusItemImport
+    self._item = VeDbusItemImport(dbus.SystemBus(), self.serviceName, self.path, eventCallback=self._onChanged, createsignal=True)
+    self._publish(self._toDecimal(self._item.get_value()))
+
+  def _onChanged(self, serviceName, path, changes):
+    self._publish(self._toDecimal(changes.get('Value')))
+
+  def _toDecimal(self, value):
+    self.reads += 1
+    # invalid D-Bus values arrive as an empty array
+    if value is None or isinstance(value, (list, tuple)) or value == []:
+      return Decimal(0.0)
+    return Decimal(str(value))
+
+
+def createInverterPowerSource(config):
+  source = config.InverterPowerSource
+  if source == 'dbus':
+    return DbusInverterPowerSource(config.InverterPowerService, config.InverterPowerPath)
+  if source == 'inotify':
+    try:
+      return InotifyInverterPowerSource(config.InverterPowerFile)
+    except (OSError, AttributeError) as e:
+      logging.warning("inotify not available (%s) - falling back to polling %s" % (e, config.InverterPowerFile))
+  return PollingInverterPowerSource(config.InverterPowerFile)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Prometheus metrics for the service.
+# Counters, gauges and histograms are kept in memory and rendered in the Prometheus text format by a small HTTP
+# listener (MetricsListen, e.g. 127.0.0.1:9101 - GET /metrics). Recording is a dict lookup and an addition under a
+# lock, so it is cheap enough for the hot paths. Values that other objects already count (D-Bus writes, inverter
+# reads, token refreshes, ...) are bound to a function and read at scrape time instead of being copied on every change.
+#
+# Print the metrics of a running service: python metrics.py [host:port]
+import sys
+import math
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds - a vehicle_data call is ~0.3-2s, a tesla-control command up to a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _formatLabels(names, values, extra=()):
+  pairs = list(zip(names, values)) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % (','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs))
+
+def _formatValue(value):
+  if value is None:
+    return 'NaN'
+  value = float(value)
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(value) if value != int(value) else str(int(value))
+
+
+class _Metric:
+  kind = 'untyped'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labelNames = tuple(labels)
+    self._values = {}       # label values: value
+    self._functions = {}    # label values: function read at scrape time
+    self._lock = threading.Lock()
+
+  def bind(self, function, **labels):
+    # the value is function() when the metrics are scraped - function must be thread-safe (or only read)
+    with self._lock:
+      self._functions[self._key(labels)] = function
+
+  def _key(self, labels):
+    if set(labels) != set(self.labelNames):
+      raise ValueError("%s needs the labels %s - got %s" % (self.name, ', '.join(self.labelNames), ', '.join(labels)))
+    return tuple(str(labels[name]) for name in self.labelNames)
+
+  def _samples(self):
+    with self._lock:
+      values = dict(self._values)
+      functions = dict(self._functions)
+    for key, function in functions.items():
+      try:
+        values[key] = function()
+      except Exception as e:
+        logging.debug("Metric %s not collected: %s" % (self.name, e))
+    return [(self.name, key, (), value) for key, value in sorted(values.items())]
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+    for name, key, extra, value in self._samples():
+      lines.append('%s%s %s' % (name, _formatLabels(self.labelNames, key, extra), _formatValue(value)))
+    return lines
+
+
+class Counter(_Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+
+class Histogram(_Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      counts = self._values.get(key)
+      if counts is None:
+        # one count per bucket (not cumulative), then sum and count
+        counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+      for index, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[index] += 1
+          break
+      counts[-2] += value
+      counts[-1] += 1
+
+  def time(self, **labels):
+    return _Timer(self, labels)
+
+  def bind(self, function, **labels):
+    raise TypeError("Histograms cannot be bound to a function")
+
+  def _samples(self):
+    with self._lock:
+      values = dict((key, list(counts)) for key, counts in self._values.items())
+    samples = []
+    for key, counts in sorted(values.items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets, counts):
+        cumulative += count
+        samples.append((self.name + '_bucket', key, (('le', _formatValue(bound)),), cumulative))
+      samples.append((self.name + '_bucket', key, (('le', '+Inf'),), counts[-1]))
+      samples.append((self.name + '_sum', key, (), counts[-2]))
+      samples.append((self.name + '_count', key, (), counts[-1]))
+    return samples
+
+
+class _Timer:
+  def __init__(self, histogram, labels):
+    self._histogram = histogram
+    self._labels = labels
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+    return False
+
+
+class MetricsRegistry:
+  def __init__(self):
+    self._metrics = []
+    self._lock = threading.Lock()
+
+  def counter(self, name, help, labels=()):
+    return self._register(Counter(name, help, labels))
+
+  def gauge(self, name, help, labels=()):
+    return self._register(Gauge(name, help, labels))
+
+  def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return self._register(Histogram(name, help, labels, buckets))
+
+  def render(self):
+    with self._lock:
+      metrics = list(self._metrics)
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+  def _register(self, metric):
+    with self._lock:
+      self._metrics.append(metric)
+    return metric
+
+
+class ServiceMetrics:
+  # the metrics of one service process - shared by all cars of the account, labelled by vehicle
+  def __init__(self, registry=None):
+    self.registry = registry or MetricsRegistry()
+    registry = self.registry
+
+    self.updateSeconds = registry.histogram('tesla_update_seconds', 'Duration of one _update() tick on the main loop', ('vehicle',))
+    self.processSeconds = registry.histogram('tesla_process_seconds', 'Time to publish one vehicle_data or telemetry update', ('vehicle',))
+    self.requestSeconds = registry.histogram('tesla_api_request_seconds', 'Tesla API request latency', ('endpoint', 'status'))
+    self.requests = registry.counter('tesla_api_requests_total', 'Tesla API requests', ('endpoint', 'status'))
+    self.commandSeconds = registry.histogram('tesla_command_seconds', 'tesla-control run time', ('command',))
+    self.commands = registry.counter('tesla_commands_total', 'tesla-control runs by exit code', ('command', 'returncode'))
+    self.errors = registry.counter('tesla_errors_total', 'Failed updates by error class', ('vehicle', 'kind'))
+    self.tokenRefreshes = registry.counter('tesla_token_refreshes_total', 'Token refreshes done by this process', ('token',))
+    self.dbusWrites = registry.counter('tesla_dbus_writes_total', 'D-Bus path writes', ('vehicle',))
+    self.dbusSkipped = registry.counter('tesla_dbus_writes_skipped_total', 'D-Bus writes dropped because the value did not change', ('vehicle',))
+    self.inverterReads = registry.counter('tesla_inverter_reads_total', 'Inverter power reads', ('source',))
+    self.waitSeconds = registry.gauge('tesla_poll_interval_seconds', 'Current poll interval (_wait_seconds)', ('vehicle',))
+    self.dataAge = registry.gauge('tesla_data_age_seconds', 'Age of the last vehicle_data snapshot', ('vehicle',))
+    self.wakeupsPerHour = registry.gauge('tesla_main_loop_wakeups_per_hour', 'Main loop wakeups of the deadline scheduler in the last hour')
+    self.wakeups = registry.counter('tesla_main_loop_wakeups_total', 'Main loop wakeups of the deadline scheduler')
+    self.rateLimitDelay = registry.gauge('tesla_rate_limit_delay_seconds', 'Seconds until the rate limiter allows the next call')
+    self.startupSeconds = registry.gauge('tesla_startup_seconds', 'Process start to D-Bus paths published', ('vehicle',))
+    self.estimateConfidence = registry.gauge('tesla_power_estimate_confidence', 'Confidence of the charger power estimate (0-1)', ('vehicle',))
+    self.earlyPolls = registry.counter('tesla_early_polls_total', 'Polls started early because the power estimate diverged', ('vehicle',))
+
+  def observeRequest(self, timing):
+    # teslahttp.RequestTiming of a finished (or failed) request
+    endpoint = endpointName(timing.url)
+    status = timing.status if timing.status is not None else 'error'
+    self.requestSeconds.observe(timing.total, endpoint=endpoint, status=status)
+    self.requests.inc(endpoint=endpoint, status=status)
+
+  def observeCommand(self, command, returncode, seconds):
+    self.commandSeconds.observe(seconds, command=command)
+    self.commands.inc(command=command, returncode=returncode)
+
+
+def endpointName(url):
+  # low-cardinality label - no vehicle ids
+  path = url.split('?')[0]
+  if '/oauth2/' in path:
+    return 'token'
+  if path.endswith('/vehicle_data'):
+    return 'vehicle_data'
+  if path.rstrip('/').endswith('/api/1/vehicles'):
+    return 'vehicle_list'
+  if '/api/1/vehicles/' in path:
+    return 'vehicle'
+  return 'other'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.server.registry.render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # scrapes would flood current.log
+    pass
+
+
+class MetricsServer:
+  def __init__(self, listen, registry):
+    host, port = listen.rsplit(':', 1)
+    self.address = (host, int(port))
+    self.registry = registry
+    self._server = None
+
+  def start(self):
+    self._server = ThreadingHTTPServer(self.address, _MetricsHandler)
+    self._server.daemon_threads = True
+    self._server.registry = self.registry
+    threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("Serving metrics on http://%s:%d/metrics" % self.address)
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+
+
+def main():
+  # print the metrics of a running service
+  from urllib.request import urlopen
+  listen = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1:9101'
+  with urlopen("http://%s/metrics" % (listen), timeout=5) as response:
+    sys.stdout.write(response.read().decode('utf-8'))
+
+if __name__ == "__main__":
+  main()
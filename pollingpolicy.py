@@ -0,0 +1,161 @@
+# Polling policies - decide how long to wait before the next vehicle_data request.
+# The service describes what just happened in a PollContext and the policy returns the next interval in seconds.
+import time
+import random
+from collections import deque
+from datetime import datetime
+from teslaerrors import AUTH as AUTH_ERROR, ASLEEP as ASLEEP_ERROR, RATE_LIMITED as RATE_LIMITED_ERROR, NETWORK as NETWORK_ERROR
+
+# PollContext.event values
+TICK = 'tick'         # periodic re-evaluation before a poll
+INVERTER = 'inverter' # inverter power changed
+DATA = 'data'         # new vehicle_data arrived
+ERROR = 'error'       # the request failed - PollContext.error is one of the error classes of teslaerrors
+
+# longest wait after repeated auth failures - a revoked refresh token does not fix itself
+AUTH_BACKOFF_MAX = 6 * 60 * 60
+
+
+class PollContext:
+  def __init__(self, event, previous, chargingState=None, driving=False, chargerPower=0, inverterPower=0,
+               inverterPowerDelta=0, error=None, consecutiveErrors=0, retryAfter=None, now=None):
+    self.event = event
+    self.previous = previous                      # the interval currently in use
+    self.chargingState = chargingState            # charge_state.charging_state of the last data
+    self.driving = driving
+    self.chargerPower = chargerPower              # power currently published on /Ac/Power
+    self.inverterPower = inverterPower
+    self.inverterPowerDelta = inverterPowerDelta
+    self.error = error
+    self.consecutiveErrors = consecutiveErrors    # failures in a row of the class `error` (teslaerrors.ErrorCounters.run)
+    self.retryAfter = retryAfter                  # seconds the server asked us to wait, if any
+    self.now = now or datetime.now()
+
+
+class PollingPolicy:
+  name = None
+
+  def nextInterval(self, context):
+    raise NotImplementedError()
+
+  def recordRequest(self, timestamp=None):
+    # called for every request actually sent
+    pass
+
+
+class HeuristicPolicy(PollingPolicy):
+  # the fixed intervals the service always used
+  name = 'heuristic'
+
+  def __init__(self, asleepInterval=60 * 5):
+    # probe-only interval while the car sleeps - probing does not wake it
+    self._asleepInterval = asleepInterval
+
+  def nextInterval(self, context):
+    interval = context.previous
+
+    if context.event == TICK:
+      if self._isQuietHours(context.now) and not context.chargerPower > 0:
+        interval = 60 * 10
+      if context.inverterPower > 500:
+        interval = 30
+    elif context.event == INVERTER:
+      if abs(context.inverterPowerDelta) >= 1.0:
+        interval = 30
+    elif context.event == DATA:
+      if context.chargingState == 'Charging':
+        interval = 30
+      elif context.chargingState is not None:
+        interval = 60 * 5
+      if context.driving:
+        interval = 60 * 60
+    elif context.event == ERROR:
+      if context.error == RATE_LIMITED_ERROR:
+        interval = context.previous + 30
+      elif context.error == NETWORK_ERROR:
+        # transient - retry soon
+        interval = 60
+      elif context.error == AUTH_ERROR:
+        # retry soon with a fresh token, then 2, 4, 8, ... minutes up to AUTH_BACKOFF_MAX - SIGHUP retries at once
+        interval = min(AUTH_BACKOFF_MAX, 60 * 2 ** max(0, context.consecutiveErrors - 1))
+      elif context.error == ASLEEP_ERROR:
+        interval = self._asleepInterval
+      else:
+        interval = 60 * 5
+      if context.retryAfter:
+        interval = max(interval, context.retryAfter)
+
+    return interval
+
+  def _isQuietHours(self, now):
+    # between 06:00 and 14:00
+    current_time = now.time()
+    start = current_time.replace(hour=6, minute=0, second=0, microsecond=0)
+    end = current_time.replace(hour=14, minute=0, second=0, microsecond=0)
+    return start <= current_time < end
+
+
+class BackoffPolicy(PollingPolicy):
+  # exponential backoff with jitter on consecutive errors, otherwise defers to the wrapped policy
+  name = 'backoff'
+
+  def __init__(self, policy, maximum=60 * 60, jitter=0.2):
+    self._policy = policy
+    self._maximum = maximum
+    self._jitter = jitter
+
+  def nextInterval(self, context):
+    interval = self._policy.nextInterval(context)
+    if context.event == ERROR and context.consecutiveErrors > 1:
+      # never shorter than the wrapped policy asked for (auth failures back off beyond maximum there)
+      interval = max(interval, min(self._maximum, interval * 2 ** (context.consecutiveErrors - 1)))
+      interval = interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+      # jitter must not undercut Retry-After
+      interval = max(interval, context.retryAfter or 0)
+    return interval
+
+  def recordRequest(self, timestamp=None):
+    self._policy.recordRequest(timestamp)
+
+
+class RateBudgetPolicy(PollingPolicy):
+  # never exceed requestsPerDay requests in any 24 hour window
+  name = 'budget'
+
+  def __init__(self, policy, requestsPerDay):
+    self._policy = policy
+    self._requestsPerDay = requestsPerDay
+    self._requests = deque()
+
+  def nextInterval(self, context):
+    interval = self._policy.nextInterval(context)
+    if self._requestsPerDay <= 0:
+      return interval
+
+    # the context's clock - a replay can run a whole day in no time
+    now = context.now.timestamp()
+    self._prune(now)
+
+    # spread the allowance evenly over the day ...
+    interval = max(interval, 24 * 60 * 60 / self._requestsPerDay)
+    # ... and wait for the oldest request to leave the window once it is used up
+    if len(self._requests) >= self._requestsPerDay:
+      interval = max(interval, self._requests[0] + 24 * 60 * 60 - now)
+    return interval
+
+  def recordRequest(self, timestamp=None):
+    self._requests.append(timestamp or time.time())
+    self._policy.recordRequest(timestamp)
+
+  def _prune(self, now):
+    while self._requests and self._requests[0] <= now - 24 * 60 * 60:
+      self._requests.popleft()
+
+
+def createPollingPolicy(config):
+  policy = HeuristicPolicy(config.AsleepProbeInterval)
+  if config.PollingPolicy in ('backoff', 'budget'):
+    policy = BackoffPolicy(policy)
+  if config.PollingPolicy == 'budget':
+    policy = RateBudgetPolicy(policy, config.DailyRequestBudget)
+  return policy
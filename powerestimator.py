@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+# Charger power estimate between two vehicle_data polls.
+# The last measured charger power (charger_actual_current x charger_voltage x charger_phases) is carried forward
+# and corrected with what the service learns without asking the car:
+#  - a charging-set-amps command that went through moves the estimate to the new current
+#  - the charge limit ends the session - from time_to_full_charge, or from the SoC and the energy per % learned
+#    during the session - and the estimate drops to 0
+#  - with loadFollows (the inverter power path measures a load that includes the charger, e.g. the AC consumption)
+#    every inverter power change is checked against the estimate: the load minus what it was at the last poll is
+#    what the charger should draw now
+# The confidence (0..1) halves every halfLife seconds since the last poll and drops on every surprise. The service
+# asks for a real poll early only when the estimate diverges (load mismatch, predicted end of charge, confidence
+# below minConfidence), and may otherwise stretch the poll interval while charging up to maxInterval.
+#
+# Validation on a recorded trace: python powerestimator.py history.db [vehicle] [days]
+# Simulated surplus-charging day with a house load: python powerestimator.py [--simulate [hours]]
+import sys
+import math
+import time
+import random
+
+# never poll early more often than this (seconds since the last poll)
+MIN_EARLY_POLL = 30
+
+# pollReason() values
+DIVERGED = 'diverged'
+CHARGE_END = 'charge-end'
+CONFIDENCE = 'confidence'
+
+
+class PowerEstimator:
+  def __init__(self, divergence=500, minConfidence=0.5, maxInterval=300, halfLife=600, loadFollows=False):
+    self.divergence = divergence          # watts between estimate and evidence that trigger a poll
+    self.minConfidence = minConfidence
+    self.maxInterval = maxInterval
+    self.halfLife = halfLife
+    self.loadFollows = loadFollows
+    self.charging = False
+    self.measured = 0.0                   # charger power of the last poll
+    self.lastError = None                 # estimate - measured at the last poll (W)
+    self.earlyPolls = 0
+    self._anchor = None                   # time of the last poll
+    self._power = 0.0                     # estimate since the last poll or command
+    self._base = 1.0                      # confidence before the time decay
+    self._wattsPerAmp = 230.0
+    self._maxAmps = None
+    self._pluggedIn = False
+    self._chargeEnd = None                # predicted end of charge (time)
+    self._whPerPercent = None
+    self._first = None                    # (soc, energy Wh) of the first poll of the session
+    self._loadBase = None                 # load - charger power at the last poll
+    self._load = None
+    self._reason = None
+
+  def observe(self, charge_state, load=None, now=None):
+    # a real vehicle_data / telemetry update - returns the error of the estimate it replaces (W) or None
+    now = time.monotonic() if now is None else now
+    charging = charge_state.get('charging_state') == 'Charging'
+    voltage = charge_state.get('charger_voltage') or 0
+    current = charge_state.get('charger_actual_current') or 0
+    phases = charge_state.get('charger_phases') or 1
+    if voltage > 100:
+      # charger_voltage reads a few volts while the contactor is open
+      self._wattsPerAmp = float(voltage * phases)
+    power = float(voltage * current * phases) if charging else 0.0
+
+    self.lastError = self.estimate(now) - power if self._anchor is not None else None
+    if not charging:
+      self._first = None
+    self._learnEnergyPerPercent(charging, charge_state)
+
+    self.charging = charging
+    self.measured = power
+    self._power = power
+    self._anchor = now
+    self._base = 1.0
+    self._reason = None
+    self._maxAmps = charge_state.get('charge_current_request_max')
+    self._pluggedIn = charge_state.get('charge_port_latch') == 'Engaged' and charge_state.get('charging_state') in ('Stopped', 'Starting')
+    self._chargeEnd = self._predictChargeEnd(charge_state, power, now) if charging else None
+    self._load = load
+    self._loadBase = float(load) - power if self.loadFollows and load is not None else None
+    return self.lastError
+
+  def commanded(self, amps, now=None):
+    # charging-set-amps went through - the car ramps to it within seconds
+    now = time.monotonic() if now is None else now
+    if not self.charging:
+      return
+    if self._maxAmps:
+      amps = min(amps, self._maxAmps)
+    self._power = float(amps) * self._wattsPerAmp
+    self._base *= 0.9
+    if self._chargeEnd is not None and self._whPerPercent is None:
+      # time_to_full_charge was for the old current
+      self._chargeEnd = None
+
+  def loadChanged(self, load, now=None):
+    # inverter power update - only evidence with loadFollows
+    now = time.monotonic() if now is None else now
+    self._load = load
+    if self._loadBase is None or self._reason or not (self.charging or self._pluggedIn):
+      # a parked car that is not waiting to charge does not explain any load change
+      return
+    mismatch = self._implied(load) - self.estimate(now)
+    if abs(mismatch) >= self.divergence:
+      self._reason = DIVERGED
+      self._base *= self.divergence / (abs(mismatch) + self.divergence)
+
+  def estimate(self, now=None):
+    now = time.monotonic() if now is None else now
+    if not self.charging:
+      return 0.0
+    if self._chargeEnd is not None and now >= self._chargeEnd:
+      return 0.0
+    return self._power
+
+  def current(self, now=None):
+    return self.estimate(now) / self._wattsPerAmp
+
+  def confidence(self, now=None):
+    now = time.monotonic() if now is None else now
+    if self._anchor is None:
+      return 0.0
+    return self._base * 0.5 ** (max(0.0, now - self._anchor) / float(self.halfLife))
+
+  def pollReason(self, now=None):
+    # why a real poll is needed before the normal interval - None while the estimate holds
+    now = time.monotonic() if now is None else now
+    if self._anchor is None or now - self._anchor < MIN_EARLY_POLL:
+      return None
+    if self._reason:
+      return self._reason
+    if self.charging and self._chargeEnd is not None and now >= self._chargeEnd:
+      return CHARGE_END
+    if self.charging and self.confidence(now) < self.minConfidence:
+      return CONFIDENCE
+    return None
+
+  def nextInterval(self, interval, now=None):
+    # while the car charges and the estimate holds, the next poll can wait until the confidence runs out
+    now = time.monotonic() if now is None else now
+    if not self.charging or self._anchor is None or self._base < self.minConfidence:
+      return interval
+    untilLow = self.halfLife * math.log(self._base / self.minConfidence, 2) - (now - self._anchor)
+    if self._chargeEnd is not None:
+      untilLow = min(untilLow, self._chargeEnd - now)
+    return max(interval, min(self.maxInterval, untilLow))
+
+  def pollStarted(self, reason):
+    self.earlyPolls += 1
+    # one poll per surprise
+    self._reason = None
+    self._loadBase = None
+
+  def _implied(self, load):
+    implied = float(load) - self._loadBase
+    limit = (self._maxAmps or 48) * self._wattsPerAmp
+    return max(0.0, min(limit, implied))
+
+  def _learnEnergyPerPercent(self, charging, charge_state):
+    soc = charge_state.get('battery_level')
+    energy = charge_state.get('charge_energy_added')
+    if not charging or soc is None or energy is None:
+      return
+    energy = float(energy) * 1000
+    if self._first is None:
+      self._first = (soc, energy)
+    elif soc - self._first[0] >= 2:
+      self._whPerPercent = (energy - self._first[1]) / float(soc - self._first[0])
+
+  def _predictChargeEnd(self, charge_state, power, now):
+    hours = charge_state.get('time_to_full_charge')
+    if hours:
+      return now + float(hours) * 3600
+    soc = charge_state.get('battery_level')
+    limit = charge_state.get('charge_limit_soc')
+    if self._whPerPercent and power > 0 and soc is not None and limit:
+      return now + max(0, limit - soc) * self._whPerPercent / power * 3600
+    return None
+
+
+def createPowerEstimator(config):
+  if not config.PowerEstimate:
+    return None
+  return PowerEstimator(config.PowerEstimateDivergence, config.PowerEstimateMinConfidence, config.PowerEstimateMaxInterval,
+                        loadFollows=bool(config.PowerEstimateLoad))
+
+
+def evaluate(trace, estimator, interval=30):
+  # trace: [(ts, true charger power W, charge_state, load W or None, commanded amps or None)] at the recorded rate.
+  # Polls only when the estimator lets it, compares the estimate and a plain hold of the last poll with the truth
+  # at every trace point in between. The baseline is the fixed schedule: every `interval` seconds while charging,
+  # every 5 minutes otherwise.
+  polls = 0
+  baseline = 0
+  nextBaseline = None
+  errors = []
+  holdErrors = []
+  nextPoll = None
+  held = 0.0
+  for ts, power, charge_state, load, amps in trace:
+    charging = charge_state.get('charging_state') == 'Charging'
+    if nextBaseline is None or ts >= nextBaseline:
+      baseline += 1
+      nextBaseline = ts + (interval if charging else 300)
+    if amps is not None:
+      estimator.commanded(amps, ts)
+    if load is not None:
+      estimator.loadChanged(load, ts)
+
+    reason = estimator.pollReason(ts)
+    if nextPoll is None or ts >= nextPoll or reason:
+      if reason:
+        estimator.pollStarted(reason)
+      estimator.observe(charge_state, load, ts)
+      held = estimator.measured
+      polls += 1
+      nextPoll = ts + estimator.nextInterval(interval if charging else 300, ts)
+      continue
+
+    if charging or held:
+      errors.append(abs(estimator.estimate(ts) - power))
+      holdErrors.append(abs(held - power))
+
+  def summary(values):
+    values = sorted(values)
+    if not values:
+      return (0.0, 0.0)
+    return (sum(values) / len(values), values[int(len(values) * 0.95)])
+
+  return {'baseline': baseline, 'polls': polls, 'earlyPolls': estimator.earlyPolls,
+          'estimate': summary(errors), 'hold': summary(holdErrors)}
+
+
+def _historyTrace(path, vehicle, days):
+  from chargehistory import ChargeHistory
+  history = ChargeHistory(path)
+  end = int(time.time()) + 1
+  rows = history.series(vehicle, end - days * 86400, end)
+  history.close()
+  trace = []
+  for ts, power, current, voltage, soc, energy, charging in rows:
+    charge_state = {'charging_state': 'Charging' if charging else 'Stopped', 'charger_actual_current': current,
+                    'charger_voltage': voltage, 'charger_phases': 1, 'battery_level': soc,
+                    'charge_energy_added': energy / 1000.0 if energy is not None else None}
+    trace.append((ts, power or 0, charge_state, None, None))
+  return trace
+
+
+def _simulatedTrace(hours):
+  # PV bell curve with clouds, a house load stepping between 200 W and 3 kW, the surplus controller setting the
+  # current every minute at most, the car tapering above 75% on its own and stopping at its 80% limit, a few volts
+  # of grid noise - load = house + charger, sampled every 30 s
+  from surpluscontroller import SurplusController
+  random.seed(2)
+  controller = SurplusController(reserve=400)
+  voltage = 230
+  setAmps = 6
+  carAmps = 6
+  soc = 40.0
+  house = 300.0
+  cloud = 1.0
+  trace = []
+  for second in range(0, int(hours * 3600), 30):
+    if random.random() < 0.03:
+      cloud = random.choice([1.0, 1.0, 0.6, 0.3])
+    if random.random() < 0.04:
+      house = random.choice([200.0, 300.0, 300.0, 1200.0, 3000.0])
+    pv = max(0.0, 7000 * math.sin(math.pi * second / (hours * 3600))) * cloud
+    voltage = 230 + random.uniform(-4, 4)
+    charging = soc < 80
+    amps = None
+    if charging:
+      command = controller.update(pv - house, voltage, carAmps, setAmps, now=second)
+      if command is not None:
+        setAmps = amps = command
+      carAmps = min(setAmps, max(5, int(32 - (soc - 75) * 6))) if soc > 75 else setAmps
+      soc += voltage * carAmps * 30 / 3600.0 / 600.0   # 60 kWh pack - 600 Wh per %
+    power = voltage * carAmps if charging else 0.0
+    charge_state = {'charging_state': 'Charging' if charging else 'Complete', 'charger_actual_current': carAmps if charging else 0,
+                    'charger_voltage': int(voltage), 'charger_phases': 1, 'battery_level': int(soc), 'charge_limit_soc': 80,
+                    'charge_energy_added': (soc - 40.0) * 0.6, 'charge_current_request_max': 32,
+                    'charge_port_latch': 'Engaged'}
+    trace.append((second, power, charge_state, house + power + random.uniform(-30, 30), amps))
+  return trace
+
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] != '--simulate':
+    vehicle = sys.argv[2] if len(sys.argv) > 2 else None
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    if vehicle is None:
+      import sqlite3
+      db = sqlite3.connect("file:%s?mode=ro" % (sys.argv[1]), uri=True)
+      vehicle = db.execute('SELECT name FROM vehicles ORDER BY id LIMIT 1').fetchone()[0]
+      db.close()
+    trace = _historyTrace(sys.argv[1], vehicle, days)
+    estimator = PowerEstimator()
+    print("%s - %d recorded samples of the last %d days (no load signal)" % (vehicle, len(trace), days))
+  else:
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 12
+    trace = _simulatedTrace(hours)
+    estimator = PowerEstimator(loadFollows=True)
+    print("simulated %.1f hours of surplus charging with a house load, sampled every 30 s" % (hours))
+
+  result = evaluate(trace, estimator)
+  print("polls:                %d instead of %d (%.0f%% fewer, %d early)" % (result['polls'], result['baseline'],
+        100.0 * (1 - result['polls'] / float(result['baseline'] or 1)), result['earlyPolls']))
+  print("estimate error:       mean %6.0f W   p95 %6.0f W" % result['estimate'])
+  print("hold last poll error: mean %6.0f W   p95 %6.0f W" % result['hold'])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# On-demand profiling of the running service.
+# Started by SIGUSR1 (ProfileDuration seconds) or by writing the number of seconds to /Profile/Duration of any
+# evcharger service of the process (0 stops early). Nothing is hooked in while no profile runs.
+#  - cprofile: cProfile on the GLib main loop thread - every callback (_update, _handlechangedvalue, _signOfLife,
+#    _onTeslaAPIData, ...) with call counts and times. Writes a .pstats file and a .txt summary.
+#  - sample: a thread takes the stack of the main loop thread every 10 ms - far less overhead, no call counts.
+#    Writes collapsed stacks (.folded, one "frame;frame;frame count" line per stack) for flamegraph.pl / speedscope.
+# Files are written to ProfileDir, the newest KEEP profiles are kept.
+#
+# Print the top functions of a profile: python profiler.py profile.pstats [lines]
+#                                       python profiler.py profile.folded [lines]
+import os
+import sys
+import time
+import logging
+import threading
+
+# profiles kept in ProfileDir
+KEEP = 10
+# seconds - longest profile the D-Bus path accepts
+MAX_DURATION = 3600
+
+
+class Profiler:
+  def __init__(self, directory, mode='cprofile', interval=0.01):
+    self.directory = directory
+    self.mode = mode
+    self.interval = interval            # seconds between two stack samples (sample mode)
+    self.runs = 0
+    self.lastPath = None
+    self._profile = None
+    self._sampler = None
+    self._started = None
+
+  @property
+  def running(self):
+    return self._started is not None
+
+  def start(self):
+    # on the thread to profile - the GLib main loop
+    if self.running:
+      return False
+    if self.mode == 'sample':
+      self._sampler = _StackSampler(threading.get_ident(), self.interval)
+      self._sampler.start()
+    else:
+      import cProfile
+      self._profile = cProfile.Profile()
+      self._profile.enable()
+    self._started = time.monotonic()
+    logging.info("Profiling the main loop (%s)" % (self.mode))
+    return True
+
+  def stop(self):
+    # returns the written file or None
+    if not self.running:
+      return None
+    seconds = time.monotonic() - self._started
+    self._started = None
+    os.makedirs(self.directory, exist_ok=True)
+    base = os.path.join(self.directory, "profile-%s" % (time.strftime('%Y%m%d-%H%M%S')))
+
+    try:
+      if self._sampler is not None:
+        stacks = self._sampler.stop()
+        path = base + '.folded'
+        with open(path, 'w') as file:
+          for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            file.write("%s %d\n" % (stack, count))
+      else:
+        self._profile.disable()
+        path = base + '.pstats'
+        self._profile.dump_stats(path)
+        with open(base + '.txt', 'w') as file:
+          _printStats(path, 40, file)
+    except OSError as e:
+      logging.error("Could not write the profile to %s: %s" % (self.directory, e))
+      return None
+    finally:
+      self._profile = None
+      self._sampler = None
+
+    self.runs += 1
+    self.lastPath = path
+    logging.info("Profile of %.0f seconds written to %s" % (seconds, path))
+    self._prune()
+    return path
+
+  def _prune(self):
+    profiles = sorted(name for name in os.listdir(self.directory) if name.startswith('profile-'))
+    stamps = sorted(set(os.path.splitext(name)[0] for name in profiles))
+    for stamp in stamps[:-KEEP]:
+      for name in profiles:
+        if os.path.splitext(name)[0] == stamp:
+          os.remove(os.path.join(self.directory, name))
+
+
+class _StackSampler(threading.Thread):
+  def __init__(self, threadId, interval):
+    super().__init__(name='profiler', daemon=True)
+    self._threadId = threadId
+    self._interval = interval
+    self._stacks = {}
+    self._stopping = threading.Event()
+
+  def run(self):
+    while not self._stopping.wait(self._interval):
+      frame = sys._current_frames().get(self._threadId)
+      names = []
+      while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+      if names:
+        stack = ';'.join(reversed(names))
+        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+  def stop(self):
+    self._stopping.set()
+    self.join()
+    return self._stacks
+
+
+def createProfiler(config):
+  return Profiler(config.ProfileDir, config.ProfileMode)
+
+
+def _printStats(path, lines, stream):
+  import pstats
+  stats = pstats.Stats(path, stream=stream)
+  stats.sort_stats('cumulative').print_stats(lines)
+
+
+def _printFolded(path, lines):
+  # own samples per function (last frame of each stack) and the hottest stacks
+  own = {}
+  total = 0
+  with open(path, 'r') as file:
+    stacks = [line.rsplit(' ', 1) for line in file if line.strip()]
+  for stack, count in stacks:
+    count = int(count)
+    total += count
+    function = stack.rsplit(';', 1)[-1]
+    own[function] = own.get(function, 0) + count
+  print("%d samples" % (total))
+  for function, count in sorted(own.items(), key=lambda item: -item[1])[:lines]:
+    print("%6.1f%%  %s" % (100.0 * count / total, function))
+
+
+def main():
+  if len(sys.argv) < 2:
+    print("usage: python profiler.py profile.pstats|profile.folded [lines]")
+    return
+  lines = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+  if sys.argv[1].endswith('.folded'):
+    _printFolded(sys.argv[1], lines)
+  else:
+    _printStats(sys.argv[1], lines, sys.stdout)
+
+if __name__ == "__main__":
+  main()
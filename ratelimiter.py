@@ -0,0 +1,191 @@
+# Client-side rate limiter in front of every Tesla call (vehicle_data, token endpoint, tesla-control commands).
+# An hourly and a daily token bucket keep us under the allowance, Retry-After and the RateLimit-* response headers
+# block further calls until the server's reset. The state is persisted to a JSON file (which doubles as the
+# status file) so a restart does not hand out a fresh allowance.
+import os
+import json
+import time
+import logging
+import threading
+import teslaerrors
+
+
+class RateLimitExceeded(teslaerrors.RateLimitedError):
+  # raised before a request is sent - retryAfter is the client-side wait
+  pass
+
+
+class TokenBucket:
+  def __init__(self, capacity, period):
+    # capacity requests per period seconds, refilled continuously - capacity 0 means unlimited
+    self.capacity = capacity
+    self.rate = capacity / float(period) if capacity > 0 else 0.0
+    self.tokens = float(capacity)
+    self.updated = time.time()
+
+  def refill(self, now):
+    if self.capacity > 0:
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def delay(self, now):
+    # seconds until one request is allowed
+    if self.capacity <= 0:
+      return 0.0
+    self.refill(now)
+    if self.tokens >= 1.0:
+      return 0.0
+    return (1.0 - self.tokens) / self.rate
+
+  def take(self, now):
+    if self.capacity > 0:
+      self.refill(now)
+      self.tokens -= 1.0
+
+  def remaining(self):
+    return int(self.tokens) if self.capacity > 0 else None
+
+
+class TeslaRateLimiter:
+  def __init__(self, path=None, perDay=0, perHour=0, persistInterval=300):
+    self.path = path
+    self.persistInterval = persistInterval
+    self.blockedUntil = 0.0          # time.time() until which the server asked us to stop
+    self.allowed = {}                # requests sent per category
+    self.denied = {}                 # requests refused per category
+    self.serverRemaining = None      # last RateLimit-Remaining seen
+    self._hour = TokenBucket(perHour, 60 * 60)
+    self._day = TokenBucket(perDay, 24 * 60 * 60)
+    self._lock = threading.Lock()
+    self._dirty = False
+    self._lastPersist = None
+    self._load()
+
+  def delay(self):
+    # seconds until the next request would be allowed
+    with self._lock:
+      return self._delay(time.time())
+
+  def acquire(self, category='api'):
+    # take one request from the budget or raise RateLimitExceeded
+    with self._lock:
+      now = time.time()
+      delay = self._delay(now)
+      if delay > 0:
+        self.denied[category] = self.denied.get(category, 0) + 1
+        raise RateLimitExceeded("Request budget used up - %s not sent, retry in %.0f seconds" % (category, delay), retryAfter=delay)
+      self._hour.take(now)
+      self._day.take(now)
+      self.allowed[category] = self.allowed.get(category, 0) + 1
+      self._dirty = True
+      self._persistIfDue()
+
+  def observe(self, response):
+    # Retry-After on 429/503 and RateLimit-Remaining/-Reset on every response
+    headers = response.headers
+    block = None
+    if response.status_code in (429, 503):
+      block = teslaerrors.parseRetryAfter(headers.get('Retry-After'))
+      if block is None and response.status_code == 429:
+        block = 60.0
+
+    remaining = self._header(headers, 'RateLimit-Remaining')
+    reset = self._header(headers, 'RateLimit-Reset')
+    if reset is not None and reset > 1000000000:
+      # some servers send the reset as epoch seconds
+      reset = max(0.0, reset - time.time())
+
+    with self._lock:
+      if remaining is not None:
+        self.serverRemaining = int(remaining)
+        if remaining <= 0 and reset:
+          block = max(block or 0.0, reset)
+      if block:
+        until = time.time() + block
+        if until > self.blockedUntil:
+          self.blockedUntil = until
+          logging.warning("Tesla API rate limit reached - no requests for %.0f seconds" % (block))
+          # a restart within the block must not hammer the API - write right away
+          self._dirty = True
+          self._persist()
+
+  def status(self):
+    with self._lock:
+      now = time.time()
+      return {
+        'delay': self._delay(now),
+        'blockedUntil': self.blockedUntil,
+        'remainingHour': self._hour.remaining(),
+        'remainingDay': self._day.remaining(),
+        'serverRemaining': self.serverRemaining,
+        'allowed': dict(self.allowed),
+        'denied': dict(self.denied),
+      }
+
+  def flush(self):
+    with self._lock:
+      self._persist()
+
+  def _delay(self, now):
+    return max(self.blockedUntil - now, self._hour.delay(now), self._day.delay(now), 0.0)
+
+  def _header(self, headers, name):
+    value = headers.get(name, headers.get('X-' + name))
+    try:
+      return float(value) if value is not None else None
+    except ValueError:
+      return None
+
+  def _persistIfDue(self):
+    if self._lastPersist is None or time.monotonic() - self._lastPersist >= self.persistInterval:
+      self._persist()
+
+  def _persist(self):
+    if not self.path or not self._dirty:
+      return
+    state = {
+      'saved': time.time(),
+      'blockedUntil': self.blockedUntil,
+      'hour': {'capacity': self._hour.capacity, 'tokens': self._hour.tokens, 'updated': self._hour.updated},
+      'day': {'capacity': self._day.capacity, 'tokens': self._day.tokens, 'updated': self._day.updated},
+      'serverRemaining': self.serverRemaining,
+      'allowed': self.allowed,
+      'denied': self.denied,
+    }
+    temp_path = "%s.tmp" % (self.path)
+    try:
+      with open(temp_path, 'w') as file:
+        json.dump(state, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+      os.replace(temp_path, self.path)
+    except OSError as e:
+      logging.error("Could not persist rate limiter state to %s: %s" % (self.path, e))
+      return
+    self._dirty = False
+    self._lastPersist = time.monotonic()
+
+  def _load(self):
+    if not self.path:
+      return
+    try:
+      with open(self.path, 'r') as file:
+        state = json.load(file)
+    except FileNotFoundError:
+      return
+    except Exception as e:
+      logging.error("Ignoring unreadable rate limiter state %s: %s" % (self.path, e))
+      return
+
+    self.blockedUntil = state.get('blockedUntil', 0.0)
+    self.serverRemaining = state.get('serverRemaining')
+    self.allowed = state.get('allowed', {})
+    self.denied = state.get('denied', {})
+    for name, bucket in (('hour', self._hour), ('day', self._day)):
+      saved = state.get(name) or {}
+      # only restore a bucket of the same size - a changed budget starts full
+      if saved.get('capacity') == bucket.capacity and bucket.capacity > 0:
+        bucket.tokens = saved['tokens']
+        bucket.updated = saved['updated']
+        bucket.refill(time.time())
+    logging.info("Loaded rate limiter state from %s (delay %.0f seconds)" % (self.path, self._delay(time.time())))
@@ -0,0 +1,131 @@
+# Deadline based scheduler for the GLib main loop.
+# Instead of a fixed tick, every piece of periodic work registers the time it next needs to run.
+# A single GLib timeout is armed for the earliest deadline and re-armed whenever deadlines change.
+import sys
+import math
+import time
+import logging
+from collections import deque
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+
+
+class ScopedScheduler:
+  # view on a shared DeadlineScheduler - deadline names are prefixed so several owners can use one timeout
+  def __init__(self, scheduler, prefix):
+    self._scheduler = scheduler
+    self._prefix = prefix + ':'
+
+  @property
+  def totalWakeups(self):
+    return self._scheduler.totalWakeups
+
+  def schedule(self, name, seconds):
+    self._scheduler.schedule(self._prefix + name, seconds)
+
+  def cancel(self, name):
+    self._scheduler.cancel(self._prefix + name)
+
+  def remaining(self, name):
+    return self._scheduler.remaining(self._prefix + name)
+
+  def wakeupsPerHour(self):
+    return self._scheduler.wakeupsPerHour()
+
+
+class DeadlineScheduler:
+  def __init__(self, callback=None):
+    # callback(due) is called with the list of deadline names that expired
+    self._callback = callback
+    self._scopes = {}
+    self._deadlines = {}
+    self._source = None
+    self._armedFor = None
+    self._wakeups = deque()
+    self.totalWakeups = 0
+
+  def schedule(self, name, seconds):
+    # run `name` in `seconds` from now (replacing an earlier deadline with the same name)
+    self._deadlines[name] = time.monotonic() + max(0.0, seconds)
+    self._arm()
+
+  def cancel(self, name):
+    if self._deadlines.pop(name, None) is not None:
+      self._arm()
+
+  def remaining(self, name):
+    deadline = self._deadlines.get(name)
+    if deadline is None:
+      return None
+    return max(0.0, deadline - time.monotonic())
+
+  def wakeupsPerHour(self):
+    # also read by the metrics thread - counts a copy instead of pruning, _fire() prunes on the main loop
+    since = time.monotonic() - 3600
+    return sum(1 for wakeup in tuple(self._wakeups) if wakeup >= since)
+
+  def scoped(self, prefix, callback):
+    # a ScopedScheduler whose expired deadlines are delivered to callback(due) without the prefix
+    self._scopes[prefix] = callback
+    return ScopedScheduler(self, prefix)
+
+  def _arm(self):
+    if not self._deadlines:
+      self._disarm()
+      return
+
+    deadline = min(self._deadlines.values())
+    if self._source is not None and self._armedFor == deadline:
+      return
+
+    self._disarm()
+    # round up so the timeout never fires before the deadline it was armed for
+    delay = math.ceil(max(0.0, deadline - time.monotonic()) * 1000)
+    self._armedFor = deadline
+    self._source = gobject.timeout_add(delay, self._fire)
+
+  def _disarm(self):
+    if self._source is not None:
+      gobject.source_remove(self._source)
+    self._source = None
+    self._armedFor = None
+
+  def _fire(self):
+    now = time.monotonic()
+    self._source = None
+    self._armedFor = None
+    self.totalWakeups += 1
+    self._wakeups.append(now)
+    self._pruneWakeups(now)
+
+    due = [name for name, deadline in self._deadlines.items() if deadline <= now]
+    for name in due:
+      del self._deadlines[name]
+
+    # group by owner - an error in one owner's callback does not hold up the others
+    callbacks = {}
+    for name in due:
+      prefix, separator, rest = name.partition(':')
+      if separator and prefix in self._scopes:
+        callbacks.setdefault(prefix, []).append(rest)
+      else:
+        callbacks.setdefault(None, []).append(name)
+
+    for prefix, names in callbacks.items():
+      try:
+        callback = self._scopes[prefix] if prefix is not None else self._callback
+        if callback:
+          callback(names)
+      except Exception as e:
+        logging.critical('Error at %s', '_fire', exc_info=e)
+
+    self._arm()
+
+    # one-shot - _arm() installs the next timeout
+    return False
+
+  def _pruneWakeups(self, now):
+    while self._wakeups and self._wakeups[0] < now - 3600:
+      self._wakeups.popleft()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Solar-surplus charge current controller.
+# While the car charges, the service feeds it the inverter power and the measured charger power after every
+# vehicle_data and inverter change. It answers with the amps to send with charging-set-amps, or None:
+#  - more current only once the surplus exceeds the charger power by `hysteresis` watts, less as soon as the
+#    charger draws more than the surplus
+#  - clamped to minAmps..maxAmps (and the car's charge_current_request_max)
+#  - at most `slewRate` amps per minute of change
+#  - only when the target moved by at least `deadband` amps and at most once per `commandInterval` seconds
+#  - never on a snapshot older than `maxDataAge` seconds - it may still say Charging after the car stopped
+#
+# Simulation against a PV / car model: python surpluscontroller.py [hours]
+import sys
+import math
+import time
+import random
+
+
+class SurplusController:
+  def __init__(self, minAmps=5, maxAmps=32, reserve=0, hysteresis=200, slewRate=6, commandInterval=60, deadband=1, maxDataAge=600):
+    self.minAmps = minAmps
+    self.maxAmps = maxAmps
+    self.reserve = reserve                  # watts kept for the house
+    self.hysteresis = hysteresis
+    self.slewRate = slewRate                # amps per minute
+    self.commandInterval = commandInterval
+    self.deadband = deadband
+    self.maxDataAge = maxDataAge
+    self.target = None
+    self.commanded = None
+    self.commands = 0
+    self.suppressed = 0                     # changes held back by commandInterval
+    self.stale = 0                          # updates ignored because the car data was too old
+    self._lastCommand = None
+
+  def update(self, inverterPower, voltage, current, requested, phases=1, carMaxAmps=None, now=None, dataAge=0):
+    # inverterPower: solar power in W - voltage/current/phases: measured by the car's charger,
+    # requested: the car's charge_current_request, dataAge: seconds since the car data was fetched (None: unknown)
+    now = time.monotonic() if now is None else now
+    if dataAge is None or dataAge > self.maxDataAge:
+      # every command would wake the car and cost a request - and re-read the car's value once data is fresh again
+      self.stale += 1
+      self.commanded = None
+      return None
+
+    # charger_voltage reads a few volts while the contactor is open
+    voltage = voltage if voltage and voltage > 100 else 230
+    wattsPerAmp = voltage * max(1, phases or 1)
+    chargerPower = (current or 0) * wattsPerAmp
+
+    # the car is the truth once a command had time to arrive (or someone changed it in the app)
+    if self.commanded is None or self._sinceCommand(now) > self.commandInterval:
+      self.commanded = int(requested or current or self.minAmps)
+
+    error = inverterPower - self.reserve - chargerPower
+    if error >= self.hysteresis or error < 0:
+      target = int(math.floor(self.commanded + error / wattsPerAmp))
+    else:
+      target = self.commanded
+
+    maxAmps = min(self.maxAmps, carMaxAmps) if carMaxAmps else self.maxAmps
+    target = max(self.minAmps, min(maxAmps, target))
+
+    if self._lastCommand is not None:
+      step = max(1, int(self.slewRate * self._sinceCommand(now) / 60.0))
+      target = max(self.commanded - step, min(self.commanded + step, target))
+    self.target = target
+
+    if abs(target - self.commanded) < self.deadband:
+      return None
+    if self._lastCommand is not None and self._sinceCommand(now) < self.commandInterval:
+      self.suppressed += 1
+      return None
+
+    self.commanded = target
+    self._lastCommand = now
+    self.commands += 1
+    return target
+
+  def commandFailed(self):
+    # re-read the car's value on the next update and try again after commandInterval
+    self.commanded = None
+
+  def _sinceCommand(self, now):
+    return now - self._lastCommand if self._lastCommand is not None else float('inf')
+
+
+def createSurplusController(config):
+  if not config.SurplusControl:
+    return None
+  return SurplusController(config.SurplusMinAmps, config.SurplusMaxAmps, config.SurplusReserve, config.SurplusHysteresis,
+                           config.SurplusSlewRate, config.SurplusCommandInterval, maxDataAge=config.SurplusMaxDataAge)
+
+
+def main():
+  # simulated day: PV bell curve with passing clouds, a car polled every 30 seconds that applies
+  # charging-set-amps after a few seconds, 230 V single phase, 400 W house load kept as reserve
+  hours = float(sys.argv[1]) if len(sys.argv) > 1 else 12
+  random.seed(1)
+  controller = SurplusController(reserve=400)
+  voltage = 230
+  carAmps = 5
+  pending = None        # (apply at, amps)
+  shortfall = 0.0       # Wh taken from the grid because the car drew more than the surplus
+  unused = 0.0          # Wh of surplus the car did not use
+  cloud = 1.0
+
+  step = 10
+  for second in range(0, int(hours * 3600), step):
+    if random.random() < 0.02:
+      cloud = random.choice([1.0, 1.0, 0.6, 0.3])
+    pv = max(0.0, 7000 * math.sin(math.pi * second / (hours * 3600))) * cloud
+
+    if pending and second >= pending[0]:
+      carAmps = pending[1]
+      pending = None
+
+    available = pv - 400
+    drawn = voltage * carAmps
+    shortfall += max(0.0, drawn - available) * step / 3600.0
+    unused += max(0.0, available - drawn) * step / 3600.0
+
+    if second % 30 == 0:
+      amps = controller.update(pv, voltage, carAmps, carAmps, now=second)
+      if amps is not None:
+        pending = (second + 5, amps)
+
+  print("simulated hours:      %.1f" % (hours))
+  print("commands sent:        %d (%.1f per hour, %d held back)" % (controller.commands, controller.commands / hours, controller.suppressed))
+  print("grid energy used:     %.0f Wh" % (shortfall))
+  print("surplus not used:     %.0f Wh" % (unused))
+
+if __name__ == "__main__":
+  main()
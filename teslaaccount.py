@@ -0,0 +1,224 @@
+# Everything the cars of one Tesla account share inside one service process.
+# Each car gets its own DbusTeslaAPIService (and evcharger D-Bus service), but they all use one pooled HTTP session,
+# one rate limiter, one token manager, one deadline scheduler, one worker thread, one tesla-control broker, one
+# inverter power source and one telemetry listener. The vehicle summary probes of all cars are answered by a single
+# vehicle list call.
+import sys
+import time
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+from teslahttp import TeslaHttpSession
+from ratelimiter import TeslaRateLimiter
+from teslatoken import teslaControlTokens, ownerApiTokens
+from teslacommand import TeslaCommandBroker, TeslaCommandClient
+from scheduler import DeadlineScheduler
+from inverterpower import createInverterPowerSource
+from teslastream import TelemetryReceiver
+from metrics import ServiceMetrics, MetricsServer
+from chargehistory import createChargeHistory
+from profiler import createProfiler, MAX_DURATION
+import teslaerrors
+
+
+class TeslaAccount:
+  def __init__(self, config, tokenDir, clientId, vehicleListMaxAge=15, executable='tesla-control'):
+    # config: the [DEFAULT] settings (teslaconfig.ACCOUNT_SETTINGS) - executable: path of tesla-control (teslaenv.py)
+    self._config = config
+    self.vehicles = []
+    self.vehicleListCalls = 0
+    self._vehicleListMaxAge = vehicleListMaxAge
+    self._vehicleList = None
+    self._vehicleListTime = None
+    self._vehicleListLock = threading.Lock()
+
+    # counters and latency histograms of all cars - served in the Prometheus format if MetricsListen is set
+    self.metrics = ServiceMetrics()
+    self.metricsServer = None
+
+    # one request budget for vehicle_data, the token endpoint and tesla-control commands - survives restarts
+    self.rateLimiter = TeslaRateLimiter(config.RateLimitStateFile, config.RateLimitPerDay, config.RateLimitPerHour)
+    # pooled keep-alive connections to the Tesla API and auth endpoints - requests is imported by the first call
+    self.session = TeslaHttpSession(timeout=(config.ConnectTimeout, config.ReadTimeout), limiter=self.rateLimiter, metrics=self.metrics)
+    # owner-api token for vehicle_data (memory only) and the token.txt used by tesla-control - the latter is
+    # shared with TokenRefresh and the CLI scripts, refreshes are serialised with a file lock
+    self.ownerTokens = ownerApiTokens(config.RefreshToken, session=self.session, authUrl=config.AuthBaseUrl)
+    self.controlTokens = teslaControlTokens(tokenDir, clientId, session=self.session, authUrl=config.AuthBaseUrl)
+
+    # vehicle_data fetches and token refreshes of all cars run one after the other on this thread
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    # tesla-control commands of the service and the CLI scripts are queued through one broker
+    self.commandBroker = TeslaCommandBroker(config.CommandSocket, executable=executable, limiter=self.rateLimiter,
+                                            metrics=self.metrics)
+    self.commandBroker.start()
+    self.commands = TeslaCommandClient(config.CommandSocket, executable=executable)
+    # /StartStop is handled on its own thread so a wake + command never blocks polling or the main loop
+    self.commandExecutor = ThreadPoolExecutor(max_workers=1)
+
+    # one GLib timeout armed for the next deadline of any car - each car uses a scoped view
+    self.scheduler = DeadlineScheduler()
+    self._scheduler = self.scheduler.scoped('account', self._onDeadline)
+
+    # inverter power is pushed to every car's _onInverterPowerChanged
+    self.inverterPower = createInverterPowerSource(config)
+    self.inverterPower.start(self._onInverterPowerChanged)
+    logging.info("Inverter power source: %s" % (self.inverterPower.name))
+
+    # every processed sample of every car and the charging sessions derived from them (one SQLite file)
+    self.history = createChargeHistory(config)
+
+    # optional push feed - records are routed to the car by VIN
+    self.telemetry = None
+    if config.TelemetryListen:
+      self.telemetry = TelemetryReceiver(config.TelemetryListen, self._onTelemetry, timeout=config.TelemetryTimeout)
+      self.telemetry.start()
+
+    self.metrics.tokenRefreshes.bind(lambda: self.ownerTokens.refreshes, token='owner')
+    self.metrics.tokenRefreshes.bind(lambda: self.controlTokens.refreshes, token='control')
+    self.metrics.inverterReads.bind(lambda: self.inverterPower.reads, source=self.inverterPower.name)
+    self.metrics.rateLimitDelay.bind(self.rateLimiter.delay)
+    # all cars share the scheduler - the old fixed 500 ms tick made 7200 wakeups per hour
+    self.metrics.wakeupsPerHour.bind(self.scheduler.wakeupsPerHour)
+    self.metrics.wakeups.bind(lambda: self.scheduler.totalWakeups)
+    if config.MetricsListen:
+      self.metricsServer = MetricsServer(config.MetricsListen, self.metrics.registry)
+      self.metricsServer.start()
+
+    # re-read config.ini on SIGHUP even if its mtime did not change
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGHUP, self._handleSighup)
+
+    # on-demand profile of the main loop - SIGUSR1 or /Profile/Duration of any car, nothing runs until then
+    self.profiler = createProfiler(config)
+    gobject.unix_signal_add(gobject.PRIORITY_DEFAULT, signal.SIGUSR1, self._handleSigusr1)
+
+  def addVehicle(self, vehicle):
+    self.vehicles.append(vehicle)
+
+  def isSingleVehicle(self):
+    return len(self.vehicles) <= 1
+
+  def vehicleState(self, vehicleId, headers):
+    # runs on a worker thread - state of one car from the (shared, briefly cached) vehicle list
+    vehicles = self._getVehicleList(headers)
+    vehicleId = str(vehicleId)
+    for vehicle in vehicles:
+      if vehicleId in (str(vehicle.get('id')), str(vehicle.get('vehicle_id')), vehicle.get('vin')):
+        return vehicle.get('state')
+    raise teslaerrors.DataError("Vehicle %s is not in the vehicle list of this account" % (vehicleId))
+
+  def _getVehicleList(self, headers):
+    with self._vehicleListLock:
+      if self._vehicleListTime is not None and time.monotonic() - self._vehicleListTime < self._vehicleListMaxAge:
+        return self._vehicleList
+
+      # the list endpoint answers for all cars at once and does not wake any of them
+      URL = "%s/api/1/vehicles" % (self._config.ApiBaseUrl)
+      self.vehicleListCalls += 1
+      response = self.session.get(URL, headers=headers)
+      teslaerrors.raiseForStatus(response)
+      try:
+        vehicles = response.json()['response']
+      except (KeyError, TypeError, ValueError) as e:
+        raise teslaerrors.DataError("Unexpected vehicle list: %s" % (response.text[:200])) from e
+
+      self._vehicleList = vehicles
+      self._vehicleListTime = time.monotonic()
+      return vehicles
+
+  def invalidateVehicleList(self):
+    # the next probe asks the API again (e.g. after a wake)
+    with self._vehicleListLock:
+      self._vehicleListTime = None
+
+  def scheduleTokenRefresh(self):
+    expiresIn = self.ownerTokens.expiresIn()
+    if expiresIn > 0 and self._scheduler.remaining('token') is None:
+      # refresh 5 minutes early so a poll never has to wait for the token endpoint
+      self._scheduler.schedule('token', max(60, expiresIn - self.ownerTokens.margin))
+
+  def _onDeadline(self, due):
+    if 'token' in due:
+      self._refreshAccessToken()
+    if 'profile' in due:
+      self.stopProfile()
+
+  def startProfile(self, seconds):
+    # main loop - False if a profile is already running
+    seconds = max(1, min(MAX_DURATION, int(seconds)))
+    if not self.profiler.start():
+      return False
+    self._scheduler.schedule('profile', seconds)
+    self._publishProfile()
+    return True
+
+  def stopProfile(self):
+    self._scheduler.cancel('profile')
+    path = self.profiler.stop()
+    self._publishProfile()
+    return path
+
+  def _publishProfile(self):
+    for vehicle in self.vehicles:
+      vehicle._publishProfile()
+
+  def _handleSigusr1(self):
+    # a second SIGUSR1 ends the running profile early
+    if self.profiler.running:
+      logging.info("SIGUSR1 received - stopping the profile")
+      self.stopProfile()
+    else:
+      logging.info("SIGUSR1 received - profiling for %d seconds" % (self._config.ProfileDuration))
+      self.startProfile(self._config.ProfileDuration)
+    return True # keep the signal handler installed
+
+  def _refreshAccessToken(self):
+    def _onToken(future):
+      try:
+        future.result()
+        self.scheduleTokenRefresh()
+      except Exception as e:
+        logging.error("Could not refresh Tesla Token: %s" % (e))
+      return False
+
+    # queued behind running fetches on the worker thread - they keep using the current token
+    future = self.executor.submit(self.ownerTokens.getToken)
+    future.add_done_callback(lambda f: gobject.idle_add(_onToken, f))
+
+  def _onInverterPowerChanged(self, power):
+    for vehicle in self.vehicles:
+      vehicle._onInverterPowerChanged(power)
+
+  def _onTelemetry(self, changes, vin):
+    for vehicle in self.vehicles:
+      vehicleVin = vehicle._getTelemetryVin()
+      if vehicleVin and vin and vehicleVin != vin:
+        continue
+      if not vehicleVin and not self.isSingleVehicle():
+        # the VIN of this car is only known after its first vehicle_data
+        continue
+      vehicle._onTelemetry(changes)
+
+  def _handleSighup(self):
+    logging.info("SIGHUP received - reloading config.ini")
+    self._config.invalidate()
+    self._config.refresh()
+    if not self.profiler.running:
+      self.profiler = createProfiler(self._config)
+    for vehicle in self.vehicles:
+      vehicle._handleSighup()
+    return True # keep the signal handler installed
+
+  def shutdown(self):
+    # a profile running at SIGTERM is still written
+    if self.profiler.running:
+      self.stopProfile()
+    for vehicle in self.vehicles:
+      vehicle.shutdown()
+    self.rateLimiter.flush()
+    if self.history:
+      self.history.close()
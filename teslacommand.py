@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Broker for tesla-control commands.
+# One long-lived executor owns the Unix socket, queues the commands of the D-Bus service and the CLI scripts,
+# runs them one at a time, coalesces a command with an identical one at the end of the queue and answers with a
+# structured JSON result.
+# tesla-control itself has no persistent session mode, so each command is still one tesla-control run - but
+# callers never start competing processes, duplicates are only run once and latency is measured end to end.
+#
+# Protocol: one JSON object per line - {"command": "charging-set-amps", "args": ["12"], "vin": "..."}
+# (vin is optional - without it tesla-control uses TESLA_VIN)
+# Answer:   {"ok": true, "returncode": 0, "stdout": "", "stderr": "", "queued": 0.0, "seconds": 1.2, "coalesced": false}
+#
+# Run standalone with: python teslacommand.py [socket path]
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import subprocess
+
+DEFAULT_SOCKET = '/tmp/tesla-command.sock'
+
+
+def _commandLine(executable, command, args, vin=None):
+  if vin:
+    return [executable, '-vin', vin, command] + list(args)
+  return [executable, command] + list(args)
+
+
+class _PendingCommand:
+  def __init__(self, command, args, vin=None):
+    self.key = (command, tuple(args), vin)
+    self.command = command
+    self.args = list(args)
+    self.vin = vin
+    self.submitted = time.monotonic()
+    self.callers = 1
+    self.started = False
+    self.result = None
+    self.done = threading.Event()
+
+
+class TeslaCommandBroker:
+  def __init__(self, socketPath=DEFAULT_SOCKET, executable='tesla-control', timeout=90, limiter=None, metrics=None):
+    self.socketPath = socketPath
+    self.executable = executable
+    self.timeout = timeout
+    # optional ratelimiter.TeslaRateLimiter shared with the HTTP session - commands take from the same budget
+    self.limiter = limiter
+    # optional metrics.ServiceMetrics - run time and exit code per command
+    self.metrics = metrics
+    self.executed = 0
+    self.coalesced = 0
+    self._queue = []
+    self._lock = threading.Condition()
+    self._socket = None
+
+  def start(self):
+    if self._isRunning():
+      logging.info("tesla-control broker already running on %s" % (self.socketPath))
+      return False
+    if os.path.exists(self.socketPath):
+      os.remove(self.socketPath)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.bind(self.socketPath)
+    self._socket.listen(8)
+
+    threading.Thread(target=self._accept, name='tesla-command-accept', daemon=True).start()
+    threading.Thread(target=self._work, name='tesla-command-worker', daemon=True).start()
+    logging.info("tesla-control broker listening on %s" % (self.socketPath))
+    return True
+
+  def submit(self, command, args=(), vin=None):
+    # returns a _PendingCommand - wait on .done for .result
+    with self._lock:
+      pending = self._queue[-1] if self._queue else None
+      if pending is not None and pending.key == (command, tuple(args), vin) and not pending.started:
+        # identical command still waiting at the end of the queue - answer both callers with one run.
+        # Only the last one: joining an earlier start behind a queued stop would run start, stop for start, stop, start
+        pending.callers += 1
+        self.coalesced += 1
+        return pending
+      pending = _PendingCommand(command, args, vin)
+      self._queue.append(pending)
+      self._lock.notify()
+      return pending
+
+  def run(self, command, args=(), vin=None):
+    pending = self.submit(command, args, vin)
+    pending.done.wait()
+    return dict(pending.result, coalesced=pending.callers > 1)
+
+  def _work(self):
+    while True:
+      with self._lock:
+        while not self._queue:
+          self._lock.wait()
+        pending = self._queue[0]
+        pending.started = True
+
+      pending.result = self._execute(pending)
+
+      with self._lock:
+        self._queue.remove(pending)
+      pending.done.set()
+
+  def _execute(self, pending):
+    started = time.monotonic()
+    if self.limiter:
+      try:
+        self.limiter.acquire('command')
+      except Exception as e:
+        logging.warning("tesla-control %s not sent: %s" % (pending.command, e))
+        return {'ok': False, 'returncode': -1, 'stdout': '', 'stderr': str(e),
+                'queued': started - pending.submitted, 'seconds': 0.0}
+    try:
+      process = subprocess.run(_commandLine(self.executable, pending.command, pending.args, pending.vin),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+      returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+    except subprocess.TimeoutExpired as e:
+      returncode, stdout, stderr = -1, e.stdout or b'', b'timeout after %d seconds' % (self.timeout)
+    except OSError as e:
+      returncode, stdout, stderr = -1, b'', str(e).encode()
+
+    self.executed += 1
+    seconds = time.monotonic() - started
+    logging.info("tesla-control %s %s -> %d in %.1fs" % (pending.command, ' '.join(pending.args), returncode, seconds))
+    if self.metrics:
+      self.metrics.observeCommand(pending.command, returncode, seconds)
+    return {
+      'ok': returncode == 0,
+      'returncode': returncode,
+      'stdout': stdout.decode('utf-8', 'replace'),
+      'stderr': stderr.decode('utf-8', 'replace'),
+      'queued': started - pending.submitted,
+      'seconds': seconds,
+    }
+
+  def _isRunning(self):
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(self.socketPath)
+        return True
+    except OSError:
+      return False
+
+  def _accept(self):
+    while True:
+      connection, address = self._socket.accept()
+      threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+  def _serve(self, connection):
+    with connection:
+      try:
+        request = json.loads(connection.makefile('r').readline())
+        result = self.run(request['command'], [str(arg) for arg in request.get('args', [])], request.get('vin'))
+      except Exception as e:
+        result = {'ok': False, 'returncode': -1, 'stdout': '', 'stderr': 'broker error: %s' % (e)}
+      connection.sendall((json.dumps(result) + '\n').encode())
+
+
+class TeslaCommandClient:
+  def __init__(self, socketPath=DEFAULT_SOCKET, executable='tesla-control', timeout=120):
+    self.socketPath = socketPath
+    self.executable = executable
+    self.timeout = timeout
+
+  def run(self, command, *args, vin=None):
+    # raises subprocess.CalledProcessError like subprocess.run(check=True) did, so callers can inspect e.stderr
+    # - also when the broker does not answer in time or answers garbage
+    # vin: the car to send the command to - defaults to TESLA_VIN
+    args = [str(arg) for arg in args]
+    started = time.monotonic()
+    result = self._viaBroker(command, args, vin)
+    if result is None:
+      result = self._direct(command, args, vin)
+    result['latency'] = time.monotonic() - started
+
+    logging.info("%s %s: %s after %.1fs" % (command, ' '.join(args), 'ok' if result['ok'] else 'failed', result['latency']))
+    if not result['ok']:
+      raise subprocess.CalledProcessError(result['returncode'], _commandLine(self.executable, command, args, vin),
+                                          output=result['stdout'].encode(), stderr=result['stderr'].encode())
+    return result
+
+  def _viaBroker(self, command, args, vin):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+      connection.settimeout(self.timeout)
+      try:
+        connection.connect(self.socketPath)
+        connection.sendall((json.dumps({'command': command, 'args': args, 'vin': vin}) + '\n').encode())
+      except OSError as e:
+        # no broker running (or a stale socket) - the broker has not seen a complete request, so start tesla-control ourselves
+        logging.debug("tesla-control broker on %s not reachable: %s" % (self.socketPath, e))
+        return None
+      try:
+        result = json.loads(connection.makefile('r').readline())
+        if not isinstance(result, dict) or not all(key in result for key in ('ok', 'returncode', 'stdout', 'stderr')):
+          raise ValueError("unexpected answer %r" % (result))
+        return result
+      except (OSError, ValueError) as e:
+        # timeout, broker gone or an empty / partial answer - the broker may still run the command,
+        # so do not start a second tesla-control but fail like a failed run
+        return {'ok': False, 'returncode': -1, 'stdout': '', 'stderr': 'broker error: %s' % (e), 'coalesced': False}
+
+  def _direct(self, command, args, vin):
+    process = subprocess.run(_commandLine(self.executable, command, args, vin), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return {
+      'ok': process.returncode == 0,
+      'returncode': process.returncode,
+      'stdout': process.stdout.decode('utf-8', 'replace'),
+      'stderr': process.stderr.decode('utf-8', 'replace'),
+      'coalesced': False,
+    }
+
+
+def main():
+  logging.basicConfig(format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                      datefmt='%Y-%m-%d %H:%M:%S',
+                      level=logging.INFO)
+  broker = TeslaCommandBroker(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET)
+  broker.start()
+  threading.Event().wait()
+
+if __name__ == "__main__":
+  main()
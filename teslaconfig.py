@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# Cached, validated view of config.ini.
+# The file is parsed once and only re-read when its inode/mtime/size changes or
+# after invalidate() (wired to SIGHUP by the services).
+import os
+import sys
+import time
+import logging
+import configparser # for config/ini file
+
+
+def _int(value):
+  # blank values are treated as 0 like the old _getSignOfLifeInterval() did
+  return int(value) if value and value.strip() else 0
+
+def _phase(value):
+  if value not in ('L1', 'L2', 'L3'):
+    raise ValueError("Phase must be L1, L2 or L3 - got '%s'" % (value))
+  return value
+
+def _position(value):
+  value = int(value)
+  if value not in (0, 1, 2):
+    raise ValueError("Position must be 0, 1 or 2 - got '%s'" % (value))
+  return value
+
+def _inverterPowerSource(value):
+  if value not in ('inotify', 'dbus', 'poll'):
+    raise ValueError("InverterPowerSource must be inotify, dbus or poll - got '%s'" % (value))
+  return value
+
+def _profileMode(value):
+  if value not in ('cprofile', 'sample'):
+    raise ValueError("ProfileMode must be cprofile or sample - got '%s'" % (value))
+  return value
+
+def _pollingPolicy(value):
+  if value not in ('heuristic', 'backoff', 'budget'):
+    raise ValueError("PollingPolicy must be heuristic, backoff or budget - got '%s'" % (value))
+  return value
+
+# name in [DEFAULT]: (converter, default) - a default of None marks a required setting
+SETTINGS = {
+  'AccessType': (str, 'OnPremise'),
+  'SignOfLifeLog': (_int, 0),
+  'Deviceinstance': (int, None),
+  'CustomName': (str, 'TESLACHARGER'),
+  'VehicleId': (str, None),
+  'Phase': (_phase, 'L1'),
+  'Position': (_position, 0),
+  'Token': (str, ''),
+  'RefreshToken': (str, ''),
+  'ApiBaseUrl': (str, 'https://owner-api.teslamotors.com'),
+  'AuthBaseUrl': (str, 'https://auth.tesla.com'),
+  'ConnectTimeout': (float, 5.0),
+  'ReadTimeout': (float, 20.0),
+  'InverterPowerSource': (_inverterPowerSource, 'inotify'),
+  'InverterPowerFile': (str, '/tmp/Inverter.json'),
+  'InverterPowerService': (str, 'com.victronenergy.system'),
+  'InverterPowerPath': (str, '/Dc/Pv/Power'),
+  'VehicleDataEndpoints': (str, 'charge_state;drive_state'),
+  'TelemetryListen': (str, ''),
+  'TelemetryTimeout': (_int, 120),
+  'CommandSocket': (str, '/tmp/tesla-command.sock'),
+  'StartStopDebounce': (float, 2.0),
+  'WakeTimeout': (_int, 60),
+  'CacheDir': (str, '/data/tesla'),
+  'CachePersistInterval': (_int, 900),
+  'PollingPolicy': (_pollingPolicy, 'heuristic'),
+  'DailyRequestBudget': (_int, 0),
+  'AsleepProbeInterval': (_int, 600),
+  'ProbeSkipWindow': (_int, 120),
+  'RateLimitPerHour': (_int, 0),
+  'RateLimitPerDay': (_int, 0),
+  'RateLimitStateFile': (str, '/data/tesla/ratelimit.json'),
+  'SurplusControl': (_int, 0),
+  'SurplusMinAmps': (_int, 5),
+  'SurplusMaxAmps': (_int, 32),
+  'SurplusReserve': (_int, 0),
+  'SurplusHysteresis': (_int, 200),
+  'SurplusSlewRate': (float, 6.0),
+  'SurplusCommandInterval': (_int, 60),
+  'SurplusMaxDataAge': (_int, 600),
+  'PowerEstimate': (_int, 0),
+  'PowerEstimateLoad': (_int, 0),
+  'PowerEstimateDivergence': (_int, 500),
+  'PowerEstimateMinConfidence': (float, 0.5),
+  'PowerEstimateMaxInterval': (_int, 300),
+  'MetricsListen': (str, ''),
+  'ProfileDir': (str, '/data/tesla/profiles'),
+  'ProfileMode': (_profileMode, 'cprofile'),
+  'ProfileDuration': (_int, 60),
+  'HistoryFile': (str, '/data/tesla/history.db'),
+  'HistoryFlushInterval': (_int, 60),
+  'HistoryDownsampleDays': (_int, 30),
+  'HistoryRetentionDays': (_int, 730),
+  'LogMaxBytes': (_int, 1024 * 1024),
+  'LogBackupCount': (_int, 3),
+  'LogBufferDir': (str, ''),
+  'LogFlushInterval': (_int, 300),
+  'TracebackInterval': (_int, 300),
+}
+
+# shared by all vehicles of the account - the per-vehicle settings are only required in a [VEHICLE...] section
+ACCOUNT_SETTINGS = dict((name, setting) for name, setting in SETTINGS.items() if name not in ('Deviceinstance', 'VehicleId'))
+
+# read by teslalog.setupLogging() - also from the config.ini of TokenRefresh, which has none of the other settings
+LOG_SETTINGS = dict((name, setting) for name, setting in SETTINGS.items() if name.startswith('Log') or name == 'TracebackInterval')
+
+# read by the change-tesla-charging-*.py scripts - the broker socket of the D-Bus service
+COMMAND_SETTINGS = dict((name, setting) for name, setting in SETTINGS.items() if name == 'CommandSocket')
+
+
+class TeslaConfig:
+  def __init__(self, path, settings=SETTINGS, section='DEFAULT'):
+    # section: a [VEHICLE...] section - its values override [DEFAULT]
+    self.path = path
+    self.section = section
+    self.reloads = 0
+    self._settings = settings
+    self._parser = None
+    self._stamp = None
+    self._invalidated = False
+    self.refresh()
+
+  def __getitem__(self, section):
+    # keeps config['DEFAULT']['Key'] style lookups working
+    return self._parser[section]
+
+  def invalidate(self):
+    # force the next refresh() to re-read the file even if it looks unchanged
+    self._invalidated = True
+
+  def refresh(self):
+    stamp = self._getStamp()
+    if self._parser is not None and stamp == self._stamp and not self._invalidated:
+      return False
+
+    self._stamp = stamp
+    self._invalidated = False
+
+    parser = configparser.ConfigParser()
+    parser.read(self.path)
+    try:
+      values = self._validate(parser)
+    except ValueError as e:
+      if self._parser is None:
+        raise
+      # keep running with the last good configuration
+      logging.error("Ignoring invalid %s: %s" % (self.path, e))
+      return False
+
+    self._parser = parser
+    self.__dict__.update(values)
+    self.reloads += 1
+    if self.reloads > 1:
+      logging.info("Reloaded %s" % (self.path))
+    return True
+
+  def get(self, key, fallback=None, section='DEFAULT'):
+    return self._parser.get(section, key, fallback=fallback)
+
+  def vehicleSections(self):
+    # one [VEHICLE...] section per car - empty for the single-car layout with everything in [DEFAULT]
+    return [section for section in self._parser.sections() if section.upper().startswith('VEHICLE')]
+
+  def _getStamp(self):
+    try:
+      stat = os.stat(self.path)
+      return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      return None
+
+  def _validate(self, parser):
+    values = {}
+    if not parser.has_section(self.section) and self.section != 'DEFAULT':
+      raise ValueError("Missing section [%s]" % (self.section))
+    section = parser[self.section]
+    for name, (convert, default) in self._settings.items():
+      raw = section.get(name)
+      if raw is None:
+        if default is None:
+          raise ValueError("Missing required setting %s in [%s]" % (name, self.section))
+        values[name] = default
+        continue
+      try:
+        values[name] = convert(raw.strip())
+      except ValueError as e:
+        raise ValueError("Invalid value for %s: %s" % (name, e))
+    return values
+
+
+def main():
+  # microbenchmark: cost per _update() tick of re-parsing vs. the cached object
+  path = sys.argv[1] if len(sys.argv) > 1 else "%s/config.ini" % (os.path.dirname(os.path.realpath(__file__)))
+  rounds = 10000
+
+  start = time.perf_counter()
+  for _ in range(rounds):
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    parser['DEFAULT']['Phase']
+  parsed = (time.perf_counter() - start) / rounds
+
+  config = TeslaConfig(path)
+  start = time.perf_counter()
+  for _ in range(rounds):
+    config.refresh()
+    config.Phase
+  cached = (time.perf_counter() - start) / rounds
+
+  print("re-parse per tick: %.1f us" % (parsed * 1e6))
+  print("cached per tick:   %.1f us (%.0fx faster)" % (cached * 1e6, parsed / cached))
+
+if __name__ == "__main__":
+  main()
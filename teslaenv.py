@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Environment for tesla-control, shared by the D-Bus service and the change-tesla-charging-*.py scripts.
+# config.json is read once per process, and the path of the tesla-control binary is resolved once and cached
+# in config.json (TESLA_CONTROL). The Go toolchain is only started (`go env GOPATH`) when the binary is found
+# nowhere else, and never again after that.
+#
+# Print the resolved path: python teslaenv.py [directory of config.json]
+import os
+import sys
+import json
+import shutil
+import logging
+import subprocess
+
+GO = '/data/usr/local/go/bin/go'
+EXTRA_PATH = ['/usr/local/bin', '/usr/bin', '/bin', '/data/usr/local/go/bin']
+
+# config.json per directory - loaded once
+_configs = {}
+
+
+def loadConfigJson(directory):
+  path = os.path.join(directory, 'config.json')
+  if path not in _configs:
+    with open(path, 'r') as file:
+      _configs[path] = json.load(file)
+  return _configs[path]
+
+
+def setupEnvironment(directory):
+  # TESLA_* variables for tesla-control - returns the full path of the binary
+  config = loadConfigJson(directory)
+  os.environ['PATH'] += os.pathsep + os.pathsep.join(EXTRA_PATH)
+  os.environ['TESLA_VIN'] = config['VIN']
+  os.environ['TESLA_KEY_NAME'] = 'Tessy'
+  os.environ['TESLA_KEY_FILE'] = '/data/tesla/private.pem'
+  os.environ['TESLA_TOKEN_FILE'] = '/data/tesla/token.txt'
+  return findTeslaControl(directory)
+
+
+def findTeslaControl(directory):
+  config = loadConfigJson(directory)
+  cached = config.get('TESLA_CONTROL')
+  if cached and os.access(cached, os.X_OK):
+    return cached
+
+  executable = _searchTeslaControl()
+  if executable is None:
+    # tesla-control is still looked up on PATH when a command runs
+    logging.warning("tesla-control not found - commands will fail until it is installed")
+    return 'tesla-control'
+
+  logging.info("Found tesla-control at %s" % (executable))
+  config['TESLA_CONTROL'] = executable
+  _saveConfigJson(directory, config)
+  return executable
+
+
+def _searchTeslaControl():
+  # cheap places first - `go install` puts the binary in $GOPATH/bin, which defaults to ~/go/bin
+  directories = list(EXTRA_PATH)
+  if os.environ.get('GOPATH'):
+    directories.append(os.path.join(os.environ['GOPATH'], 'bin'))
+  directories.append(os.path.join(os.path.expanduser('~'), 'go', 'bin'))
+  directories.append('/data/go/bin')
+
+  path = os.pathsep.join([os.environ.get('PATH', '')] + directories)
+  executable = shutil.which('tesla-control', path=path)
+  if executable:
+    return executable
+
+  # last resort - a non-default GOPATH only the Go toolchain knows about
+  try:
+    gopath = subprocess.check_output([GO, 'env', 'GOPATH'], timeout=30).decode().strip()
+  except (OSError, subprocess.SubprocessError) as e:
+    logging.warning("Could not run %s env GOPATH: %s" % (GO, e))
+    return None
+  return shutil.which('tesla-control', path=os.pathsep.join(os.path.join(p, 'bin') for p in gopath.split(os.pathsep)))
+
+
+def _saveConfigJson(directory, config):
+  path = os.path.join(directory, 'config.json')
+  temp_path = "%s.tmp" % (path)
+  try:
+    with open(temp_path, 'w') as file:
+      json.dump(config, file, indent=4)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(temp_path, path)
+  except OSError as e:
+    # not fatal - the next start searches again
+    logging.warning("Could not cache the tesla-control path in %s: %s" % (path, e))
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  directory = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.realpath(__file__))
+  print(findTeslaControl(directory))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,126 @@
+# Error taxonomy for Tesla API failures.
+# Every failure is mapped to one class with its own recovery in the service (see _handleUpdateError):
+# only an auth failure drops the token, a rate limit waits for Retry-After, network errors retry soon and
+# data errors are logged without touching the token endpoint.
+import sys
+import time
+
+# error classes - also the PollContext.error values
+AUTH = 'auth'                   # 401 / rejected refresh token
+RATE_LIMITED = 'rate_limited'   # 429
+ASLEEP = 'asleep'               # 408 - vehicle asleep or offline
+NETWORK = 'network'             # connect/read timeout, connection error, 5xx
+DATA = 'data'                   # unexpected or missing fields in a response
+NO_POWER = 'no_power'           # the charger has no power
+OTHER = 'other'
+
+KINDS = [AUTH, RATE_LIMITED, ASLEEP, NETWORK, DATA, NO_POWER, OTHER]
+
+
+class TeslaAPIError(Exception):
+  kind = OTHER
+
+  def __init__(self, message, status=None, retryAfter=None):
+    super().__init__(message)
+    self.status = status
+    self.retryAfter = retryAfter    # seconds, from the Retry-After header
+
+
+class AuthError(TeslaAPIError):
+  kind = AUTH
+
+
+class RateLimitedError(TeslaAPIError):
+  kind = RATE_LIMITED
+
+
+class VehicleAsleepError(TeslaAPIError):
+  kind = ASLEEP
+
+
+class NetworkError(TeslaAPIError):
+  kind = NETWORK
+
+
+class DataError(TeslaAPIError):
+  kind = DATA
+
+
+class NoPowerError(TeslaAPIError):
+  kind = NO_POWER
+
+
+def parseRetryAfter(value):
+  # Retry-After is either delay-seconds or an HTTP date
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    import email.utils # only needed for the rare HTTP-date form
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+def raiseForStatus(response):
+  # like response.raise_for_status(), but with the error class in the exception type
+  status = response.status_code
+  if status < 400:
+    return
+
+  message = "%d %s for url: %s" % (status, response.reason, response.url)
+  retryAfter = parseRetryAfter(response.headers.get('Retry-After'))
+  if status == 401:
+    raise AuthError(message, status)
+  if status == 408:
+    raise VehicleAsleepError(message, status)
+  if status == 429:
+    raise RateLimitedError(message, status, retryAfter)
+  if status >= 500:
+    raise NetworkError(message, status, retryAfter)
+  raise TeslaAPIError(message, status)
+
+
+def classifyError(e):
+  if isinstance(e, TeslaAPIError):
+    return e.kind
+  # requests is imported lazily by teslahttp - none of its exceptions can exist before that
+  requests = sys.modules.get('requests')
+  if requests and isinstance(e, (requests.Timeout, requests.ConnectionError)):
+    return NETWORK
+  if isinstance(e, (KeyError, IndexError, TypeError, ValueError)):
+    # includes JSON decode errors
+    return DATA
+  if isinstance(e, OSError):
+    return NETWORK
+  return OTHER
+
+
+def getRetryAfter(e):
+  return getattr(e, 'retryAfter', None)
+
+
+class ErrorCounters:
+  # failures per error class since start
+  def __init__(self):
+    self.counts = dict((kind, 0) for kind in KINDS)
+    self.last = None
+    self.lastTime = None
+    # consecutive failures of the class `last` - a night of asleep results must not count towards the auth backoff
+    self.run = 0
+
+  def record(self, kind):
+    self.counts[kind] = self.counts.get(kind, 0) + 1
+    self.run = self.run + 1 if kind == self.last and self.run else 1
+    self.last = kind
+    self.lastTime = time.time()
+
+  def resetRun(self):
+    # a successful request (or SIGHUP) ends the run
+    self.run = 0
+
+  def __str__(self):
+    return ', '.join("%s: %d" % (kind, count) for kind, count in self.counts.items() if count) or 'none'
@@ -0,0 +1,157 @@
+# Shared, pooled HTTP session for the Tesla endpoints.
+# Keeps TCP/TLS connections to owner-api.teslamotors.com and auth.tesla.com alive
+# between polls and records how long each request spent connecting, in the TLS
+# handshake and transferring data.
+# requests/urllib3 are only imported when the first request is sent, so they do not slow down the service start.
+import time
+import logging
+import threading
+
+# the timing record of the request running on this thread
+_current = threading.local()
+
+# the timed urllib3/requests classes - defined on first use by _timedAdapterClass()
+_adapterClass = None
+
+
+class RequestTiming:
+  def __init__(self, method, url):
+    self.method = method
+    self.url = url
+    self.status = None
+    self.reused = True     # False when a new connection had to be opened
+    self.connect = 0.0     # DNS lookup + TCP connect
+    self.tls = 0.0         # TLS handshake
+    self.transfer = 0.0    # request sent until body read
+    self.total = 0.0
+
+  def __str__(self):
+    return "%s %s -> %s in %.0fms (connect %.0fms, tls %.0fms, transfer %.0fms, %s connection)" % (
+      self.method, self.url, self.status, self.total * 1000, self.connect * 1000, self.tls * 1000,
+      self.transfer * 1000, 'reused' if self.reused else 'new')
+
+
+def _timedAdapterClass():
+  global _adapterClass
+  if _adapterClass is not None:
+    return _adapterClass
+
+  from requests.adapters import HTTPAdapter
+  from urllib3.connection import HTTPSConnection
+  from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+  class _TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+      start = time.monotonic()
+      sock = super()._new_conn()
+      self._connectSeconds = time.monotonic() - start
+      return sock
+
+    def connect(self):
+      start = time.monotonic()
+      self._connectSeconds = 0.0
+      super().connect()
+      timing = getattr(_current, 'timing', None)
+      if timing:
+        timing.reused = False
+        timing.connect += self._connectSeconds
+        timing.tls += time.monotonic() - start - self._connectSeconds
+
+  class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+  class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+      super().init_poolmanager(*args, **kwargs)
+      self.poolmanager.pool_classes_by_scheme = {'http': HTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+  _adapterClass = _TimedHTTPAdapter
+  return _adapterClass
+
+
+def _retry(retries):
+  # only idempotent GETs are retried - token refreshes and commands are not
+  from urllib3.util.retry import Retry
+  kwargs = dict(total=retries, connect=retries, read=retries, backoff_factor=1,
+                status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+  try:
+    return Retry(allowed_methods=frozenset(['GET']), **kwargs)
+  except TypeError:
+    # urllib3 < 1.26
+    return Retry(method_whitelist=frozenset(['GET']), **kwargs)
+
+
+class TeslaHttpSession:
+  def __init__(self, timeout=(5, 20), retries=2, pool_connections=2, pool_maxsize=2, history=50, limiter=None, metrics=None):
+    self.timeout = timeout
+    # optional ratelimiter.TeslaRateLimiter - every request takes from its budget and reports the headers back
+    self.limiter = limiter
+    # optional metrics.ServiceMetrics - latency per endpoint and status
+    self.metrics = metrics
+    self.timings = []
+    self._history = history
+    self._retries = retries
+    self._poolConnections = pool_connections
+    self._poolMaxsize = pool_maxsize
+    # created by the first request (on the worker thread) - see _getSession()
+    self._session = None
+    self._sessionLock = threading.Lock()
+
+  def _getSession(self):
+    with self._sessionLock:
+      if self._session is None:
+        import requests
+        session = requests.Session()
+        session.headers.update({
+          'Accept-Encoding': 'gzip, deflate',
+          'Connection': 'keep-alive',
+        })
+        adapter = _timedAdapterClass()(pool_connections=self._poolConnections, pool_maxsize=self._poolMaxsize,
+                                       max_retries=_retry(self._retries))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self._session = session
+      return self._session
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def request(self, method, url, **kwargs):
+    kwargs.setdefault('timeout', self.timeout)
+    if self.limiter:
+      # raises ratelimiter.RateLimitExceeded without sending anything
+      self.limiter.acquire('token' if '/oauth2/' in url else 'api')
+
+    timing = RequestTiming(method, url.split('?')[0])
+    _current.timing = timing
+    start = time.monotonic()
+    try:
+      response = self._getSession().request(method, url, **kwargs)
+      response.content # read the body so transfer time is included
+      timing.status = response.status_code
+      if self.limiter:
+        self.limiter.observe(response)
+      return response
+    finally:
+      _current.timing = None
+      timing.total = time.monotonic() - start
+      timing.transfer = max(0.0, timing.total - timing.connect - timing.tls)
+      self._record(timing)
+
+  def lastTiming(self):
+    return self.timings[-1] if self.timings else None
+
+  def close(self):
+    if self._session is not None:
+      self._session.close()
+
+  def _record(self, timing):
+    logging.debug(str(timing))
+    if self.metrics:
+      self.metrics.observeRequest(timing)
+    self.timings.append(timing)
+    if len(self.timings) > self._history:
+      del self.timings[0]
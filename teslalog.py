@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+# Logging setup shared by the D-Bus service, TokenRefresh and the change-tesla-charging-*.py scripts.
+# The calling thread only puts the record on a queue; formatting (including tracebacks) and file I/O happen on the
+# listener thread, so a slow SD card never stalls the GLib main loop.
+#  - the log file is rotated by size (LogMaxBytes, LogBackupCount)
+#  - a traceback that repeats within TracebackInterval seconds is logged as one line with a repeat count
+#  - with LogBufferDir (e.g. /run or /var/volatile) the file is written to tmpfs and appended to the real log every
+#    LogFlushInterval seconds, on shutdown and on the next start after a crash
+#
+# Benchmark of the time a log call takes on the calling thread: python teslalog.py [log file]
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import tempfile
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from teslaconfig import TeslaConfig, LOG_SETTINGS
+
+FORMAT = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s'
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+
+class _QueueHandler(QueueHandler):
+  def prepare(self, record):
+    # the stock prepare() formats the traceback on the calling thread - only resolve the message here and
+    # leave exc_info to the formatter on the listener thread (the record is not shared, the queue is the only handler)
+    record.msg = record.getMessage()
+    record.args = None
+    return record
+
+
+class TracebackFilter(logging.Filter):
+  def __init__(self, interval=300):
+    super().__init__()
+    self.interval = interval
+    self._seen = {}   # key: [time.monotonic() of the last full traceback, repeats since]
+    self._lock = threading.Lock()
+
+  def filter(self, record):
+    if not record.exc_info or not record.exc_info[1] or self.interval <= 0:
+      return True
+
+    key = self._key(record)
+    now = time.monotonic()
+    with self._lock:
+      seen = self._seen.get(key)
+      if seen is None or now - seen[0] >= self.interval:
+        repeats = seen[1] if seen else 0
+        self._seen[key] = [now, 0]
+        if repeats:
+          record.msg = "%s (repeated %d times without traceback)" % (record.getMessage(), repeats)
+          record.args = None
+        return True
+      seen[1] += 1
+
+    # same traceback as a moment ago - keep the line, drop the stack
+    error = record.exc_info[1]
+    record.msg = "%s - %s: %s (traceback suppressed, repeat %d)" % (record.getMessage(), type(error).__name__, error, seen[1])
+    record.args = None
+    record.exc_info = None
+    record.exc_text = None
+    return True
+
+  def _key(self, record):
+    # same message, exception type and raising line - the exception text may contain ids or timestamps
+    error = record.exc_info[1]
+    tb = record.exc_info[2]
+    while tb is not None and tb.tb_next is not None:
+      tb = tb.tb_next
+    where = (tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb is not None else None
+    return (record.getMessage(), type(error), where)
+
+
+class BufferedFileHandler(logging.Handler):
+  # writes to a file on tmpfs and appends it to the (rotated) log file on the SD card every flushInterval seconds
+  def __init__(self, path, bufferDir, flushInterval=300, maxBytes=0, backupCount=0):
+    super().__init__()
+    self.path = path
+    self.bufferPath = os.path.join(bufferDir, "%s.buffer" % (os.path.basename(path)))
+    self.flushInterval = flushInterval
+    self._target = RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+    self._lastFlush = time.monotonic()
+    os.makedirs(bufferDir, exist_ok=True)
+    # left over from a crash - keep it
+    self._persist()
+    self._buffer = open(self.bufferPath, 'a')
+
+  def emit(self, record):
+    try:
+      self._buffer.write(self.format(record) + '\n')
+      self._buffer.flush()
+      if time.monotonic() - self._lastFlush >= self.flushInterval:
+        self.flush()
+    except Exception:
+      self.handleError(record)
+
+  def flush(self):
+    self.acquire()
+    try:
+      if getattr(self, '_buffer', None) is None:
+        return
+      self._buffer.close()
+      self._persist()
+      self._buffer = open(self.bufferPath, 'a')
+      self._lastFlush = time.monotonic()
+    finally:
+      self.release()
+
+  def close(self):
+    self.acquire()
+    try:
+      if getattr(self, '_buffer', None) is not None:
+        self._buffer.close()
+        self._buffer = None
+        self._persist()
+      self._target.close()
+    finally:
+      self.release()
+    super().close()
+
+  def _persist(self):
+    try:
+      with open(self.bufferPath, 'r') as file:
+        data = file.read()
+    except FileNotFoundError:
+      return
+    if data:
+      target = self._target
+      if target.stream is None:
+        target.stream = target._open()
+      if target.maxBytes > 0 and target.stream.tell() > 0 and target.stream.tell() + len(data) > target.maxBytes:
+        target.doRollover()
+        if target.stream is None:
+          # delay=True leaves the new file closed
+          target.stream = target._open()
+      target.stream.write(data)
+      target.stream.flush()
+    os.remove(self.bufferPath)
+
+
+class LogPipeline:
+  def __init__(self, listener, handlers):
+    self.listener = listener
+    self.handlers = handlers
+
+  def flush(self):
+    for handler in self.handlers:
+      handler.flush()
+
+  def stop(self):
+    # drains the queue, then closes the files (and writes the tmpfs buffer to the SD card)
+    if self.listener is None:
+      return
+    self.listener.stop()
+    self.listener = None
+    for handler in self.handlers:
+      handler.close()
+
+
+def setupLogging(logPath, configPath=None, level=logging.INFO, console=True):
+  # configPath: config.ini with the Log* settings in [DEFAULT] - missing file or settings use the defaults
+  config = TeslaConfig(configPath, LOG_SETTINGS) if configPath else None
+  maxBytes = config.LogMaxBytes if config else LOG_SETTINGS['LogMaxBytes'][1]
+  backupCount = config.LogBackupCount if config else LOG_SETTINGS['LogBackupCount'][1]
+  bufferDir = config.LogBufferDir if config else LOG_SETTINGS['LogBufferDir'][1]
+  flushInterval = config.LogFlushInterval if config else LOG_SETTINGS['LogFlushInterval'][1]
+  tracebackInterval = config.TracebackInterval if config else LOG_SETTINGS['TracebackInterval'][1]
+
+  formatter = logging.Formatter(FORMAT, datefmt=DATEFMT)
+  if bufferDir:
+    fileHandler = BufferedFileHandler(logPath, bufferDir, flushInterval, maxBytes, backupCount)
+  else:
+    fileHandler = RotatingFileHandler(logPath, maxBytes=maxBytes, backupCount=backupCount)
+  handlers = [fileHandler]
+  if console:
+    handlers.append(logging.StreamHandler())
+  for handler in handlers:
+    handler.setFormatter(formatter)
+
+  listener = QueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+  queueHandler = _QueueHandler(listener.queue)
+  queueHandler.addFilter(TracebackFilter(tracebackInterval))
+
+  root = logging.getLogger()
+  for handler in list(root.handlers):
+    root.removeHandler(handler)
+  root.addHandler(queueHandler)
+  root.setLevel(level)
+
+  listener.start()
+  pipeline = LogPipeline(listener, handlers)
+  # the CLI scripts simply return from main()
+  atexit.register(pipeline.stop)
+  return pipeline
+
+
+def _timeCalls(rounds):
+  # one info line and, every 50th call, an error with traceback like the _update except branch
+  latencies = []
+  for index in range(rounds):
+    start = time.perf_counter()
+    if index % 50:
+      logging.info("Last Get Tesla Data: %s - Wait in Seconds: %d", index, 30)
+    else:
+      try:
+        raise ConnectionError("No response from TeslaAPI")
+      except ConnectionError as e:
+        logging.critical('Error at %s', '_update', exc_info=e)
+    latencies.append(time.perf_counter() - start)
+  latencies.sort()
+  return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1]
+
+
+def main():
+  # time a log call takes on the calling thread: direct FileHandler vs. the queue
+  path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.mkdtemp(), 'bench.log')
+  rounds = 20000
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+
+  handler = logging.FileHandler(path)
+  handler.setFormatter(logging.Formatter(FORMAT, datefmt=DATEFMT))
+  root.addHandler(handler)
+  direct = _timeCalls(rounds)
+  root.removeHandler(handler)
+  handler.close()
+
+  pipeline = setupLogging(path, console=False)
+  queued = _timeCalls(rounds)
+  pipeline.stop()
+
+  print("                 p50        p99        max")
+  print("FileHandler  %7.1f us %7.1f us %7.1f us" % tuple(value * 1e6 for value in direct))
+  print("queued       %7.1f us %7.1f us %7.1f us" % tuple(value * 1e6 for value in queued))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Streaming telemetry ingestion.
+# Listens on a local TCP port for Fleet Telemetry records (one JSON record per line, as written by the
+# fleet-telemetry JSON dispatchers) and hands the decoded charge/drive fields to the service on the GLib
+# main loop as they arrive. The service falls back to polling vehicle_data when the stream goes quiet.
+#
+# Record format: {"vin": "...", "createdAt": "...", "data": [{"key": "ACChargingPower", "value": {"doubleValue": 7.2}}, ...]}
+#
+# Stand-in sender for testing - replays recorded records with their original spacing:
+#   python teslastream.py frames.jsonl 127.0.0.1:4443 [speedup]
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+from datetime import datetime
+if sys.version_info.major == 2:
+    import gobject
+else:
+    from gi.repository import GLib as gobject
+
+# Fleet Telemetry field: (vehicle_data section, key, converter)
+FIELDS = {
+  'ACChargingPower': ('charge_state', 'charger_power', float),
+  'ChargeAmps': ('charge_state', 'charger_actual_current', float),
+  'ChargerVoltage': ('charge_state', 'charger_voltage', float),
+  'ChargeCurrentRequestMax': ('charge_state', 'charge_current_request_max', float),
+  'ACChargingEnergyIn': ('charge_state', 'charge_energy_added', float),
+  'Soc': ('charge_state', 'battery_level', float),
+  'DetailedChargeState': ('charge_state', 'charging_state', lambda v: str(v).replace('DetailedChargeState', '')),
+  'ChargePortLatch': ('charge_state', 'charge_port_latch', lambda v: str(v).replace('ChargePortLatch', '')),
+  'VehicleSpeed': ('drive_state', 'speed', float),
+  'Gear': ('drive_state', 'shift_state', lambda v: None if str(v) in ('', 'ShiftStateP', 'ShiftStateInvalid') else str(v).replace('ShiftState', '')),
+}
+
+
+def decodeValue(value):
+  # {"doubleValue": 7.2} / {"stringValue": "..."} / {"invalid": true}
+  if not isinstance(value, dict):
+    return value
+  if value.get('invalid'):
+    return None
+  for item in value.values():
+    return item
+  return None
+
+
+def decodeRecord(record, vin=None):
+  # returns {section: {key: value}} with the fields we know, or None if the record is for another car
+  if vin and record.get('vin') and record['vin'] != vin:
+    return None
+
+  changes = {}
+  for datum in record.get('data', []):
+    field = FIELDS.get(datum.get('key'))
+    if not field:
+      continue
+    section, key, convert = field
+    value = decodeValue(datum.get('value'))
+    if value is None:
+      continue
+    try:
+      changes.setdefault(section, {})[key] = convert(value)
+    except (TypeError, ValueError):
+      logging.warning("Ignoring telemetry %s=%r" % (datum.get('key'), value))
+  return changes
+
+
+class TelemetryReceiver:
+  def __init__(self, listen, callback, vin=None, timeout=120):
+    host, port = listen.rsplit(':', 1)
+    self.address = (host, int(port))
+    self.vin = vin
+    self.timeout = timeout
+    self.records = 0
+    # callback(changes, vin)
+    self._callback = callback
+    self._lastRecords = {}    # vin: time.monotonic() of its last record
+    self._socket = None
+
+  def start(self):
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind(self.address)
+    self._socket.listen(4)
+    threading.Thread(target=self._accept, name='telemetry-accept', daemon=True).start()
+    logging.info("Listening for telemetry on %s:%d" % self.address)
+
+  def isLive(self, vin=None):
+    return self.staleIn(vin) > 0
+
+  def staleIn(self, vin=None):
+    # seconds until the stream of `vin` (or of any car) counts as dropped
+    if vin is None:
+      lastRecord = max(self._lastRecords.values()) if self._lastRecords else None
+    else:
+      lastRecord = self._lastRecords.get(vin)
+    if lastRecord is None:
+      return 0.0
+    return max(0.0, lastRecord + self.timeout - time.monotonic())
+
+  def _accept(self):
+    while True:
+      connection, address = self._socket.accept()
+      logging.info("Telemetry connected from %s:%d" % address)
+      threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+  def _read(self, connection):
+    with connection, connection.makefile('r') as lines:
+      for line in lines:
+        if not line.strip():
+          continue
+        try:
+          record = json.loads(line)
+          changes = decodeRecord(record, self.vin)
+        except ValueError as e:
+          logging.warning("Ignoring malformed telemetry record: %s" % (e))
+          continue
+        if changes:
+          gobject.idle_add(self._deliver, changes, record.get('vin'))
+    logging.info("Telemetry connection closed")
+
+  def _deliver(self, changes, vin):
+    self._lastRecords[vin] = time.monotonic()
+    self.records += 1
+    self._callback(changes, vin)
+    return False
+
+
+def main():
+  # stand-in sender: replay recorded records to a receiver
+  path, listen = sys.argv[1], sys.argv[2]
+  speedup = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+  host, port = listen.rsplit(':', 1)
+
+  with open(path, 'r') as file:
+    records = [json.loads(line) for line in file if line.strip()]
+
+  with socket.create_connection((host, int(port))) as connection:
+    previous = None
+    for record in records:
+      created = record.get('createdAt')
+      if created and previous:
+        delay = (datetime.fromisoformat(created.replace('Z', '+00:00')) - previous).total_seconds() / speedup
+        time.sleep(max(0.0, delay))
+      if created:
+        previous = datetime.fromisoformat(created.replace('Z', '+00:00'))
+      connection.sendall((json.dumps(record) + '\n').encode())
+      print("sent %s" % (created or ''))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,196 @@
+# Token manager shared by the D-Bus service, the TokenRefresh service and the CLI scripts.
+# Keeps the access token and its expiry in memory, refreshes before it expires and serialises refreshes across
+# processes with a file lock - a process that waited for the lock picks up the token the other one just wrote
+# instead of refreshing again. token.txt (read by tesla-control) is replaced atomically.
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+import teslaerrors
+
+AUTH_URL = 'https://auth.tesla.com'
+EXPIRE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _writeAtomic(path, content):
+  temp_path = "%s.tmp" % (path)
+  with open(temp_path, 'w') as file:
+    file.write(content)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(temp_path, path)
+
+
+class TokenManager:
+  def __init__(self, clientId, scope, refreshToken=None, directory=None, session=None, authUrl=AUTH_URL,
+               jsonBody=False, margin=300):
+    # directory: keeps authtoken.txt (refresh token), token.txt and tokenexpire.txt there - otherwise memory only
+    self.clientId = clientId
+    self.scope = scope
+    self.directory = directory
+    self.authUrl = authUrl
+    self.margin = margin
+    self.refreshes = 0
+    self._refreshToken = refreshToken
+    self._session = session
+    self._jsonBody = jsonBody
+    self._token = None
+    self._expires = 0.0
+    self._stamp = None
+    self._lock = threading.Lock()
+
+    if directory:
+      self.authtokenPath = os.path.join(directory, 'authtoken.txt')
+      self.tokenPath = os.path.join(directory, 'token.txt')
+      self.expirePath = os.path.join(directory, 'tokenexpire.txt')
+      self.lockPath = os.path.join(directory, 'token.lock')
+
+  def getToken(self):
+    # a valid access token - refreshed first if it expires within `margin` seconds
+    with self._lock:
+      self._reload()
+      if self._token and self.expiresIn() > self.margin:
+        return self._token
+      return self._refresh(force=False)
+
+  def isExpired(self):
+    with self._lock:
+      self._reload()
+      return not self._token or self.expiresIn() <= 0
+
+  def expiresIn(self):
+    return self._expires - time.time()
+
+  def invalidate(self):
+    with self._lock:
+      self._token = None
+      self._expires = 0.0
+
+  def refresh(self, force=True):
+    # force: the token was rejected - refresh even if it looks valid, unless another process just replaced it
+    with self._lock:
+      self._reload()
+      return self._refresh(force)
+
+  def _refresh(self, force):
+    stamp = self._stamp
+    lock = self._lockFile()
+    try:
+      # someone else may have refreshed while we waited for the lock
+      self._reload()
+      if self._token and self.expiresIn() > self.margin and (not force or self._stamp != stamp):
+        return self._token
+      return self._requestToken()
+    finally:
+      if lock:
+        lock.close()
+
+  def _requestToken(self):
+    refreshToken = self._readRefreshToken()
+    url = '%s/oauth2/v3/token' % (self.authUrl)
+    data = {
+      'grant_type': 'refresh_token',
+      'client_id': self.clientId,
+      'refresh_token': refreshToken,
+    }
+
+    if self._jsonBody:
+      data['scope'] = self.scope
+      response = self._post(url, data=json.dumps(data), headers={'Content-Type': 'application/json'})
+    else:
+      data['scopes'] = self.scope
+      response = self._post(url, data=data, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+    # a rejected refresh token is an auth failure, not a network problem
+    if response.status_code in (400, 401):
+      raise teslaerrors.AuthError("Token refresh rejected - %s (%d)" % (url, response.status_code), response.status_code)
+    teslaerrors.raiseForStatus(response)
+    response_data = response.json()
+
+    auth_token = response_data.get('access_token', '')
+    expires_in = response_data.get('expires_in', 0)
+    if not auth_token:
+      raise teslaerrors.DataError("Token response does not contain an access token")
+
+    self.refreshes += 1
+    self._token = auth_token
+    # same safety margin the token files always had
+    self._expires = time.time() + (expires_in - 1000)
+
+    if 'refresh_token' in response_data:
+      self._refreshToken = response_data['refresh_token']
+
+    if self.directory:
+      if 'refresh_token' in response_data:
+        _writeAtomic(self.authtokenPath, json.dumps(response_data, indent=4))
+      _writeAtomic(self.tokenPath, auth_token)
+      _writeAtomic(self.expirePath, time.strftime(EXPIRE_FORMAT, time.localtime(self._expires)))
+      self._stamp = self._getStamp()
+      logging.info("New auth token saved to %s" % (self.tokenPath))
+    else:
+      logging.info("New access token received")
+
+    return self._token
+
+  def _post(self, url, **kwargs):
+    if self._session:
+      return self._session.post(url, **kwargs)
+    import requests # only needed by processes without a shared session
+    return requests.post(url, timeout=(5, 20), **kwargs)
+
+  def _readRefreshToken(self):
+    if self.directory:
+      with open(self.authtokenPath, 'r') as file:
+        return json.load(file)['refresh_token']
+    return self._refreshToken
+
+  def _lockFile(self):
+    if not self.directory:
+      return None
+    lock = open(self.lockPath, 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+  def _getStamp(self):
+    try:
+      tokenStat = os.stat(self.tokenPath)
+      expireStat = os.stat(self.expirePath)
+      return (tokenStat.st_ino, tokenStat.st_mtime_ns, expireStat.st_ino, expireStat.st_mtime_ns)
+    except OSError:
+      return None
+
+  def _reload(self):
+    # pick up a token written by another process - only re-reads the files when they changed
+    if not self.directory:
+      return
+    stamp = self._getStamp()
+    if stamp == self._stamp:
+      return
+    self._stamp = stamp
+    if stamp is None:
+      self._token = None
+      self._expires = 0.0
+      return
+    try:
+      with open(self.tokenPath, 'r') as file:
+        self._token = file.read().strip()
+      with open(self.expirePath, 'r') as file:
+        self._expires = time.mktime(time.strptime(file.read().strip(), EXPIRE_FORMAT))
+    except (OSError, ValueError) as e:
+      logging.warning("Could not read saved token: %s" % (e))
+      self._token = None
+      self._expires = 0.0
+
+
+def teslaControlTokens(directory, clientId, session=None, authUrl=AUTH_URL):
+  # Fleet API token used by tesla-control (token.txt)
+  return TokenManager(clientId, 'user_data vehicle_device_data vehicle_cmds vehicle_charging_cmds',
+                      directory=directory, session=session, authUrl=authUrl)
+
+
+def ownerApiTokens(refreshToken, session=None, authUrl=AUTH_URL):
+  # owner-api token for vehicle_data, from the RefreshToken in config.ini - kept in memory only
+  return TokenManager('ownerapi', 'openid email offline_access', refreshToken=refreshToken,
+                      session=session, authUrl=authUrl, jsonBody=True)
@@ -0,0 +1,83 @@
+# The GLib main loop keeps its 500 ms cadence while the Tesla API stalls.
+# Runs the real service against the Replay stub server with every vehicle_data answer held back STALL seconds and
+# records a 500 ms GLib timeout meanwhile. Needs PyGObject (gi) and requests like Replay/replay.py - takes ~STALL seconds.
+#
+# python -m pytest tests/test_nonblocking.py
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import importlib.util
+import threading
+import unittest
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..', 'Replay'))
+
+try:
+  from gi.repository import GLib
+except ImportError:
+  GLib = None
+
+STALL = 30      # seconds every vehicle_data answer is held back
+TICK = 0.5      # the main loop cadence that has to hold
+SLACK = 0.25    # seconds a tick may be late
+
+
+@unittest.skipIf(GLib is None or importlib.util.find_spec('requests') is None, 'needs PyGObject and requests')
+class NonBlockingFetchTest(unittest.TestCase):
+  def testTickCadenceDuringStall(self):
+    import replay
+    logging.basicConfig(level=logging.WARNING)
+    args = replay.parseArgs(['--delay', str(STALL)])
+    with open(args.recording, 'r') as file:
+      samples = [json.loads(line) for line in file if line.strip()]
+
+    vehicleId = 'stall-%d' % (os.getpid())
+    server = replay.ReplayServer(samples, [vehicleId], STALL)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    module = replay.loadService()
+    mainloop = GLib.MainLoop()
+    ticks = []
+    fetched = []
+
+    with tempfile.TemporaryDirectory() as directory:
+      service = module.DbusTeslaAPIService(configPath=replay.writeConfig(directory, server.server_address[1], args, [vehicleId]))
+      processTeslaAPIData = service._onTeslaAPIData
+
+      def onTeslaAPIData(future):
+        fetched.append(time.monotonic())
+        processTeslaAPIData(future)
+        mainloop.quit()
+        return False
+
+      def tick():
+        ticks.append(time.monotonic())
+        return True
+
+      service._onTeslaAPIData = onTeslaAPIData
+      GLib.timeout_add(int(TICK * 1000), tick)
+      GLib.timeout_add(int((STALL + 20) * 1000), mainloop.quit)
+      started = time.monotonic()
+      mainloop.run()
+
+      inFlight = server.requests.get('vehicle_data', 0)
+      service._account.executor.shutdown(wait=True)
+      service._account.shutdown()
+    server.shutdown()
+
+    self.assertTrue(fetched, 'vehicle_data never arrived')
+    self.assertGreaterEqual(fetched[0] - started, STALL - 1, 'the stub did not stall')
+    # one fetch at a time - no second request while the first one hangs
+    self.assertEqual(inFlight, 1)
+
+    stalled = [stamp for stamp in ticks if stamp < fetched[0]]
+    gaps = [later - earlier for earlier, later in zip(stalled, stalled[1:])]
+    self.assertGreaterEqual(len(stalled), int(STALL / TICK * 0.95))
+    self.assertLess(max(gaps), TICK + SLACK, 'main loop blocked for %.2f seconds' % (max(gaps)))
+
+
+if __name__ == "__main__":
+  unittest.main()
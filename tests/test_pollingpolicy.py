@@ -0,0 +1,143 @@
+# Replays recorded vehicle_data sequences through the polling policies and counts the API calls per day.
+# The simulated clock is the PollContext's `now` - a day runs in milliseconds.
+#
+# python -m pytest tests   (or: python -m unittest discover tests)
+import os
+import sys
+import json
+import random
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import pollingpolicy
+from pollingpolicy import PollContext, HeuristicPolicy, BackoffPolicy, RateBudgetPolicy
+from teslaerrors import ASLEEP, AUTH, OTHER, ErrorCounters
+
+RECORDING = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Replay', 'sample-vehicle-data.jsonl')
+DAY = 24 * 60 * 60
+# a Monday 00:00 - the heuristic only looks at the time of day on TICK events
+START = datetime(2024, 6, 3).timestamp()
+
+
+def loadRecording(path=RECORDING):
+  with open(path, 'r') as file:
+    return [json.loads(line) for line in file if line.strip()]
+
+
+def contextFor(sample, previous, consecutiveErrors, now):
+  # what the service passes after processing this sample
+  if 'vehicle_data' not in sample:
+    error = ASLEEP if sample.get('status') == 408 else OTHER
+    return PollContext(pollingpolicy.ERROR, previous, error=error, consecutiveErrors=consecutiveErrors, now=now)
+  response = sample['vehicle_data']['response']
+  charge_state = response.get('charge_state') or {}
+  drive_state = response.get('drive_state') or {}
+  charging = charge_state.get('charging_state') == 'Charging'
+  chargerPower = charge_state.get('charger_voltage', 0) * charge_state.get('charger_actual_current', 0) if charging else 0
+  return PollContext(pollingpolicy.DATA, previous, chargingState=charge_state.get('charging_state'),
+                     driving=bool(drive_state.get('speed') or drive_state.get('shift_state')), chargerPower=chargerPower,
+                     inverterPower=sample.get('inverter', 0), now=now)
+
+
+def replay(policy, samples, days=1):
+  # one request per sample (the recording is cycled), spaced by the interval the policy picks - returns the request times
+  now = START
+  previous = 30
+  errors = ErrorCounters()
+  requests = []
+  index = 0
+  while now < START + days * DAY:
+    sample = samples[index % len(samples)]
+    index += 1
+    policy.recordRequest(now)
+    requests.append(now)
+    if 'vehicle_data' in sample:
+      errors.resetRun()
+    else:
+      errors.record(ASLEEP if sample.get('status') == 408 else OTHER)
+    previous = policy.nextInterval(contextFor(sample, previous, errors.run, datetime.fromtimestamp(now)))
+    now += previous
+  return requests
+
+
+def maxPerDay(requests):
+  # most requests in any 24 hour window
+  most = 0
+  first = 0
+  for last in range(len(requests)):
+    while requests[last] - requests[first] >= DAY:
+      first += 1
+    most = max(most, last - first + 1)
+  return most
+
+
+class PollingPolicyReplayTest(unittest.TestCase):
+  def setUp(self):
+    random.seed(1)
+    self.samples = loadRecording()
+    self.asleep = [{'inverter': 0, 'status': 408, 'body': {'error': 'vehicle unavailable'}}]
+
+  def testHeuristicCallsPerDay(self):
+    # one pass over the recording: 300 (Stopped) + 4 x 30 (Charging) + 300 (Stopped) + 300 (408) + 3600 (driving)
+    # = 4620 seconds for 8 calls - 18 passes and all 8 calls of the 19th fit into the day
+    requests = replay(HeuristicPolicy(), self.samples)
+    self.assertEqual(len(requests), 152)
+
+  def testBackoffMatchesHeuristicWithoutErrorRuns(self):
+    # the recording never has two failures in a row - backoff only changes repeated errors
+    self.assertEqual(len(replay(BackoffPolicy(HeuristicPolicy()), self.samples)), len(replay(HeuristicPolicy(), self.samples)))
+
+  def testBackoffWhileAsleep(self):
+    # a car asleep all day: the heuristic probes every AsleepProbeInterval, backoff grows to an hour
+    heuristic = replay(HeuristicPolicy(), self.asleep)
+    backoff = replay(BackoffPolicy(HeuristicPolicy()), self.asleep)
+    self.assertEqual(len(heuristic), DAY // 300)
+    self.assertLess(len(backoff), 40)
+    self.assertGreater(len(backoff), 20)
+
+  def testBudgetCeiling(self):
+    for budget in (24, 48, 100):
+      requests = replay(RateBudgetPolicy(BackoffPolicy(HeuristicPolicy()), budget), self.samples, days=3)
+      self.assertLessEqual(maxPerDay(requests), budget, "budget %d" % (budget))
+      # spread evenly - not used up in the first hours of the day
+      self.assertGreaterEqual(requests[budget // 2] - requests[0], DAY / 2 - 3600)
+
+  def testBudgetAboveHeuristicChangesNothing(self):
+    # the budget also spaces calls by at least a day / budget - above 2880 a day even the 30 second interval fits
+    heuristic = replay(HeuristicPolicy(), self.samples)
+    budget = replay(RateBudgetPolicy(HeuristicPolicy(), 3000), self.samples)
+    self.assertEqual(len(budget), len(heuristic))
+
+  def testRevokedTokenBacksOff(self):
+    # a revoked refresh token fails every request with an auth error - 1, 2, 4, ... minutes up to AUTH_BACKOFF_MAX
+    policy = HeuristicPolicy()
+    now = START
+    previous = 30
+    requests = 0
+    while now < START + DAY:
+      requests += 1
+      previous = policy.nextInterval(PollContext(pollingpolicy.ERROR, previous, error=AUTH, consecutiveErrors=requests,
+                                                 now=datetime.fromtimestamp(now)))
+      now += previous
+    self.assertLessEqual(requests, 12)
+
+  def testAuthAfterAsleepNightRetriesSoon(self):
+    # a night of asleep results, then the token expires - the first auth failure starts its own run
+    errors = ErrorCounters()
+    for _ in range(100):
+      errors.record(ASLEEP)
+    errors.record(AUTH)
+    self.assertEqual(errors.run, 1)
+    for policy in (HeuristicPolicy(), BackoffPolicy(HeuristicPolicy())):
+      interval = policy.nextInterval(PollContext(pollingpolicy.ERROR, 600, error=AUTH, consecutiveErrors=errors.run,
+                                                 now=datetime.fromtimestamp(START)))
+      self.assertLessEqual(interval, 60, policy.name)
+    # the second auth failure in a row backs off
+    errors.record(AUTH)
+    self.assertEqual(errors.run, 2)
+    self.assertEqual(HeuristicPolicy().nextInterval(PollContext(pollingpolicy.ERROR, 60, error=AUTH, consecutiveErrors=errors.run)), 120)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,80 @@
+# SurplusController decisions on a simulated clock - 230 V single phase, so 1 A is 230 W.
+#
+# python -m pytest tests/test_surpluscontroller.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from surpluscontroller import SurplusController
+
+VOLTS = 230
+
+
+def charging(controller, amps, surplus, now, **kwargs):
+  # the car draws (and requested) `amps`, the inverter delivers that plus `surplus` watts
+  return controller.update(amps * VOLTS + surplus, VOLTS, amps, amps, now=now, **kwargs)
+
+
+class SurplusControllerTest(unittest.TestCase):
+  def testHysteresis(self):
+    controller = SurplusController()
+    # 150 W unused - below the 200 W hysteresis, keep the current
+    self.assertIsNone(charging(controller, 10, 150, 0))
+    # 250 W unused - one more amp
+    self.assertEqual(charging(controller, 10, 250, 0), 11)
+
+  def testLowersAtOnce(self):
+    # drawing 50 W more than the surplus already lowers the current - no hysteresis downwards
+    self.assertEqual(charging(SurplusController(), 10, -50, 0), 9)
+
+  def testDeadband(self):
+    controller = SurplusController(deadband=2)
+    self.assertIsNone(charging(controller, 10, 250, 0))
+    self.assertEqual(controller.target, 11)
+    self.assertEqual(charging(controller, 10, 2 * VOLTS + 10, 0), 12)
+
+  def testClamp(self):
+    self.assertEqual(charging(SurplusController(maxAmps=16), 10, 10000, 0), 16)
+    self.assertEqual(charging(SurplusController(), 10, 10000, 0, carMaxAmps=13), 13)
+    self.assertIsNone(charging(SurplusController(minAmps=5), 5, -2000, 0))
+
+  def testCommandIntervalHold(self):
+    controller = SurplusController(commandInterval=60)
+    self.assertEqual(charging(controller, 10, 250, 0), 11)
+    # the next change is held back until commandInterval passed
+    self.assertIsNone(charging(controller, 11, 250, 30))
+    self.assertEqual(controller.suppressed, 1)
+    self.assertEqual(charging(controller, 11, 250, 61), 12)
+    self.assertEqual(controller.commands, 2)
+
+  def testSlewRate(self):
+    controller = SurplusController(slewRate=6, commandInterval=60)
+    self.assertEqual(charging(controller, 10, 250, 0), 11)
+    # 10 kW unused after 61 seconds - at most 6 A per minute
+    self.assertEqual(charging(controller, 11, 10000, 61), 17)
+    # and at least one amp even right after the hold
+    controller = SurplusController(slewRate=0.5, commandInterval=60)
+    self.assertEqual(charging(controller, 10, 250, 0), 11)
+    self.assertEqual(charging(controller, 11, 10000, 61), 12)
+
+  def testStaleData(self):
+    controller = SurplusController(maxDataAge=600)
+    # no fetch yet, or the last one too old - no command to a car that may have stopped charging
+    self.assertIsNone(charging(controller, 10, 2000, 0, dataAge=None))
+    self.assertIsNone(charging(controller, 10, 2000, 0, dataAge=601))
+    self.assertEqual(controller.stale, 2)
+    self.assertEqual(controller.commands, 0)
+    self.assertEqual(charging(controller, 10, 2000, 0, dataAge=30), 18)
+
+  def testStaleDataRereadsTheCar(self):
+    controller = SurplusController()
+    self.assertEqual(charging(controller, 10, 250, 0), 11)
+    charging(controller, 10, 250, 10, dataAge=None)
+    # the car's own value counts again, not the 11 A sent before the data went stale
+    self.assertIsNone(charging(controller, 16, 100, 20))
+    self.assertEqual(controller.commanded, 16)
+
+
+if __name__ == "__main__":
+  unittest.main()
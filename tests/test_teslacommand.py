@@ -0,0 +1,147 @@
+# TeslaCommandClient against a broker that is missing, hangs or answers garbage, and the queue order of the broker.
+# tesla-control itself is never started - _direct and _execute are replaced by recorders.
+#
+# python -m pytest tests/test_teslacommand.py
+import os
+import sys
+import socket
+import tempfile
+import threading
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from teslacommand import TeslaCommandClient, TeslaCommandBroker
+
+
+class FakeBroker:
+  # accepts one connection, reads the request line and answers with `answer` (None: no answer, just hold the connection)
+  def __init__(self, path, answer):
+    self.answer = answer
+    self.requests = []
+    self._closing = threading.Event()
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.bind(path)
+    self._socket.listen(1)
+    threading.Thread(target=self._serve, daemon=True).start()
+
+  def _serve(self):
+    try:
+      connection, address = self._socket.accept()
+    except OSError:
+      # closed before anyone connected
+      return
+    with connection:
+      self.requests.append(connection.makefile('r').readline())
+      if self.answer is None:
+        self._closing.wait(10)
+      else:
+        connection.sendall(self.answer)
+
+  def close(self):
+    self._closing.set()
+    self._socket.close()
+
+
+class TeslaCommandClientTest(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self._directory.name, 'command.sock')
+    self.broker = None
+    self.direct = []
+    self.client = TeslaCommandClient(self.path, timeout=0.5)
+    self.client._direct = self._direct
+
+  def tearDown(self):
+    if self.broker:
+      self.broker.close()
+    self._directory.cleanup()
+
+  def _direct(self, command, args, vin):
+    self.direct.append(command)
+    return {'ok': True, 'returncode': 0, 'stdout': '', 'stderr': '', 'coalesced': False}
+
+  def testNoBrokerRunsDirectly(self):
+    self.client.run('charging-start')
+    self.assertEqual(self.direct, ['charging-start'])
+
+  def testStaleSocketRunsDirectly(self):
+    # socket file left behind by a dead broker - connection refused
+    FakeBroker(self.path, b'').close()
+    self.client.run('charging-start')
+    self.assertEqual(self.direct, ['charging-start'])
+
+  def testAnswer(self):
+    self.broker = FakeBroker(self.path, b'{"ok": true, "returncode": 0, "stdout": "", "stderr": ""}\n')
+    self.assertTrue(self.client.run('charging-set-amps', 12)['ok'])
+    self.assertEqual(self.direct, [])
+
+  def testFailuresAfterSendingDoNotRunTwice(self):
+    # the broker got the request and may run it - the client fails instead of starting its own tesla-control
+    for answer in (None, b'', b'{"ok": tr', b'[]\n'):
+      with self.subTest(answer=answer):
+        self.broker = FakeBroker(self.path, answer)
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+          self.client.run('charging-stop')
+        self.assertIn('broker error', raised.exception.stderr.decode())
+        self.assertEqual(len(self.broker.requests), 1)
+        self.assertEqual(self.direct, [])
+        self.broker.close()
+        os.remove(self.path)
+        self.broker = None
+
+
+class TeslaCommandBrokerTest(unittest.TestCase):
+  def setUp(self):
+    self.broker = TeslaCommandBroker(socketPath=None)
+    self.executed = []
+    self.release = threading.Event()
+    self.broker._execute = self._execute
+    threading.Thread(target=self.broker._work, daemon=True).start()
+
+  def tearDown(self):
+    self.release.set()
+
+  def _execute(self, pending):
+    # the first command hangs until released, so the others queue up behind it
+    if not self.executed:
+      self.executed.append(pending.command)
+      self.release.wait(10)
+    else:
+      self.executed.append(pending.command)
+    return {'ok': True, 'returncode': 0, 'stdout': '', 'stderr': ''}
+
+  def _waitForRunning(self):
+    for _ in range(100):
+      if self.executed:
+        return
+      threading.Event().wait(0.01)
+    self.fail('first command never started')
+
+  def testLastRequestWins(self):
+    # charging-stop running, start and stop queued - a new start must not join the first start
+    first = self.broker.submit('charging-stop')
+    self._waitForRunning()
+    queued = [self.broker.submit(command) for command in ('charging-start', 'charging-stop', 'charging-start')]
+    self.assertEqual(self.broker.coalesced, 0)
+    self.release.set()
+    for pending in [first] + queued:
+      self.assertTrue(pending.done.wait(5))
+    self.assertEqual(self.executed, ['charging-stop', 'charging-start', 'charging-stop', 'charging-start'])
+
+  def testCoalescesWithLastQueued(self):
+    first = self.broker.submit('charging-stop')
+    self._waitForRunning()
+    start = self.broker.submit('charging-start')
+    self.assertIs(self.broker.submit('charging-start'), start)
+    # the running command is never joined
+    stop = self.broker.submit('charging-stop')
+    self.assertIsNot(stop, first)
+    self.assertEqual(self.broker.coalesced, 1)
+    self.release.set()
+    self.assertTrue(stop.done.wait(5))
+    self.assertEqual(self.executed, ['charging-stop', 'charging-start', 'charging-stop'])
+
+
+if __name__ == "__main__":
+  unittest.main()
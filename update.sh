@@ -1,7 +1,10 @@
 #!/bin/bash
 SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
-rm $SCRIPT_DIR/dbus-teslaapi-evcharger.py
-wget https://raw.githubusercontent.com/rsmith0906/dbus-teslaapi-evcharger/main/dbus-teslaapi-evcharger.py
+for file in dbus-teslaapi-evcharger.py teslaconfig.py teslahttp.py inverterpower.py scheduler.py pollingpolicy.py dbuspublisher.py teslacommand.py vehiclecache.py teslastream.py teslatoken.py teslaerrors.py ratelimiter.py teslaaccount.py surpluscontroller.py teslaenv.py metrics.py teslalog.py chargehistory.py powerestimator.py profiler.py
+do
+    rm $SCRIPT_DIR/$file
+    wget https://raw.githubusercontent.com/rsmith0906/dbus-teslaapi-evcharger/main/$file
+done
 rm $SCRIPT_DIR/current.log
 kill $(pgrep -f "python $SCRIPT_DIR/dbus-teslaapi-evcharger.py")
@@ -0,0 +1,84 @@
+# In-memory cache of the last vehicle_data snapshot.
+# Every reader is served from RAM. The snapshot is persisted with write-to-temp + rename, at most once per
+# persistInterval seconds (and on shutdown), under /data so it survives reboots and a cold start can publish
+# the VIN and firmware version right away.
+import os
+import json
+import time
+import logging
+
+
+class VehicleStateCache:
+  def __init__(self, path, persistInterval=900):
+    self.path = path
+    self.persistInterval = persistInterval
+    self.data = None
+    self.fetched = None     # time.time() of the fetch that produced data
+    self.writes = 0
+    self._dirty = False
+    self._lastPersist = None
+    self._load()
+
+  @property
+  def age(self):
+    # seconds since the snapshot was fetched, None if there is none
+    if self.fetched is None:
+      return None
+    return time.time() - self.fetched
+
+  def get(self, *keys, default=None):
+    # cache.get('charge_state', 'charging_state') - looks inside data['response']
+    value = self.data['response'] if self.data else None
+    for key in keys:
+      if not isinstance(value, dict) or key not in value:
+        return default
+      value = value[key]
+    return value
+
+  def update(self, data, fetched=None):
+    self.data = data
+    self.fetched = fetched or time.time()
+    self._dirty = True
+    if self.persistDue() <= 0:
+      self.flush()
+
+  def persistDue(self):
+    # seconds until the next write is allowed, None if nothing needs to be written
+    if not self._dirty:
+      return None
+    if self._lastPersist is None:
+      return 0.0
+    return max(0.0, self._lastPersist + self.persistInterval - time.monotonic())
+
+  def flush(self):
+    if not self._dirty:
+      return False
+
+    temp_path = "%s.tmp" % (self.path)
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      with open(temp_path, 'w') as file:
+        json.dump({'fetched': self.fetched, 'data': self.data}, file)
+        file.flush()
+        os.fsync(file.fileno())
+      os.replace(temp_path, self.path)
+    except OSError as e:
+      logging.error("Could not persist vehicle state to %s: %s" % (self.path, e))
+      return False
+
+    self._dirty = False
+    self._lastPersist = time.monotonic()
+    self.writes += 1
+    return True
+
+  def _load(self):
+    try:
+      with open(self.path, 'r') as file:
+        saved = json.load(file)
+      self.data = saved['data']
+      self.fetched = saved['fetched']
+      logging.info("Loaded vehicle state from %s (%.0f seconds old)" % (self.path, self.age))
+    except FileNotFoundError:
+      pass
+    except Exception as e:
+      logging.error("Ignoring unreadable vehicle state %s: %s" % (self.path, e))